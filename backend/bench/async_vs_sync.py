@@ -0,0 +1,67 @@
+#####
+# Compare latency of the sync and async (aiosqlite) request paths under concurrent load
+#    - `python -m bench.async_vs_sync --concurrency 100 --requests 5000`
+#####
+
+import argparse
+import json
+import os
+import tempfile
+
+from bench.common import prepare_database, print_table, run_load, run_server
+
+# a mix of cheap lookups and range scans
+REQUESTS = [
+    ("GET", "/physicians?state=CA"),
+    ("GET", "/messages?physician_id=101"),
+    ("GET", "/messages?start_date=2025-07-01T00:00:00&end_date=2025-08-01T00:00:00"),
+    ("POST", "/classify/10013"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--data-dir", default="sample_data")
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        prepare_database(db_path, args.data_dir)
+
+        results = []
+        for mode, db_url in (
+            ("sync", f"sqlite:///{db_path}"),
+            ("async", f"sqlite+aiosqlite:///{db_path}"),
+        ):
+            with run_server(db_url) as server:
+                # warm up connections and compiled statements
+                run_load(
+                    server.base_url, REQUESTS, args.concurrency, len(REQUESTS) * 10
+                )
+                summary = run_load(
+                    server.base_url, REQUESTS, args.concurrency, args.requests
+                )
+            results.append({"mode": mode, "concurrency": args.concurrency, **summary})
+
+    print_table(
+        results,
+        [
+            "mode",
+            "concurrency",
+            "requests",
+            "errors",
+            "throughput_rps",
+            "p50_ms",
+            "p99_ms",
+        ],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
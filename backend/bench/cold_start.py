@@ -0,0 +1,161 @@
+#####
+# Cold start of an api process with and without the startup warm-up
+#    - `python -m bench.cold_start --messages 200000`
+#    - time until the process accepts requests and until GET /ready answers 200
+#    - latency of the first request to every endpoint against its steady state (median
+#      of the following requests), every request has its own query string or body so the
+#      response and draft classification caches never answer it
+#####
+
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from bench.common import prepare_database, print_table, run_server
+from bench.generate import generate
+
+
+def endpoint_requests(
+    db_path: str, count: int
+) -> dict[str, list[tuple[str, str, dict | None]]]:
+    """(method, path, json body) of `count` distinct requests per endpoint"""
+    with sqlite3.connect(db_path) as conn:
+        message_ids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT message_id FROM messages ORDER BY message_id LIMIT ?", (count,)
+            )
+        ]
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return {
+        "/physicians": [
+            ("GET", f"/physicians?limit={100 - i}", None) for i in range(count)
+        ],
+        "/messages": [
+            ("GET", f"/messages?limit={100 - i}", None) for i in range(count)
+        ],
+        "/stats": [("GET", f"/stats?limit={1000 - i}", None) for i in range(count)],
+        "/physicians/search": [
+            (
+                "GET",
+                f"/physicians/search?prefix={letters[i % 26]}&limit={20 - i % 20}",
+                None,
+            )
+            for i in range(count)
+        ],
+        "/classify/{message_id}": [
+            ("POST", f"/classify/{message_id}", None) for message_id in message_ids
+        ],
+        "/classify/text": [
+            (
+                "POST",
+                "/classify/text",
+                {"text": f"Dosing question {i} about the trial."},
+            )
+            for i in range(count)
+        ],
+    }
+
+
+def measure_endpoints(base_url: str, requests: dict) -> list[dict]:
+    results = []
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        for endpoint, endpoint_requests in requests.items():
+            latencies = []
+            for method, path, body in endpoint_requests:
+                start_time = time.perf_counter()
+                response = client.request(method, path, json=body)
+                latencies.append(time.perf_counter() - start_time)
+                response.raise_for_status()
+            first, *rest = latencies
+            steady = statistics.median(rest)
+            results.append(
+                {
+                    "endpoint": endpoint,
+                    "first_ms": first * 1000,
+                    "steady_p50_ms": steady * 1000,
+                    "first_vs_steady": first / steady,
+                }
+            )
+    return results
+
+
+def run_cold_start(db_path: str, warmup: bool, count: int) -> list[dict]:
+    env = {"WARMUP": "1" if warmup else "0"}
+    with run_server(f"sqlite:///{db_path}", env=env, ready_path="/ready") as server:
+        ready = httpx.get(f"{server.base_url}/ready").json()
+        endpoints = measure_endpoints(
+            server.base_url, endpoint_requests(db_path, count)
+        )
+    startup = {
+        "warmup": warmup,
+        "listening_s": server.listening_seconds,
+        "ready_s": server.ready_seconds,
+        "warmup_s": ready["warmup_seconds"],
+        **{f"{step}_s": seconds for step, seconds in ready["warmup_steps"].items()},
+    }
+    return [startup, *({"warmup": warmup, **row} for row in endpoints)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=20,
+        help="Requests per endpoint, the first is cold",
+    )
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(data_dir, args.messages)
+        db_path = os.path.join(tmp_dir, "bench.db")
+
+        startups, endpoints = [], []
+        for warmup in (False, True):
+            # a fresh database file per run, classify requests store their results
+            prepare_database(db_path, data_dir)
+            startup, *rows = run_cold_start(db_path, warmup, args.requests)
+            startups.append(startup)
+            endpoints.extend(rows)
+
+    print(f"cpus: {os.cpu_count()}")
+    print_table(
+        startups,
+        [
+            "warmup",
+            "listening_s",
+            "ready_s",
+            "warmup_s",
+            "database_s",
+            "connections_s",
+            "statements_s",
+            "physician_directory_s",
+        ],
+    )
+    print()
+    print_table(
+        endpoints,
+        ["warmup", "endpoint", "first_ms", "steady_p50_ms", "first_vs_steady"],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"startup": startups, "endpoints": endpoints}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#####
+# Shared benchmark helpers
+#    - every benchmark runs offline against a local sqlite file and a real uvicorn process
+#####
+
+import asyncio
+import contextlib
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def manage(db_url: str, *args: str) -> tuple[float, float]:
+    """Runs `python -m db.manage <args>` against the database, returns (seconds, peak rss mb)"""
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "db.manage", *args],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "DB_URL": db_url},
+        stdout=subprocess.DEVNULL,
+    )
+    # wait4 reports the peak memory of this child, RUSAGE_CHILDREN would be the max
+    # over every child this process ever waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return elapsed, max_rss_mb(usage)
+
+
+def max_rss_mb(usage: resource.struct_rusage) -> float:
+    # linux reports kilobytes, macos bytes
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / scale
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    """Peak resident memory of a running process so far, None where /proc is unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def prepare_database(
+    db_path: str, data_dir: str = "sample_data", bulk: bool = True
+) -> tuple[float, float]:
+    """Creates and loads a fresh sqlite database file, returns (seconds, peak rss mb) of the load"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db_url = f"sqlite:///{os.path.abspath(db_path)}"
+    manage(db_url, "migrate")
+    load_args = ["load", "--data-dir", os.path.abspath(data_dir)]
+    if bulk:
+        load_args.append("--bulk")
+    return manage(db_url, *load_args)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@dataclass
+class Server:
+    base_url: str
+    pid: int
+    # from starting the process until it accepted a request / answered `ready_path`
+    listening_seconds: float = 0.0
+    ready_seconds: float = 0.0
+
+
+@contextlib.contextmanager
+def run_server(
+    db_url: str,
+    workers: int = 1,
+    env: dict[str, str] | None = None,
+    ready_path: str = "/physicians?limit=1",
+) -> Iterator[Server]:
+    """Starts uvicorn on a free port and yields it once `ready_path` answers with a 200"""
+    port = free_port()
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "DB_URL": db_url, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        server = Server(base_url, process.pid)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                response = httpx.get(f"{base_url}{ready_path}", timeout=1)
+                if not server.listening_seconds:
+                    server.listening_seconds = time.perf_counter() - start_time
+                if response.status_code == 200:
+                    server.ready_seconds = time.perf_counter() - start_time
+                    break
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("Server did not start")
+            time.sleep(0.01)
+        yield server
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def _run_load(
+    base_url: str,
+    requests: list[tuple[str, str]],
+    concurrency: int,
+    total: int,
+) -> tuple[list[float], int, float]:
+    latencies: list[float] = []
+    errors = 0
+    next_request = 0
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+
+        async def worker():
+            nonlocal next_request, errors
+            while next_request < total:
+                method, path = requests[next_request % len(requests)]
+                next_request += 1
+                start_time = time.perf_counter()
+                try:
+                    response = await client.request(method, path)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+    return latencies, errors, elapsed
+
+
+def run_load(
+    base_url: str,
+    requests: list[tuple[str, str]],
+    concurrency: int,
+    total: int,
+) -> dict:
+    """Sends `total` requests (cycling through `requests`) from `concurrency` concurrent clients"""
+    latencies, errors, elapsed = asyncio.run(
+        _run_load(base_url, requests, concurrency, total)
+    )
+    return summarize(latencies, elapsed, errors)
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int = 0) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": len(ordered) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+    }
+
+
+def print_table(rows: list[dict], columns: list[str]):
+    widths = [
+        max(len(c), *(len(format_cell(row.get(c))) for row in rows)) for c in columns
+    ]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print(
+            "  ".join(format_cell(row.get(c)).ljust(w) for c, w in zip(columns, widths))
+        )
+
+
+def format_cell(value) -> str:
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
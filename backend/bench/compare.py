@@ -0,0 +1,65 @@
+#####
+# Compare two result files of `python -m bench.run`
+#    - `python -m bench.compare bench/results/<before>.json bench/results/<after>.json`
+#####
+
+import argparse
+import json
+
+from bench.common import print_table
+
+METRICS = [
+    "throughput_rows_per_second",
+    "throughput_rps",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "errors",
+    "peak_rss_mb",
+]
+
+
+def load_results(path: str) -> tuple[str, dict[str, dict]]:
+    with open(path) as f:
+        data = json.load(f)
+    label = f"{data['commit']}{'-dirty' if data['dirty'] else ''}"
+    return label, {result["name"]: result for result in data["results"]}
+
+
+def compare(before: dict[str, dict], after: dict[str, dict]) -> list[dict]:
+    rows = []
+    for name, after_result in after.items():
+        before_result = before.get(name, {})
+        for metric in METRICS:
+            if after_result.get(metric) is None:
+                continue
+            old, new = before_result.get(metric), after_result[metric]
+            change = None
+            if old:
+                change = f"{(new - old) / old * 100:+.1f}%"
+            rows.append(
+                {
+                    "name": name,
+                    "metric": metric,
+                    "before": old,
+                    "after": new,
+                    "change": change,
+                }
+            )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    before_label, before = load_results(args.before)
+    after_label, after = load_results(args.after)
+    print(f"{before_label} -> {after_label}")
+    print_table(compare(before, after), ["name", "metric", "before", "after", "change"])
+
+
+if __name__ == "__main__":
+    main()
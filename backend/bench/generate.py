@@ -0,0 +1,445 @@
+#####
+# Synthetic data at configurable scale, in the formats `db.manage load` and `load-policy` read
+#    - `python -m bench.generate --out-dir bench/data/1m --messages 1000000 --keywords 5000 --versions 3`
+#    - writes physicians.csv, messages.csv, compliance_policies.json (v1) and
+#      compliance_policies_v2.json ... for every later version
+#    - rows are streamed to disk so 10^7 messages need no more memory than 10^3
+#    - the same seed always produces the same files
+#####
+
+import argparse
+import csv
+import json
+import os
+import random
+from datetime import date, datetime, timedelta
+from itertools import product
+
+FIRST_NAMES = [
+    "Cameron",
+    "Casey",
+    "Drew",
+    "Elliot",
+    "Hayden",
+    "Jamie",
+    "Jordan",
+    "Kai",
+    "Morgan",
+    "Riley",
+    "Sam",
+    "Taylor",
+    "Avery",
+    "Quinn",
+    "Rowan",
+    "Skyler",
+]
+LAST_NAMES = [
+    "Anderson",
+    "Davis",
+    "Garcia",
+    "Jackson",
+    "Johnson",
+    "Kim",
+    "Lee",
+    "Martinez",
+    "Nguyen",
+    "Patel",
+    "Thomas",
+    "White",
+    "Wilson",
+    "Brown",
+    "Lopez",
+    "Clark",
+]
+SPECIALTIES = [
+    "Cardiology",
+    "Dermatology",
+    "Endocrinology",
+    "Family Medicine",
+    "Gastroenterology",
+    "Neurology",
+    "Oncology",
+    "Pulmonology",
+    "Rheumatology",
+    "Nephrology",
+]
+STATES = ["CA", "CT", "FL", "GA", "MA", "NJ", "NY", "PA", "TX", "IL", "OH", "WA"]
+CHANNELS = ["email", "voice", "sms"]
+
+# topic -> message texts, the first one of each is the text used in sample_data
+TOPIC_TEXTS = {
+    "reimbursement": [
+        "Question about reimbursement and prior auth forms.",
+        "Coverage denied, need help with the appeal.",
+        "Copay card enrollment for a new patient.",
+    ],
+    "scheduling": [
+        "Schedule a rep connect call next week.",
+        "Can we move the lunch meeting to Thursday?",
+        "Please confirm the in-service time.",
+    ],
+    "samples": [
+        "Requesting patient samples for clinic use.",
+        "Running low on starter packs, sample request attached.",
+    ],
+    "medical_info": [
+        "Medical information request on latest data.",
+        "Looking for the updated prescribing information.",
+    ],
+    "dosing": [
+        "Clarify dosing schedule and titration.",
+        "What is the maximum dose for renal impairment?",
+    ],
+    "trial": [
+        "Eligibility for clinical trial referral.",
+        "Any open studies for refractory patients?",
+    ],
+    "safety": [
+        "Safety profile and contraindications.",
+        "Reporting a possible adverse event.",
+    ],
+}
+TOPICS = list(TOPIC_TEXTS)
+
+# keywords are built from these, a phrase of two or three words is a realistic policy term
+KEYWORD_WORDS = [
+    "off-label",
+    "unapproved",
+    "dosing",
+    "titration",
+    "loading",
+    "pediatric",
+    "geriatric",
+    "renal",
+    "hepatic",
+    "cardiac",
+    "pregnancy",
+    "lactation",
+    "overdose",
+    "interaction",
+    "contraindication",
+    "warning",
+    "boxed",
+    "adverse",
+    "serious",
+    "fatal",
+    "trial",
+    "registry",
+    "enrollment",
+    "eligibility",
+    "placebo",
+    "efficacy",
+    "superiority",
+    "comparison",
+    "guarantee",
+    "cure",
+    "miracle",
+    "free",
+    "discount",
+    "rebate",
+    "copay",
+    "voucher",
+    "coupon",
+    "samples",
+    "starter",
+    "kit",
+    "gift",
+    "meal",
+    "honorarium",
+    "speaker",
+    "consulting",
+    "grant",
+    "PHI",
+    "SSN",
+    "MRN",
+    "DOB",
+    "address",
+    "phone",
+    "diagnosis",
+    "prescription",
+    "refill",
+    "switch",
+    "substitute",
+    "generic",
+    "biosimilar",
+    "formulary",
+    "coverage",
+    "appeal",
+    "denial",
+    "prior-auth",
+    "step-therapy",
+]
+
+# the keywords of sample_data, kept in every version so small scales classify the same way
+BASE_RULES = [
+    (
+        "R-001",
+        "No off-label claims",
+        ["off-label", "unapproved use"],
+        ("action", "flag"),
+    ),
+    (
+        "R-002",
+        "Include safety statement when mentioning dosing",
+        ["dosing", "titration"],
+        ("requires_append", "See PI for full safety info."),
+    ),
+    ("R-003", "No patient PHI", ["DOB:", "SSN", "MRN"], ("action", "reject")),
+    (
+        "R-004",
+        "Samples request needs rep follow-up",
+        ["samples", "sample request"],
+        ("action", "route_to_rep"),
+    ),
+    (
+        "R-005",
+        "Clinical trial info must cite registry",
+        ["trial", "clinical trial"],
+        ("requires_append", "Refer to ClinicalTrials.gov for eligibility details."),
+    ),
+]
+ACTIONS = ["flag", "reject", "route_to_rep", "escalate"]
+
+KEYWORDS_PER_RULE = 10
+# fraction of keywords added and removed between consecutive versions
+VERSION_CHURN = 0.02
+# fraction of messages that mention a policy keyword
+KEYWORD_MESSAGE_RATE = 0.3
+
+START_TIMESTAMP = datetime(2024, 1, 1)
+TIMESTAMP_RANGE_SEC = 2 * 365 * 24 * 3600
+FIRST_PHYSICIAN_ID = 101
+FIRST_MESSAGE_ID = 10001
+
+
+def keyword_pool(count: int, rng: random.Random) -> list[str]:
+    """`count` distinct multi word keywords in a random (seeded) order"""
+    base_keywords = {
+        keyword for _, _, keywords, _ in BASE_RULES for keyword in keywords
+    }
+    pairs = [f"{a} {b}" for a, b in product(KEYWORD_WORDS, repeat=2) if a != b]
+    rng.shuffle(pairs)
+    pool = [keyword for keyword in pairs if keyword not in base_keywords]
+    if count > len(pool):
+        triples = (
+            f"{a} {b} {c}"
+            for a, b, c in product(KEYWORD_WORDS, repeat=3)
+            if len({a, b, c}) == 3
+        )
+        pool.extend(triple for triple, _ in zip(triples, range(count - len(pool))))
+    return pool[:count]
+
+
+def policy_versions(
+    keyword_count: int, version_count: int, rng: random.Random
+) -> list[dict]:
+    """Compliance policies v1..vN, each one replacing a few keywords of the previous"""
+    churn = int(keyword_count * VERSION_CHURN)
+    # the keywords later versions add are drawn from the same pool
+    pool = keyword_pool(keyword_count + churn * version_count, rng)
+    unused = iter(pool[keyword_count:])
+    rule_keywords = [
+        pool[index : min(index + KEYWORDS_PER_RULE, keyword_count)]
+        for index in range(0, keyword_count, KEYWORDS_PER_RULE)
+    ]
+
+    policies = []
+    updated = date(2025, 9, 22)
+    for number in range(1, version_count + 1):
+        if number > 1:
+            # keywords are replaced in place, the other keywords stay in their rule
+            rule_keywords = [list(keywords) for keywords in rule_keywords]
+            for _ in range(churn):
+                keywords = rng.choice(rule_keywords)
+                keywords[rng.randrange(len(keywords))] = next(unused)
+            updated += timedelta(days=30)
+
+        rules = [
+            rule_dict(rule_id, name, keywords, result)
+            for rule_id, name, keywords, result in BASE_RULES
+        ]
+        for offset, keywords in enumerate(rule_keywords, start=len(BASE_RULES) + 1):
+            result = (
+                ("action", ACTIONS[offset % len(ACTIONS)])
+                if offset % 3
+                else ("requires_append", f"See policy section {offset}.")
+            )
+            rules.append(
+                rule_dict(
+                    f"R-{offset:03d}", f"Generated rule {offset}", keywords, result
+                )
+            )
+        policies.append(
+            {"version": f"v{number}", "updated": updated.isoformat(), "rules": rules}
+        )
+    return policies
+
+
+def rule_dict(
+    rule_id: str, name: str, keywords: list[str], result: tuple[str, str]
+) -> dict:
+    result_type, result_text = result
+    return {
+        "id": rule_id,
+        "name": name,
+        "keywords_any": keywords,
+        result_type: result_text,
+    }
+
+
+def write_physicians(path: str, count: int, rng: random.Random):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "physician_id",
+                "npi",
+                "first_name",
+                "last_name",
+                "specialty",
+                "state",
+                "consent_opt_in",
+                "preferred_channel",
+            ]
+        )
+        for physician_id in range(FIRST_PHYSICIAN_ID, FIRST_PHYSICIAN_ID + count):
+            writer.writerow(
+                [
+                    physician_id,
+                    str(1_000_000_000 + rng.randrange(999_999_999)),
+                    rng.choice(FIRST_NAMES),
+                    rng.choice(LAST_NAMES),
+                    rng.choice(SPECIALTIES),
+                    rng.choice(STATES),
+                    rng.random() < 0.7,
+                    rng.choice(CHANNELS),
+                ]
+            )
+
+
+def write_messages(
+    path: str, count: int, physician_count: int, keywords: list[str], rng: random.Random
+):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "message_id",
+                "physician_id",
+                "channel",
+                "direction",
+                "timestamp",
+                "message_text",
+                "campaign_id",
+                "topic",
+                "compliance_tag",
+                "sentiment",
+                "delivery_status",
+                "response_latency_sec",
+            ]
+        )
+        for message_id in range(FIRST_MESSAGE_ID, FIRST_MESSAGE_ID + count):
+            topic = rng.choice(TOPICS)
+            text = rng.choice(TOPIC_TEXTS[topic])
+            if rng.random() < KEYWORD_MESSAGE_RATE:
+                text = f"{text} Mentions {rng.choice(keywords)}."
+            is_outbound = rng.random() < 0.7
+            timestamp = START_TIMESTAMP + timedelta(
+                seconds=rng.randrange(TIMESTAMP_RANGE_SEC)
+            )
+            writer.writerow(
+                [
+                    message_id,
+                    FIRST_PHYSICIAN_ID + rng.randrange(physician_count),
+                    rng.choice(CHANNELS),
+                    "outbound" if is_outbound else "inbound",
+                    timestamp.strftime("%Y-%m-%dT%H:%M:%S"),
+                    text,
+                    f"CMP-{rng.randrange(10, 100)}",
+                    topic,
+                    rng.choices(["allowed", "needs_review", "disallowed"], [76, 18, 6])[
+                        0
+                    ],
+                    rng.choices(["neutral", "positive", "negative"], [52, 28, 20])[0],
+                    rng.choices(["delivered", "bounced", "failed"], [86, 11, 3])[0],
+                    # only replies have a response latency
+                    "" if is_outbound else float(rng.randrange(30, 3600)),
+                ]
+            )
+
+
+def generate(
+    out_dir: str,
+    message_count: int,
+    physician_count: int | None = None,
+    keyword_count: int = 1000,
+    version_count: int = 3,
+    seed: int = 0,
+) -> list[str]:
+    """Writes the data set to `out_dir`, returns the policy files of every version in order"""
+    rng = random.Random(seed)
+    if physician_count is None:
+        physician_count = max(25, message_count // 100)
+    os.makedirs(out_dir, exist_ok=True)
+
+    policies = policy_versions(keyword_count, version_count, rng)
+    policy_paths = []
+    for policy in policies:
+        # v1 is the policy `db.manage load` reads, the later ones are for `load-policy`
+        file_name = (
+            "compliance_policies.json"
+            if policy["version"] == "v1"
+            else f"compliance_policies_{policy['version']}.json"
+        )
+        policy_path = os.path.join(out_dir, file_name)
+        with open(policy_path, "w") as f:
+            json.dump(policy, f, indent=2)
+        policy_paths.append(policy_path)
+
+    # messages mention keywords of every version so each version has work to do
+    all_keywords = sorted(
+        {
+            k
+            for policy in policies
+            for rule in policy["rules"]
+            for k in rule["keywords_any"]
+        }
+    )
+    write_physicians(os.path.join(out_dir, "physicians.csv"), physician_count, rng)
+    write_messages(
+        os.path.join(out_dir, "messages.csv"),
+        message_count,
+        physician_count,
+        all_keywords,
+        rng,
+    )
+    return policy_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic physicians, messages and policies"
+    )
+    parser.add_argument("--out-dir", required=True)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument(
+        "--physicians", type=int, help="Defaults to one per 100 messages"
+    )
+    parser.add_argument("--keywords", type=int, default=1000)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(
+        args.out_dir,
+        args.messages,
+        args.physicians,
+        args.keywords,
+        args.versions,
+        args.seed,
+    )
+    print(f"Generated {args.messages} messages in {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#####
+# Sustained ingest throughput of POST /messages/ingest
+#    - `python -m bench.ingest --total 200000 --batch-size 500 --concurrency 8`
+#    - clients post NDJSON batches as fast as the api accepts them and back off on a 429,
+#      the rate is measured until every message is written and classified
+#####
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import create_engine, func, select
+
+from bench.common import prepare_database, print_table, run_server
+from bench.generate import generate
+
+
+def ingest_bodies(
+    db_path: str, total: int, batch_size: int, seed: int = 0
+) -> tuple[list[bytes], int]:
+    """NDJSON request bodies of `total` new messages, and the largest message id before them"""
+    from db.models import Message, Physician
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        last_message_id = conn.execute(
+            select(func.max(Message.message_id))
+        ).scalar_one()
+        physician_ids = list(conn.execute(select(Physician.physician_id)).scalars())
+    engine.dispose()
+
+    rng = random.Random(seed)
+    start = datetime(2030, 1, 1)
+    bodies = []
+    for batch_start in range(0, total, batch_size):
+        lines = []
+        for offset in range(batch_start, min(total, batch_start + batch_size)):
+            message = {
+                "message_id": last_message_id + 1 + offset,
+                "physician_id": rng.choice(physician_ids),
+                "channel": rng.choice(["email", "sms", "portal"]),
+                "direction": rng.choice(["inbound", "outbound"]),
+                "timestamp": (start + timedelta(seconds=offset)).isoformat(),
+                "message_text": "Following up on dosing questions and samples for the clinical trial.",
+                "campaign_id": f"CMP-{rng.randint(10, 99)}",
+                "topic": "dosing",
+                "compliance_tag": "allowed",
+                "sentiment": rng.choice(["positive", "neutral", "negative"]),
+                "delivery_status": "delivered",
+                "response_latency_sec": rng.randint(10, 3600),
+            }
+            lines.append(json.dumps(message))
+        bodies.append(("\n".join(lines) + "\n").encode())
+    return bodies, last_message_id
+
+
+def count_ingested(db_path: str, after_message_id: int) -> tuple[int, int]:
+    """(written, classified under the active version) messages after the id"""
+    from db.models import Message, TextClassification
+    from services.classifications import active_compliance_version
+    from sqlalchemy.orm import Session
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    with Session(engine) as db:
+        written = db.execute(
+            select(func.count()).where(Message.message_id > after_message_id)
+        ).scalar_one()
+        classified = db.execute(
+            select(func.count())
+            .select_from(Message)
+            .join(TextClassification, TextClassification.text_hash == Message.text_hash)
+            .where(
+                Message.message_id > after_message_id,
+                TextClassification.compliance_version == active_compliance_version(db),
+            )
+        ).scalar_one()
+    engine.dispose()
+    return written, classified
+
+
+async def post_batches(
+    base_url: str, bodies: list[bytes], concurrency: int
+) -> tuple[list[float], int, int]:
+    """Posts every body, retrying on a 429, returns (latencies, 429s, errors)"""
+    latencies: list[float] = []
+    rejected = 0
+    errors = 0
+    next_body = 0
+    headers = {"content-type": "application/x-ndjson"}
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+
+        async def worker():
+            nonlocal next_body, rejected, errors
+            while next_body < len(bodies):
+                body = bodies[next_body]
+                next_body += 1
+                while True:
+                    start_time = time.perf_counter()
+                    response = await client.post(
+                        "/messages/ingest", content=body, headers=headers
+                    )
+                    latencies.append(time.perf_counter() - start_time)
+                    if response.status_code != 429:
+                        break
+                    rejected += 1
+                    await asyncio.sleep(float(response.headers["retry-after"]))
+                if response.status_code != 202:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, rejected, errors
+
+
+def run_ingest(
+    db_path: str,
+    profile: str,
+    total: int,
+    batch_size: int,
+    concurrency: int,
+    queue_size: int,
+) -> dict:
+    bodies, last_message_id = ingest_bodies(db_path, total, batch_size)
+    env = {"DB_PROFILE": profile, "INGEST_QUEUE_SIZE": str(queue_size)}
+    with run_server(f"sqlite:///{db_path}", env=env) as server:
+        start_time = time.perf_counter()
+        latencies, rejected, errors = asyncio.run(
+            post_batches(server.base_url, bodies, concurrency)
+        )
+        accepted_seconds = time.perf_counter() - start_time
+
+        written, classified = 0, 0
+        deadline = time.monotonic() + 300
+        while (written < total or classified < total) and time.monotonic() < deadline:
+            time.sleep(0.1)
+            written, classified = count_ingested(db_path, last_message_id)
+        elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        "profile": profile,
+        "batch_size": batch_size,
+        "messages": total,
+        "accepted_per_second": total / accepted_seconds,
+        "messages_per_second": written / elapsed,
+        "classified": classified,
+        "rejected_429": rejected,
+        "errors": errors,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument("--total", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--queue-size", type=int, default=50_000, help="INGEST_QUEUE_SIZE of the api"
+    )
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(data_dir, args.messages)
+
+        results = []
+        for profile in ["default", "production"]:
+            db_path = os.path.join(tmp_dir, f"{profile}.db")
+            prepare_database(db_path, data_dir)
+            results.append(
+                run_ingest(
+                    db_path,
+                    profile,
+                    args.total,
+                    args.batch_size,
+                    args.concurrency,
+                    args.queue_size,
+                )
+            )
+
+    print(f"cpus: {os.cpu_count()}")
+    print_table(
+        results,
+        [
+            "profile",
+            "batch_size",
+            "messages",
+            "accepted_per_second",
+            "messages_per_second",
+            "classified",
+            "rejected_429",
+            "errors",
+            "p50_ms",
+            "p99_ms",
+        ],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
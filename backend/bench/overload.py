@@ -0,0 +1,134 @@
+#####
+# Lookup latency while heavy message scans overload the api, with and without admission
+# control (services/admission.py)
+#    - `python -m bench.overload --scan-clients 60 --lookup-clients 4 --seconds 15`
+#    - scan clients send full text searches over date ranges, lookup clients page
+#      /physicians, a shed (503) client waits for Retry-After like a well behaved one would
+#    - the response cache is off so every request reaches the handlers
+#####
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+import httpx
+
+from bench.common import prepare_database, print_table, run_server, summarize
+from bench.generate import generate
+
+# caps high enough that nothing is ever queued or shed
+UNLIMITED = {
+    "ADMISSION_LOOKUP_LIMIT": "100000",
+    "ADMISSION_SCAN_LIMIT": "100000",
+    "ADMISSION_CLASSIFY_LIMIT": "100000",
+}
+
+
+def scan_path(rng: random.Random) -> str:
+    return (
+        f"/messages?start_date=2024-{rng.randint(1, 9):02d}-01T00:00:00"
+        "&limit=1000&q=dosing OR trial"
+    )
+
+
+def lookup_path(rng: random.Random) -> str:
+    return f"/physicians?state=CA&limit={rng.randint(1, 1000)}"
+
+
+async def overload(
+    base_url: str, scan_clients: int, lookup_clients: int, seconds: float
+) -> dict[str, dict]:
+    latencies: dict[str, list[float]] = {"scan": [], "lookup": []}
+    shed = {"scan": 0, "lookup": 0}
+    errors = {"scan": 0, "lookup": 0}
+    limits = httpx.Limits(max_connections=scan_clients + lookup_clients)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120
+    ) as client:
+        stop_time = time.monotonic() + seconds
+
+        async def worker(kind: str, seed: int):
+            rng = random.Random(seed)
+            path = scan_path if kind == "scan" else lookup_path
+            while time.monotonic() < stop_time:
+                start_time = time.perf_counter()
+                response = await client.get(path(rng))
+                if response.status_code == 503:
+                    shed[kind] += 1
+                    await asyncio.sleep(float(response.headers["retry-after"]))
+                    continue
+                latencies[kind].append(time.perf_counter() - start_time)
+                if response.status_code != 200:
+                    errors[kind] += 1
+
+        await asyncio.gather(
+            *(worker("scan", i) for i in range(scan_clients)),
+            *(worker("lookup", -i - 1) for i in range(lookup_clients)),
+        )
+    return {
+        kind: {**summarize(latencies[kind], seconds, errors[kind]), "shed": shed[kind]}
+        for kind in latencies
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument("--scan-clients", type=int, default=60)
+    parser.add_argument("--lookup-clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(data_dir, args.messages)
+        db_path = os.path.join(tmp_dir, "bench.db")
+        prepare_database(db_path, data_dir)
+
+        results = []
+        for admission, env in (("off", UNLIMITED), ("on", {})):
+            env = {**env, "RESPONSE_CACHE_MB": "0"}
+            with run_server(f"sqlite:///{db_path}", env=env) as server:
+                summaries = asyncio.run(
+                    overload(
+                        server.base_url,
+                        args.scan_clients,
+                        args.lookup_clients,
+                        args.seconds,
+                    )
+                )
+            for kind, summary in summaries.items():
+                results.append({"admission": admission, "requests_of": kind, **summary})
+
+    print(f"cpus: {os.cpu_count()}")
+    print_table(
+        results,
+        [
+            "admission",
+            "requests_of",
+            "requests",
+            "shed",
+            "errors",
+            "throughput_rps",
+            "p50_ms",
+            "p95_ms",
+            "p99_ms",
+        ],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#####
+# Endpoint and load benchmark suite
+#    - `python -m bench.run --messages 100000` generates a data set, loads it into a fresh
+#      sqlite file and measures `load`, `/physicians`, `/messages`, `/stats` and `/classify/{id}`
+#    - `--data-dir` reuses a data set written by `python -m bench.generate`
+#    - results (with the git commit) are saved as json, `python -m bench.compare a.json b.json`
+#      compares two runs
+#####
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+
+from bench.common import (
+    BACKEND_DIR,
+    peak_rss_mb,
+    prepare_database,
+    print_table,
+    run_load,
+    run_server,
+)
+from bench.generate import SPECIALTIES, STATES, generate
+
+RESULTS_DIR = os.path.join(BACKEND_DIR, "bench", "results")
+
+# number of distinct requests per endpoint, cycled through by the load
+REQUEST_VARIANTS = 200
+
+
+def git_commit() -> tuple[str | None, bool]:
+    """(commit, has uncommitted changes) of the working tree, None outside of a git checkout"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(status.strip())
+
+
+def endpoint_requests(db_path: str, seed: int) -> dict[str, list[tuple[str, str]]]:
+    """A fixed (seeded) set of realistic requests per endpoint for the loaded data"""
+    rng = random.Random(seed)
+    with sqlite3.connect(db_path) as conn:
+        physician_ids = [
+            row[0] for row in conn.execute("SELECT physician_id FROM physicians")
+        ]
+        min_message_id, max_message_id = conn.execute(
+            "SELECT min(message_id), max(message_id) FROM messages"
+        ).fetchone()
+        min_timestamp, max_timestamp = conn.execute(
+            "SELECT min(timestamp), max(timestamp) FROM messages"
+        ).fetchone()
+
+    first_day = datetime.fromisoformat(min_timestamp)
+    days = max(1, (datetime.fromisoformat(max_timestamp) - first_day).days)
+
+    physicians = []
+    messages = []
+    stats = []
+    classify = []
+    for _ in range(REQUEST_VARIANTS):
+        physicians.append(
+            rng.choice(
+                [
+                    ("GET", f"/physicians?state={rng.choice(STATES)}"),
+                    ("GET", f"/physicians?specialty={rng.choice(SPECIALTIES)}"),
+                    ("GET", "/physicians?limit=100"),
+                ]
+            )
+        )
+
+        start = first_day + timedelta(days=rng.randrange(days))
+        end = start + timedelta(days=7)
+        messages.append(
+            rng.choice(
+                [
+                    ("GET", f"/messages?physician_id={rng.choice(physician_ids)}"),
+                    (
+                        "GET",
+                        f"/messages?start_date={start:%Y-%m-%dT%H:%M:%S}"
+                        f"&end_date={end:%Y-%m-%dT%H:%M:%S}",
+                    ),
+                ]
+            )
+        )
+
+        stats.append(
+            rng.choice(
+                [
+                    ("GET", "/stats?group_by=channel"),
+                    (
+                        "GET",
+                        f"/stats?group_by=day&physician_id={rng.choice(physician_ids)}",
+                    ),
+                    (
+                        "GET",
+                        f"/stats?group_by=physician_id&start_date={start:%Y-%m-%d}"
+                        f"&end_date={end:%Y-%m-%d}",
+                    ),
+                ]
+            )
+        )
+
+        message_id = rng.randint(min_message_id, max_message_id)
+        classify.append(("POST", f"/classify/{message_id}"))
+
+    return {
+        "/physicians": physicians,
+        "/messages": messages,
+        "/stats": stats,
+        "/classify/{id}": classify,
+    }
+
+
+def run_suite(
+    data_dir: str, db_path: str, concurrency: int, request_count: int, seed: int
+) -> list[dict]:
+    results = []
+
+    load_seconds, load_rss_mb = prepare_database(db_path, data_dir)
+    with sqlite3.connect(db_path) as conn:
+        row_count = sum(
+            conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in ("physicians", "messages")
+        )
+    results.append(
+        {
+            "name": "load",
+            "rows": row_count,
+            "seconds": load_seconds,
+            "throughput_rows_per_second": row_count / load_seconds,
+            "peak_rss_mb": load_rss_mb,
+        }
+    )
+
+    requests = endpoint_requests(db_path, seed)
+    with run_server(f"sqlite:///{db_path}") as server:
+        for name, mix in requests.items():
+            # warm up connections, compiled statements and the keyword matcher
+            run_load(server.base_url, mix, concurrency, concurrency * 2)
+            summary = run_load(server.base_url, mix, concurrency, request_count)
+            # the server peak so far, endpoints run in order so it only grows
+            results.append(
+                {"name": name, **summary, "peak_rss_mb": peak_rss_mb(server.pid)}
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark load and the api endpoints")
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--keywords", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--requests", type=int, default=2000, help="Requests per endpoint"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="Result file, defaults to bench/results/<commit>.json"
+    )
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(
+                data_dir, args.messages, keyword_count=args.keywords, seed=args.seed
+            )
+        results = run_suite(
+            data_dir,
+            os.path.join(tmp_dir, "bench.db"),
+            args.concurrency,
+            args.requests,
+            args.seed,
+        )
+
+    load, *endpoints = results
+    print(
+        f"load: {load['rows']} rows in {load['seconds']:.2f}s "
+        f"({load['throughput_rows_per_second']:,.0f} rows/s), "
+        f"peak rss {load['peak_rss_mb']:.0f} MB"
+    )
+    print_table(
+        endpoints,
+        [
+            "name",
+            "throughput_rps",
+            "p50_ms",
+            "p95_ms",
+            "p99_ms",
+            "errors",
+            "peak_rss_mb",
+        ],
+    )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        file_name = f"{commit or 'unknown'}{'-dirty' if dirty else ''}.json"
+        output = os.path.join(RESULTS_DIR, file_name)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "dirty": dirty,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "params": {
+                    "data_dir": args.data_dir,
+                    "messages": None if args.data_dir else args.messages,
+                    "keywords": None if args.data_dir else args.keywords,
+                    "concurrency": args.concurrency,
+                    "requests": args.requests,
+                    "seed": args.seed,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
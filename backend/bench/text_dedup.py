@@ -0,0 +1,208 @@
+#####
+# Database size and classification time of the content addressed message texts (db/texts.py)
+#    - `python -m bench.text_dedup --messages 200000`
+#    - a generated data set is loaded, then a copy is rebuilt the way it was stored before
+#      message_texts: the text inline in messages and one classification per message
+#    - both layouts classify every message against v1 from scratch and are vacuumed before
+#      their file size is measured
+#####
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bench.common import prepare_database, print_table
+from bench.generate import generate
+
+COMPLIANCE_VERSION = "v1"
+
+
+def inline_copy(db_path: str, inline_path: str):
+    """Copy of the database with the texts back in messages and per message results"""
+    shutil.copy(db_path, inline_path)
+    with sqlite3.connect(inline_path) as conn:
+        conn.executescript(
+            """
+            -- a zero takes no space in the record, like a missing column
+            UPDATE messages SET text_hash = 0, message_text = (
+                SELECT message_text FROM message_texts t
+                WHERE t.text_hash = messages.text_hash
+            );
+            DROP TRIGGER messages_fts_insert;
+            DROP TRIGGER messages_fts_delete;
+            DROP TRIGGER messages_fts_update;
+            DROP TABLE messages_fts;
+            DROP VIEW message_contents;
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                message_text, content='messages', content_rowid='message_id'
+            );
+            INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+            DROP TABLE text_classifications;
+            DROP TABLE keyword_postings;
+            DROP TABLE message_texts;
+            CREATE TABLE message_classifications (
+                message_id INTEGER NOT NULL, compliance_version TEXT NOT NULL,
+                matches TEXT NOT NULL, PRIMARY KEY (message_id, compliance_version)
+            );
+            CREATE TABLE keyword_postings (
+                keyword TEXT NOT NULL, message_id INTEGER NOT NULL,
+                PRIMARY KEY (keyword, message_id)
+            );
+            """
+        )
+
+
+def classify_per_text(db_path: str) -> tuple[float, int]:
+    """(seconds, stored results) of the backfill of this tree"""
+    from services.classifications import backfill_classifications
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    with Session(engine) as db:
+        start_time = time.perf_counter()
+        classified_count = backfill_classifications(db, COMPLIANCE_VERSION)
+        elapsed = time.perf_counter() - start_time
+    engine.dispose()
+    return elapsed, classified_count
+
+
+def classify_per_message(db_path: str) -> tuple[float, int]:
+    """(seconds, stored results) of the backfill as it was, every message matched on its own"""
+    from services.classifications import (
+        CLASSIFY_CHUNK_SIZE,
+        encode_matches,
+        get_index_matcher,
+    )
+    from services.matcher import build_matcher
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    with Session(engine) as db:
+        start_time = time.perf_counter()
+        matcher = build_matcher(db, COMPLIANCE_VERSION)
+        index_matcher = get_index_matcher(db)
+        conn = db.connection().connection.driver_connection
+        classified_count = 0
+        last_message_id = -1
+        while True:
+            rows = conn.execute(
+                "SELECT message_id, message_text FROM messages "
+                "WHERE message_id > ? ORDER BY message_id LIMIT ?",
+                (last_message_id, CLASSIFY_CHUNK_SIZE),
+            ).fetchall()
+            if not rows:
+                break
+            classifications = []
+            postings = []
+            for message_id, message_text in rows:
+                matches = matcher.match(message_text)
+                classifications.append(
+                    (message_id, COMPLIANCE_VERSION, encode_matches(matches))
+                )
+                posting_keywords = index_matcher.matched_keywords(message_text)
+                for keywords in matches.values():
+                    posting_keywords.update(keyword.lower() for keyword in keywords)
+                postings.extend((keyword, message_id) for keyword in posting_keywords)
+            conn.executemany(
+                "INSERT INTO message_classifications VALUES (?, ?, ?)", classifications
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO keyword_postings VALUES (?, ?)", postings
+            )
+            conn.commit()
+            classified_count += len(rows)
+            last_message_id = rows[-1][0]
+        elapsed = time.perf_counter() - start_time
+    engine.dispose()
+    return elapsed, classified_count
+
+
+def vacuumed_size_mb(db_path: str) -> float:
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("VACUUM")
+    return os.path.getsize(db_path) / (1024 * 1024)
+
+
+def table_sizes_mb(db_path: str) -> dict[str, float]:
+    """Size of every table and index (dbstat), empty where sqlite was built without it"""
+    with sqlite3.connect(db_path) as conn:
+        try:
+            rows = conn.execute(
+                "SELECT name, sum(pgsize) FROM dbstat GROUP BY name"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return {}
+    return {name: size / (1024 * 1024) for name, size in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(data_dir, args.messages)
+        db_path = os.path.join(tmp_dir, "text_dedup.db")
+        prepare_database(db_path, data_dir)
+        inline_path = os.path.join(tmp_dir, "inline.db")
+        inline_copy(db_path, inline_path)
+
+        with sqlite3.connect(db_path) as conn:
+            message_count, text_count = conn.execute(
+                "SELECT (SELECT count(*) FROM messages), (SELECT count(*) FROM message_texts)"
+            ).fetchone()
+
+        results = []
+        for layout, path, classify in (
+            ("inline", inline_path, classify_per_message),
+            ("message_texts", db_path, classify_per_text),
+        ):
+            classify_seconds, classified_count = classify(path)
+            size_mb = vacuumed_size_mb(path)
+            sizes = table_sizes_mb(path)
+            results.append(
+                {
+                    "layout": layout,
+                    "messages": message_count,
+                    "distinct_texts": text_count,
+                    "db_mb": size_mb,
+                    "messages_mb": sizes.get("messages"),
+                    "texts_mb": sizes.get("message_texts"),
+                    "classify_s": classify_seconds,
+                    "classified": classified_count,
+                }
+            )
+
+    print(f"cpus: {os.cpu_count()}")
+    print_table(
+        results,
+        [
+            "layout",
+            "messages",
+            "distinct_texts",
+            "db_mb",
+            "messages_mb",
+            "texts_mb",
+            "classify_s",
+            "classified",
+        ],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#####
+# Read throughput by uvicorn worker count while a background process keeps writing
+#    - `python -m bench.worker_scaling --workers 1,2,4 --messages 200000`
+#    - runs the default profile (rollback journal) and DB_PROFILE=production (WAL, read
+#      only pools) on fresh copies of the same database
+#####
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Event
+
+from sqlalchemy import func, insert, select
+
+from bench.common import prepare_database, print_table, run_load, run_server
+from bench.generate import generate
+from bench.run import endpoint_requests
+
+# messages inserted per write transaction by the background writer
+WRITE_BATCH_SIZE = 100
+PROFILES = ["default", "production"]
+
+
+def write_messages(
+    db_path: str, profile: str, rate: int, stop: Event, written: Synchronized
+):
+    """Inserts about `rate` messages a second in small transactions until stopped, like a steady ingest"""
+    # imported in the writer process, the profile is read when the engine is created
+    from db.database import create_db_engine
+    from db.models import Message
+    from db.texts import store_message_texts, text_hash
+    from services.response_cache import bump_data_version
+
+    engine = create_db_engine(f"sqlite:///{db_path}", profile=profile)
+    with engine.connect() as conn:
+        message_id = conn.execute(select(func.max(Message.message_id))).scalar_one()
+        physician_id = conn.execute(select(func.min(Message.physician_id))).scalar_one()
+
+    batch_interval = WRITE_BATCH_SIZE / rate
+    next_batch = time.perf_counter()
+    while not stop.is_set():
+        # a fixed write rate keeps the background load the same for every profile
+        next_batch += batch_interval
+        time.sleep(max(0.0, next_batch - time.perf_counter()))
+        rows = []
+        message_text = "Background write for the worker scaling benchmark."
+        for _ in range(WRITE_BATCH_SIZE):
+            message_id += 1
+            rows.append(
+                {
+                    "message_id": message_id,
+                    "physician_id": physician_id,
+                    "channel": "email",
+                    "is_outbound": True,
+                    "timestamp": datetime.now(),
+                    "message_text": message_text,
+                    "text_hash": text_hash(message_text),
+                    "campaign_id": "CMP-10",
+                    "topic": "scheduling",
+                    "compliance_tag": "allowed",
+                    "sentiment": "neutral",
+                    "delivery_status": "delivered",
+                }
+            )
+        with engine.begin() as conn:
+            conn.execute(insert(Message.__table__), store_message_texts(conn, rows))
+            bump_data_version(conn)
+        with written.get_lock():
+            written.value += len(rows)
+    engine.dispose()
+
+
+def run_profile(
+    base_db_path: str,
+    tmp_dir: str,
+    profile: str,
+    worker_counts: list[int],
+    concurrency: int,
+    request_count: int,
+    write_rate: int,
+) -> list[dict]:
+    results = []
+    for workers in worker_counts:
+        # every run starts from the same (rollback journal) file
+        db_path = os.path.join(tmp_dir, f"{profile}-{workers}.db")
+        shutil.copy(base_db_path, db_path)
+        requests = endpoint_requests(db_path, seed=0)
+        mix = requests["/physicians"] + requests["/messages"]
+
+        env = {"DB_PROFILE": profile}
+        with run_server(f"sqlite:///{db_path}", workers=workers, env=env) as server:
+            run_load(server.base_url, mix, concurrency, concurrency * 2)
+
+            context = multiprocessing.get_context("spawn")
+            stop = context.Event()
+            written = context.Value("i", 0)
+            writer = context.Process(
+                target=write_messages,
+                args=(db_path, profile, write_rate, stop, written),
+            )
+            writer.start()
+            start_time = time.perf_counter()
+            try:
+                summary = run_load(server.base_url, mix, concurrency, request_count)
+            finally:
+                stop.set()
+                writer.join()
+            elapsed = time.perf_counter() - start_time
+
+        results.append(
+            {
+                "profile": profile,
+                "workers": workers,
+                **summary,
+                "writes_per_second": written.value / elapsed,
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers", default="1,2,4", help="Comma separated worker counts"
+    )
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument(
+        "--data-dir", help="Data set from bench.generate, generated if not set"
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--write-rate", type=int, default=2000, help="Messages written per second"
+    )
+    parser.add_argument("--output", help="Write the results as json to this file")
+    args = parser.parse_args()
+    worker_counts = [int(workers) for workers in args.workers.split(",")]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp_dir, "data")
+            generate(data_dir, args.messages)
+        base_db_path = os.path.join(tmp_dir, "base.db")
+        prepare_database(base_db_path, data_dir)
+
+        results = []
+        for profile in PROFILES:
+            results.extend(
+                run_profile(
+                    base_db_path,
+                    tmp_dir,
+                    profile,
+                    worker_counts,
+                    args.concurrency,
+                    args.requests,
+                    args.write_rate,
+                )
+            )
+
+    print(f"cpus: {os.cpu_count()}")
+    print_table(
+        results,
+        [
+            "profile",
+            "workers",
+            "throughput_rps",
+            "p50_ms",
+            "p99_ms",
+            "errors",
+            "writes_per_second",
+        ],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
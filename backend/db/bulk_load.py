@@ -0,0 +1,102 @@
+#####
+# Bulk loading of large csv exports
+#    - csv files are streamed in fixed size chunks so memory is bounded by the chunk size
+#    - each chunk is inserted with a single core executemany in its own transaction
+#    - secondary indexes are dropped during the load and rebuilt once at the end
+#####
+
+import csv
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterator
+
+from sqlalchemy import Connection, Engine, Table, insert
+
+DEFAULT_CHUNK_SIZE = 10_000
+
+ParseChunk = Callable[[list[dict]], list[dict]]
+# runs in the transaction of a chunk before its insert, returns the rows to insert
+BeforeInsert = Callable[[Connection, list[dict]], list[dict]]
+
+
+def iter_csv_chunks(path: str, chunk_size: int) -> Iterator[list[dict]]:
+    with open(path, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_parsed_chunks(
+    chunks: Iterator[list[dict]], parse: ParseChunk, workers: int
+) -> Iterator[list[dict]]:
+    """Parses chunks in order, in a process pool when there is more than one worker"""
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse(chunk)
+        return
+
+    # spawn, forking a process that already runs threads (e.g. the api) can deadlock
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        # only a couple of chunks per worker are in flight, so a large file is never
+        # read ahead of the inserts (executor.map would submit every chunk up front)
+        pending: deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def drop_indexes(engine: Engine, table: Table):
+    with engine.begin() as conn:
+        for index in table.indexes:
+            index.drop(conn, checkfirst=True)
+
+
+def create_indexes(engine: Engine, table: Table):
+    with engine.begin() as conn:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def bulk_load_csv(
+    engine: Engine,
+    table: Table,
+    path: str,
+    parse: ParseChunk,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = 0,
+    before_insert: BeforeInsert | None = None,
+) -> int:
+    """Streams the csv into the table, returns the number of loaded rows"""
+    start_time = time.perf_counter()
+    row_count = 0
+
+    # maintaining the indexes row by row is much slower than building them once
+    drop_indexes(engine, table)
+    try:
+        chunks = iter_csv_chunks(path, chunk_size)
+        for rows in iter_parsed_chunks(chunks, parse, workers):
+            with engine.begin() as conn:
+                if before_insert is not None:
+                    rows = before_insert(conn, rows)
+                conn.execute(insert(table), rows)
+            row_count += len(rows)
+    finally:
+        create_indexes(engine, table)
+
+    elapsed = time.perf_counter() - start_time
+    rows_per_second = row_count / elapsed if elapsed > 0 else float("inf")
+    print(
+        f"Loaded {row_count} rows into {table.name} in {elapsed:.2f}s "
+        f"({rows_per_second:,.0f} rows/s)"
+    )
+    return row_count
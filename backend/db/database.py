@@ -3,7 +3,13 @@
 #####
 
 
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import Engine, create_engine, event, inspect
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.pool import StaticPool
@@ -12,19 +18,136 @@ import os
 
 DB_URL = os.environ.get("DB_URL", "sqlite:///impiricus.db")
 
-# for tests to work in memory sqlite datbase needs to be able to run on different threads
-if DB_URL == "sqlite:///:memory:":
-    engine = create_engine(
-        "sqlite:///:memory:",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
+# an async driver in the url (e.g. "sqlite+aiosqlite:///impiricus.db") switches the api
+# to async handlers and sessions, db/manage.py always uses the sync driver of the same database
+_url = make_url(DB_URL)
+IS_ASYNC = _url.get_dialect().is_async
+SYNC_DB_URL = (
+    _url.set(drivername=_url.get_backend_name()).render_as_string(hide_password=False)
+    if IS_ASYNC
+    else DB_URL
+)
+
+# "production" tunes sqlite for several api workers sharing one database file
+#    - WAL lets readers run next to a writer instead of blocking behind it
+#    - read only endpoints get their own pool of `mode=ro` connections
+DB_PROFILE = os.environ.get("DB_PROFILE", "default")
+
+SQLITE_PRODUCTION_PRAGMAS = {
+    # other workers hold the write lock for short transactions, wait instead of failing
+    # (first, switching to WAL needs the lock too)
+    "busy_timeout": "5000",
+    # with WAL a commit is still atomic and durable up to the last checkpoint
+    "synchronous": "NORMAL",
+    "mmap_size": str(256 * 1024 * 1024),
+    # negative sizes are in KiB
+    "cache_size": str(-64 * 1024),
+    "temp_store": "MEMORY",
+}
+
+
+# connections per engine (the production profile has a read and a write engine), the
+# overflow is opened under load and closed again, a request waits DB_POOL_TIMEOUT seconds
+# for a connection before it fails, keep it above the admission limits of services/admission.py
+POOL_OPTIONS = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+    "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+}
+
+
+def is_memory_url(url: URL) -> bool:
+    return url.database in (None, "", ":memory:")
+
+
+def read_only_url(url: URL) -> URL:
+    return url.set(
+        database=f"file:{url.database}",
+        query={**url.query, "mode": "ro", "uri": "true"},
     )
-else:
-    engine = create_engine(DB_URL)
 
 
+def apply_production_pragmas(engine: Engine, read_only: bool):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRODUCTION_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        else:
+            # stored in the database file, read only connections pick it up from there
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
+
+def create_db_engine(
+    url: str, profile: str = DB_PROFILE, read_only: bool = False
+) -> Engine:
+    sqlalchemy_url = make_url(url)
+    # for tests to work in memory sqlite datbase needs to be able to run on different threads
+    if is_memory_url(sqlalchemy_url):
+        return create_engine(
+            url, connect_args={"check_same_thread": False}, poolclass=StaticPool
+        )
+
+    if profile != "production":
+        return create_engine(url, **POOL_OPTIONS)
+    if read_only:
+        sqlalchemy_url = read_only_url(sqlalchemy_url)
+    engine = create_engine(sqlalchemy_url, **POOL_OPTIONS)
+    apply_production_pragmas(engine, read_only)
+    return engine
+
+
+def create_async_db_engine(
+    url: str, profile: str = DB_PROFILE, read_only: bool = False
+) -> AsyncEngine:
+    sqlalchemy_url = make_url(url)
+    if is_memory_url(sqlalchemy_url):
+        return create_async_engine(url)
+    if profile != "production":
+        return create_async_engine(url, **POOL_OPTIONS)
+    if read_only:
+        sqlalchemy_url = read_only_url(sqlalchemy_url)
+    engine = create_async_engine(sqlalchemy_url, **POOL_OPTIONS)
+    apply_production_pragmas(engine.sync_engine, read_only)
+    return engine
+
+
+engine = create_db_engine(SYNC_DB_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the default profile (and an in memory database) reads through the same engine
+use_read_engine = DB_PROFILE == "production" and not is_memory_url(_url)
+read_engine = (
+    create_db_engine(SYNC_DB_URL, read_only=True) if use_read_engine else engine
+)
+if use_read_engine:
+    # read only connections cannot switch the file to WAL, a write connection does it once
+    with engine.connect():
+        pass
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# only created in async mode, an in memory database cannot be shared with the sync engine
+async_engine = create_async_db_engine(DB_URL) if IS_ASYNC else None
+async_read_engine = (
+    create_async_db_engine(DB_URL, read_only=True)
+    if IS_ASYNC and use_read_engine
+    else async_engine
+)
+AsyncSessionLocal = (
+    async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    if async_engine is not None
+    else None
+)
+AsyncReadSessionLocal = (
+    async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
+    if async_read_engine is not None
+    else None
+)
+
 Base = declarative_base()
 
 
@@ -36,6 +159,27 @@ def get_db():
         db.close()
 
 
+def get_read_db():
+    """Session for endpoints that never write, read only connections in the production profile"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    assert AsyncSessionLocal is not None, "DB_URL does not use an async driver"
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db():
+    assert AsyncReadSessionLocal is not None, "DB_URL does not use an async driver"
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
 def create_tables():
     Base.metadata.create_all(bind=engine)
 
@@ -0,0 +1,256 @@
+#####
+# Incremental loading of growing csv exports (db.manage load --incremental)
+#    - a checkpoint per file keeps the byte offset of the rows loaded so far and a hash of
+#      that prefix, a rerun reads on from the offset when the prefix is unchanged
+#    - a file whose prefix changed (a rewritten or edited export) is read again from the
+#      start, the writes make that idempotent: physicians are upserted where a column
+#      changed, messages already stored (in messages or their partition) are skipped
+#    - every chunk is written together with its checkpoint in one short transaction with
+#      the full text and rollup triggers in place, so the api keeps serving reads during
+#      the load and an interrupted load resumes after the last committed chunk
+#    - only complete records are read, a row the exporter is still appending (a partial
+#      last line, or a quoted field whose embedded newlines are not all written yet) is left
+#      for the next run
+#####
+
+import csv
+import hashlib
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+from typing import BinaryIO, Callable, Iterator
+
+from sqlalchemy import Connection, Engine, or_, select
+from sqlalchemy.dialects.sqlite import insert
+
+from db.bulk_load import DEFAULT_CHUNK_SIZE, ParseChunk, iter_parsed_chunks
+from db.models import LoadCheckpoint, Message, Physician
+from db.partitions import archived_message_ids
+from db.texts import store_message_texts
+from services.response_cache import bump_data_version
+
+# bytes hashed at a time when checking the prefix of a checkpoint
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# writes a parsed chunk in the transaction of its checkpoint, returns the rows changed
+WriteChunk = Callable[[Connection, list[dict]], int]
+
+
+@dataclass(slots=True)
+class FilePosition:
+    byte_offset: int
+    prefix_hash: str
+    row_count: int
+
+
+##
+# Reading a csv file on from its checkpoint
+##
+
+
+class CsvCursor:
+    """Complete records of a csv file from a position, keeping the offset and prefix hash"""
+
+    def __init__(self, f: BinaryIO, checkpoint: LoadCheckpoint | None):
+        self.f = f
+        self.hasher = hashlib.blake2b()
+        header = f.readline()
+        self.header = next(csv.reader([header.decode()]))
+        self.byte_offset = len(header)
+        self.row_count = 0
+        # lines of the record being read, counted in the offset once the record is complete
+        self._pending: list[bytes] = []
+        self._lines_exhausted = False
+        self.hasher.update(header)
+        self.resumed = checkpoint is not None and self.resume(checkpoint)
+        if self.resumed:
+            self.byte_offset = checkpoint.byte_offset
+            self.row_count = checkpoint.row_count
+        else:
+            self.hasher = hashlib.blake2b(header)
+            self.f.seek(self.byte_offset)
+
+    def resume(self, checkpoint: LoadCheckpoint) -> bool:
+        """Hashes the rest of the checkpointed prefix, True if the file still starts with it"""
+        remaining = checkpoint.byte_offset - self.byte_offset
+        if remaining < 0:
+            return False
+        while remaining > 0:
+            block = self.f.read(min(remaining, HASH_BLOCK_SIZE))
+            if not block:
+                # truncated below the checkpoint
+                return False
+            self.hasher.update(block)
+            remaining -= len(block)
+        return self.hasher.hexdigest() == checkpoint.prefix_hash
+
+    def lines(self) -> Iterator[str]:
+        for line in self.f:
+            if not line.endswith(b"\n"):
+                break
+            self._pending.append(line)
+            yield line.decode()
+        self._lines_exhausted = True
+
+    def records(self) -> Iterator[list[str]]:
+        """Parsed records, the offset and hash are at the end of the last one returned"""
+        # the csv reader never reads ahead, a complete record is returned without asking
+        # for another line. One returned after the lines ran out ended inside a quoted
+        # field, the reader (not strict) hands back what it has and it is dropped here
+        for record in csv.reader(self.lines()):
+            if self._lines_exhausted:
+                return
+            for line in self._pending:
+                self.hasher.update(line)
+                self.byte_offset += len(line)
+            self._pending.clear()
+            yield record
+
+    def position(self) -> FilePosition:
+        return FilePosition(self.byte_offset, self.hasher.hexdigest(), self.row_count)
+
+
+def record_row(header: list[str], record: list[str]) -> dict:
+    # the rows of csv.DictReader, extra values under None and missing ones as None
+    row: dict = dict(zip(header, record))
+    if len(record) > len(header):
+        row[None] = record[len(header) :]
+    for name in header[len(record) :]:
+        row[name] = None
+    return row
+
+
+def iter_chunks_from(
+    cursor: CsvCursor, chunk_size: int
+) -> Iterator[tuple[list[dict], FilePosition]]:
+    # blank lines are skipped like csv.DictReader does
+    reader = (
+        record_row(cursor.header, record) for record in cursor.records() if record
+    )
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        cursor.row_count += len(chunk)
+        yield chunk, cursor.position()
+
+
+def get_checkpoint(conn: Connection, path: str) -> LoadCheckpoint | None:
+    row = conn.execute(
+        select(LoadCheckpoint.__table__).where(LoadCheckpoint.path == path)
+    ).one_or_none()
+    return LoadCheckpoint(**row._mapping) if row is not None else None
+
+
+def save_checkpoint(conn: Connection, path: str, position: FilePosition):
+    values = dict(
+        byte_offset=position.byte_offset,
+        prefix_hash=position.prefix_hash,
+        row_count=position.row_count,
+        updated_at=datetime.now(),
+    )
+    conn.execute(
+        insert(LoadCheckpoint.__table__)
+        .values(path=path, **values)
+        .on_conflict_do_update(index_elements=["path"], set_=values)
+    )
+
+
+def checkpoint_file(engine: Engine, path: str):
+    """Checkpoints the complete records of a file loaded in full (load, load --bulk)"""
+    path = os.path.abspath(path)
+    with open(path, "rb") as f:
+        cursor = CsvCursor(f, None)
+        for _ in cursor.records():
+            cursor.row_count += 1
+    with engine.begin() as conn:
+        save_checkpoint(conn, path, cursor.position())
+
+
+def load_csv_incremental(
+    engine: Engine,
+    path: str,
+    parse: ParseChunk,
+    write: WriteChunk,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = 0,
+) -> tuple[int, int]:
+    """Loads the rows of the csv after its checkpoint, returns (rows read, rows changed)"""
+    start_time = time.perf_counter()
+    path = os.path.abspath(path)
+    with engine.connect() as conn:
+        checkpoint = get_checkpoint(conn, path)
+
+    read_count = 0
+    changed_count = 0
+    with open(path, "rb") as f:
+        cursor = CsvCursor(f, checkpoint)
+        if checkpoint is not None and not cursor.resumed:
+            print(f"{path} changed before its checkpoint, reading it from the start")
+
+        # the parsed chunks come back in order, their positions are queued alongside
+        positions: deque[FilePosition] = deque()
+
+        def raw_chunks() -> Iterator[list[dict]]:
+            for chunk, position in iter_chunks_from(cursor, chunk_size):
+                positions.append(position)
+                yield chunk
+
+        for rows in iter_parsed_chunks(raw_chunks(), parse, workers):
+            position = positions.popleft()
+            with engine.begin() as conn:
+                chunk_changed = write(conn, rows)
+                save_checkpoint(conn, path, position)
+                if chunk_changed:
+                    # cached /physicians and /messages responses are stale
+                    bump_data_version(conn)
+            read_count += len(rows)
+            changed_count += chunk_changed
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Read {read_count} rows of {os.path.basename(path)} in {elapsed:.2f}s, "
+        f"{changed_count} inserted or updated"
+    )
+    return read_count, changed_count
+
+
+##
+# Idempotent writes
+##
+
+
+def upsert_physicians(conn: Connection, rows: list[dict]) -> int:
+    """Inserts new physicians and updates the ones with a changed column"""
+    if not rows:
+        return 0
+    table = Physician.__table__
+    stmt = insert(table)
+    columns = [name for name in rows[0] if name != "physician_id"]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["physician_id"],
+        set_={name: stmt.excluded[name] for name in columns},
+        # unchanged rows are not written, they would only wake the triggers and the wal
+        where=or_(
+            *(table.c[name].is_distinct_from(stmt.excluded[name]) for name in columns)
+        ),
+    )
+    return conn.execute(stmt, rows).rowcount
+
+
+def insert_new_messages(conn: Connection, rows: list[dict]) -> int:
+    """Inserts the messages not stored yet, a message never changes once it is loaded"""
+    # an id in messages is skipped by the conflict, one in a partition has to be looked up
+    archived_ids = archived_message_ids(
+        conn, [(row["message_id"], row["timestamp"]) for row in rows]
+    )
+    rows = [row for row in rows if row["message_id"] not in archived_ids]
+    if not rows:
+        return 0
+    message_rows = store_message_texts(conn, rows)
+    return conn.execute(
+        insert(Message.__table__).on_conflict_do_nothing(), message_rows
+    ).rowcount
@@ -2,22 +2,62 @@
 # Manage db
 #    - migrations
 #    - move sample data to database
+#    - monthly partitions of the messages
 #####
 import argparse
 import csv
+import glob
 import json
+import os
 from pydantic import BaseModel, field_validator
 from typing import List, Optional
 from datetime import date, datetime
 
-from db.database import SessionLocal, create_tables
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from db.database import SessionLocal, engine
+from db.bulk_load import DEFAULT_CHUNK_SIZE, bulk_load_csv
+from db.incremental_load import (
+    checkpoint_file,
+    insert_new_messages,
+    load_csv_incremental,
+    upsert_physicians,
+)
+from db.texts import store_message_texts, text_hash
+from db.partitions import (
+    PartitionError,
+    archive_month,
+    archived_months,
+    attach_month,
+    detach_month,
+    hot_months,
+    restore_month,
+    set_read_only,
+)
+from db.rollups import add_to_rollups, create_rollup_triggers, drop_rollup_triggers
+from db.migrations import (
+    create_full_text_triggers,
+    drop_full_text_triggers,
+    migrate,
+    rebuild_full_text_index,
+)
 from db.models import (
     Physician as PhysicianDB,
     Message as MessageDB,
     ComplianceVersion as ComplianceVersionDB,
     Rule as RuleDB,
     AnyKeyword as AnyKeywordDB,
+    TextClassification as TextClassificationDB,
+)
+from services.matcher import bump_rules_revision, invalidate_matchers
+from services.classifications import (
+    backfill_classifications,
+    latest_classified_version,
+    reclassify_incremental,
 )
+from services.response_cache import bump_data_version
 
 ##
 # Declare the shape of the input datat to parse it declaratively with pydantic
@@ -58,6 +98,23 @@ class Message(BaseModel):
             return None
         return v
 
+    def to_db(self) -> dict:
+        return dict(
+            message_id=self.message_id,
+            physician_id=self.physician_id,
+            channel=self.channel,
+            is_outbound=self.direction == "outbound",
+            timestamp=self.timestamp,
+            message_text=self.message_text,
+            text_hash=text_hash(self.message_text),
+            topic=self.topic,
+            campaign_id=self.campaign_id,
+            compliance_tag=self.compliance_tag,
+            sentiment=self.sentiment,
+            delivery_status=self.delivery_status,
+            response_latency_sec=self.response_latency_sec,
+        )
+
 
 class Physician(BaseModel):
     physician_id: int
@@ -75,93 +132,418 @@ class Physician(BaseModel):
 ##
 
 
-def load_data():
+# top level so they can be sent to the bulk loader's process pool
+def parse_physician_rows(rows: list[dict]) -> list[dict]:
+    return [Physician(**row).model_dump() for row in rows]
+
+
+def parse_message_rows(rows: list[dict]) -> list[dict]:
+    return [Message(**row).to_db() for row in rows]
+
+
+def policy_paths(data_dir: str) -> list[str]:
+    """compliance_policies.json and any other version next to it (compliance_policies_v2.json)"""
+    return sorted(glob.glob(os.path.join(data_dir, "compliance_policies*.json")))
+
+
+def load_data(
+    data_dir: str = "sample_data",
+    bulk: bool = False,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = 0,
+    incremental: bool = False,
+):
+    physicians_path = os.path.join(data_dir, "physicians.csv")
+    messages_path = os.path.join(data_dir, "messages.csv")
+
+    if incremental:
+        # only the rows after the checkpoint of each file, see db/incremental_load.py
+        load_csv_incremental(
+            engine,
+            physicians_path,
+            parse_physician_rows,
+            upsert_physicians,
+            chunk_size,
+            workers,
+        )
+        load_csv_incremental(
+            engine,
+            messages_path,
+            parse_message_rows,
+            insert_new_messages,
+            chunk_size,
+            workers,
+        )
+    elif bulk:
+        # streamed in chunks with executemany for exports too large for the orm
+        bulk_load_csv(
+            engine,
+            PhysicianDB.__table__,
+            physicians_path,
+            parse_physician_rows,
+            chunk_size,
+            workers,
+        )
+        # maintaining the full text index and the rollups row by row through their
+        # triggers doubles the load time, both are brought up to date once instead
+        with engine.begin() as conn:
+            drop_full_text_triggers(conn)
+            drop_rollup_triggers(conn)
+            last_message_id = conn.execute(
+                select(func.coalesce(func.max(MessageDB.message_id), 0))
+            ).scalar_one()
+        message_count = 0
+        try:
+            message_count = bulk_load_csv(
+                engine,
+                MessageDB.__table__,
+                messages_path,
+                parse_message_rows,
+                chunk_size,
+                workers,
+                # the texts of a chunk are stored (once) before its messages
+                before_insert=store_message_texts,
+            )
+        finally:
+            with engine.begin() as conn:
+                create_full_text_triggers(conn)
+                rebuild_full_text_index(conn)
+                create_rollup_triggers(conn)
+                add_to_rollups(conn, last_message_id, message_count)
+
     db = SessionLocal()
     try:
-        # Load physicians
-        with open("sample_data/physicians.csv", "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                row: dict
-                physician = Physician(**row)
-                db_physician = PhysicianDB(**physician.model_dump())
-                db.add(db_physician)
-        db.commit()
+        if not bulk and not incremental:
+            # Load physicians
+            with open(physicians_path, "r") as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    row: dict
+                    physician = Physician(**row)
+                    db_physician = PhysicianDB(**physician.model_dump())
+                    db.add(db_physician)
+            db.commit()
 
-        # Load messages
-        with open("sample_data/messages.csv", "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                row: dict
-                message = Message(**row)
-                db_message = MessageDB(
-                    message_id=message.message_id,
-                    physician_id=message.physician_id,
-                    channel=message.channel,
-                    is_outbound=message.direction == "outbound",
-                    timestamp=message.timestamp,
-                    message_text=message.message_text,
-                    topic=message.topic,
-                    campaign_id=message.campaign_id,
-                    compliance_tag=message.compliance_tag,
-                    sentiment=message.sentiment,
-                    delivery_status=message.delivery_status,
-                    response_latency_sec=message.response_latency_sec,
-                )
-                db.add(db_message)
+            # Load messages, their texts are stored once in message_texts
+            with open(messages_path, "r") as f:
+                reader = csv.DictReader(f)
+                rows = [Message(**row).to_db() for row in reader]
+            for row in store_message_texts(db, rows):
+                db.add(MessageDB(**row))
+            db.commit()
+
+        if not incremental:
+            # a later load --incremental reads on from the end of the loaded files
+            checkpoint_file(engine, physicians_path)
+            checkpoint_file(engine, messages_path)
+
+        # loaded messages of archived months belong in their partitions
+        route_to_partitions()
+
+        # cached /physicians and /messages responses of every api worker are now stale
+        bump_data_version(db)
         db.commit()
 
-        # Load compliance policies
-        with open("sample_data/compliance_policies.json", "r") as f:
-            data = json.load(f)
-            compliance = Compliance(**data)
-            db_compliance_version = ComplianceVersionDB(
-                version=compliance.version, first_name=compliance.updated.isoformat()
+        # Load compliance policies, a version that is already loaded is upserted
+        for policy_path in policy_paths(data_dir):
+            load_compliance_policy(db, policy_path)
+
+    finally:
+        db.close()
+    print("Data loaded successfully")
+
+
+def load_compliance_policy(db: Session, path: str) -> str:
+    """Loads a compliance policy json file as its compliance version, returns the version
+
+    loading the same policy again changes nothing, a changed policy replaces the rules and
+    keywords of its version and the classifications stored for it are dropped
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    compliance = Compliance(**data)
+    version = compliance.version
+
+    version_values = dict(first_name=compliance.updated.isoformat())
+    db.execute(
+        insert(ComplianceVersionDB.__table__)
+        .values(version=version, **version_values)
+        .on_conflict_do_update(index_elements=["version"], set_=version_values)
+    )
+
+    rule_rows = []
+    keywords = set()
+    for rule in compliance.rules:
+        # rules are assumption to have a single result type e.i. action, requires_append etc
+        # result type stores this value along with the text
+
+        # a rule must have either it is likely more cases would need to be added, but then the parsing will also change
+        assert rule.action or rule.requires_append
+        result_type = "action" if rule.action else "requires_append"
+        result_text = rule.action if rule.action else rule.requires_append
+
+        rule_rows.append(
+            dict(
+                id=rule.id,
+                compliance_version=version,
+                name=rule.name,
+                result_type=result_type,
+                result_text=result_text,
             )
-            db.add(db_compliance_version)
-            db.commit()
+        )
+        keywords.update((rule.id, keyword) for keyword in rule.keywords_any)
 
-            for rule in compliance.rules:
-                # rules are assumption to have a single result type e.i. action, requires_append etc
-                # result type stores this value along with the text
-
-                # a rule must have either it is likely more cases would need to be added, but then the parsing will also change
-                assert rule.action or rule.requires_append
-                result_type = "action" if rule.action else "requires_append"
-                result_text = rule.action if rule.action else rule.requires_append
-
-                db_rule = RuleDB(
-                    id=rule.id,
-                    compliance_version=compliance.version,
-                    name=rule.name,
-                    result_type=result_type,
-                    result_text=result_text,
-                )
-                db.add(db_rule)
-                db.commit()
-
-                for keyword in rule.keywords_any:
-                    db_keyword = AnyKeywordDB(rule_id=rule.id, keyword=keyword)
-                    db.add(db_keyword)
-                db.commit()
+    # rule ids are only unique within a version, other versions are never touched
+    rules = RuleDB.__table__
+    rule_stmt = insert(rules)
+    rule_columns = ["name", "result_type", "result_text"]
+    rule_stmt = rule_stmt.on_conflict_do_update(
+        index_elements=["id", "compliance_version"],
+        set_={name: rule_stmt.excluded[name] for name in rule_columns},
+        where=or_(
+            *(
+                rules.c[name].is_distinct_from(rule_stmt.excluded[name])
+                for name in rule_columns
+            )
+        ),
+    )
+    changed_count = db.execute(rule_stmt, rule_rows).rowcount
+
+    keyword_table = AnyKeywordDB.__table__
+    stored_keywords = {
+        (rule_id, keyword)
+        for rule_id, keyword in db.execute(
+            select(keyword_table.c.rule_id, keyword_table.c.keyword).where(
+                keyword_table.c.compliance_version == version
+            )
+        )
+    }
+    added_keywords = keywords - stored_keywords
+    if added_keywords:
+        changed_count += db.execute(
+            insert(keyword_table).on_conflict_do_nothing(),
+            [
+                dict(rule_id=rule_id, compliance_version=version, keyword=keyword)
+                for rule_id, keyword in added_keywords
+            ],
+        ).rowcount
+    for rule_id, keyword in stored_keywords - keywords:
+        db.execute(
+            delete(keyword_table).where(
+                keyword_table.c.compliance_version == version,
+                keyword_table.c.rule_id == rule_id,
+                keyword_table.c.keyword == keyword,
+            )
+        )
+        changed_count += 1
+    rule_ids = {row["id"] for row in rule_rows}
+    changed_count += db.execute(
+        delete(rules).where(
+            rules.c.compliance_version == version, rules.c.id.not_in(rule_ids)
+        )
+    ).rowcount
+
+    if changed_count:
+        # compiled matchers of every process (api workers included) are now out of date
+        bump_rules_revision(db, version)
+        # results of the previous rules, recomputed by classify or on the next request
+        dropped_count = db.execute(
+            delete(TextClassificationDB.__table__).where(
+                TextClassificationDB.compliance_version == version
+            )
+        ).rowcount
+        if dropped_count:
+            print(
+                f"Rules of {version} changed, dropped {dropped_count} stored classifications"
+            )
+
+    # the version, its rules and keywords are loaded all or nothing
+    db.commit()
 
+    # the matchers of this process are dropped right away, not only on the next lookup
+    invalidate_matchers()
+    return version
+
+
+def load_policy(path: str, base_version: Optional[str] = None):
+    """Loads a new compliance version and classifies messages incrementally from a previous version"""
+    db = SessionLocal()
+    try:
+        compliance_version = load_compliance_policy(db, path)
+        if base_version is None:
+            base_version = latest_classified_version(db, exclude=compliance_version)
+
+        if base_version is None:
+            # nothing to start from, every message has to be matched
+            classified_count = backfill_classifications(db, compliance_version)
+            print(f"Classified {classified_count} messages for {compliance_version}")
+        else:
+            copied_count, classified_count = reclassify_incremental(
+                db, compliance_version, base_version
+            )
+            print(
+                f"Classified {compliance_version} from {base_version}: "
+                f"{copied_count} unchanged, {classified_count} reclassified"
+            )
     finally:
         db.close()
-    print("Data loaded successfully")
+    print("Compliance policy loaded successfully")
+
+
+def classify(compliance_version: str):
+    """Backfills stored classifications for every message not yet classified"""
+    db = SessionLocal()
+    try:
+        classified_count = backfill_classifications(db, compliance_version)
+    finally:
+        db.close()
+    print(f"Classified {classified_count} messages for {compliance_version}")
+
+
+##
+# Monthly partitions, see db/partitions.py
+##
+
+
+def route_to_partitions():
+    """Moves hot messages of months that already have a partition into it"""
+    archived = archived_months(engine)
+    if not archived:
+        return
+    for month in hot_months(engine):
+        if month not in archived:
+            continue
+        if archived[month]:
+            print(f"Partition {month} is read only, its new messages stay in messages")
+            continue
+        moved_count = archive_month(engine, month)
+        print(f"Moved {moved_count} messages to partition {month}")
+
+
+def partition(before_month: str):
+    """Moves every month older than before_month out of the hot messages table"""
+    for month in hot_months(engine, before_month):
+        moved_count = archive_month(engine, month)
+        print(f"Moved {moved_count} messages to partition {month}")
+
+
+def manage_partition(action: str, month: str, path: str | None, writable: bool):
+    if action == "detach-partition":
+        path = detach_month(engine, month)
+        print(f"Detached partition {month}, {path} is kept")
+    elif action == "attach-partition":
+        assert path is not None
+        attach_month(engine, month, path)
+        print(f"Attached partition {month}")
+    elif action == "read-only-partition":
+        set_read_only(engine, month, not writable)
+        print(f"Partition {month} is {'writable' if writable else 'read only'}")
+    elif action == "restore-partition":
+        moved_count = restore_month(engine, month)
+        print(f"Moved {moved_count} messages back from partition {month}")
 
 
-# more sophiscated migration scripts or tooling would need to be used for reflect changes, deletetions, etc to the schema
+# migrations are versioned in db/migrations.py, each one is applied once
 def run_migrations():
-    create_tables()
+    applied_names = migrate(engine)
+    for name in applied_names:
+        print(f"Applied migration {name}")
     print("Migrations ran successfully")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage the database.")
-    parser.add_argument("action", choices=["load", "migrate"], help="Action to perform")
+    parser.add_argument(
+        "action",
+        choices=[
+            "load",
+            "migrate",
+            "classify",
+            "load-policy",
+            "partition",
+            "detach-partition",
+            "attach-partition",
+            "read-only-partition",
+            "restore-partition",
+        ],
+        help="Action to perform",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="sample_data",
+        help="Directory with physicians.csv, messages.csv and compliance_policies.json (load)",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Stream the csv files in chunks with executemany inserts (load)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Rows per chunk and transaction (load --bulk)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Processes used to parse chunks, 0 or 1 parses in this process (load --bulk)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only load the rows added since the last load, upserting changed physicians (load)",
+    )
+    parser.add_argument(
+        "--compliance-version",
+        default="v1",
+        help="Compliance version to backfill classifications for (classify)",
+    )
+    parser.add_argument(
+        "--policy-file", help="Compliance policy json to load as a new version (load-policy)"
+    )
+    parser.add_argument(
+        "--base-version",
+        help="Version to reclassify incrementally from, defaults to the latest classified version (load-policy)",
+    )
+    parser.add_argument(
+        "--before",
+        help="Move every month older than this YYYY-MM month to its partition (partition)",
+    )
+    parser.add_argument("--month", help="YYYY-MM month of the partition (*-partition)")
+    parser.add_argument("--path", help="Partition file to attach (attach-partition)")
+    parser.add_argument(
+        "--writable",
+        action="store_true",
+        help="Make the partition writable again (read-only-partition)",
+    )
     args = parser.parse_args()
 
     if args.action == "load":
-        load_data()
+        if args.bulk and args.incremental:
+            parser.error("load takes either --bulk or --incremental")
+        load_data(
+            args.data_dir, args.bulk, args.chunk_size, args.workers, args.incremental
+        )
     elif args.action == "migrate":
         run_migrations()
+    elif args.action == "classify":
+        classify(args.compliance_version)
+    elif args.action == "load-policy":
+        if args.policy_file is None:
+            parser.error("load-policy requires --policy-file")
+        load_policy(args.policy_file, args.base_version)
+    elif args.action == "partition":
+        if args.before is None:
+            parser.error("partition requires --before")
+        partition(args.before)
+    else:
+        if args.month is None:
+            parser.error(f"{args.action} requires --month")
+        if args.action == "attach-partition" and args.path is None:
+            parser.error("attach-partition requires --path")
+        try:
+            manage_partition(args.action, args.month, args.path, args.writable)
+        except PartitionError as error:
+            parser.exit(1, f"{error}\n")
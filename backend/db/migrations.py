@@ -0,0 +1,346 @@
+#####
+# Versioned schema migrations
+#    - applied migrations are recorded in the schema_migrations table
+#    - migrations inspect the schema before changing it, so databases created by the
+#      old create_all are upgraded the same way as new ones
+#####
+
+import os
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, create_engine, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+
+from db.database import Base
+from db.models import (
+    DataVersion,
+    ExportJob,
+    KeywordPosting,
+    LoadCheckpoint,
+    MessagePartition,
+    MessageRollup,
+    MessageText,
+    MonthlyRollup,
+    SchemaMigration,
+    TextClassification,
+)
+from db.rollups import create_rollup_triggers, rebuild_rollups
+from db.texts import TextHashCollision, register_text_hash_function
+
+
+def column_names(conn: Connection, table_name: str) -> set[str]:
+    # generated columns are hidden from the inspector so ask sqlite directly
+    rows = conn.exec_driver_sql(f"PRAGMA table_xinfo({table_name})")
+    return {row[1] for row in rows}
+
+
+def create_declared_indexes(conn: Connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# an external content table is only updated through these triggers, these are the ones of
+# the messages_full_text_search migration when the text was a column of messages
+INLINE_TEXT_FTS_TRIGGERS = {
+    "messages_fts_insert": (
+        "AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, message_text) "
+        "VALUES (new.message_id, new.message_text); "
+        "END"
+    ),
+    "messages_fts_delete": (
+        "AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "VALUES ('delete', old.message_id, old.message_text); "
+        "END"
+    ),
+    "messages_fts_update": (
+        "AFTER UPDATE OF message_id, message_text ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "VALUES ('delete', old.message_id, old.message_text); "
+        "INSERT INTO messages_fts (rowid, message_text) "
+        "VALUES (new.message_id, new.message_text); "
+        "END"
+    ),
+}
+
+# since the message_texts migration the text is looked up by the hash of the message,
+# message_texts rows are never changed or deleted so only messages need triggers
+MESSAGES_FTS_TRIGGERS = {
+    "messages_fts_insert": (
+        "AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, message_text) "
+        "SELECT new.message_id, message_text FROM message_texts "
+        "WHERE text_hash = new.text_hash; "
+        "END"
+    ),
+    "messages_fts_delete": (
+        "AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "SELECT 'delete', old.message_id, message_text FROM message_texts "
+        "WHERE text_hash = old.text_hash; "
+        "END"
+    ),
+    "messages_fts_update": (
+        "AFTER UPDATE OF message_id, text_hash ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, message_text) "
+        "SELECT 'delete', old.message_id, message_text FROM message_texts "
+        "WHERE text_hash = old.text_hash; "
+        "INSERT INTO messages_fts (rowid, message_text) "
+        "SELECT new.message_id, message_text FROM message_texts "
+        "WHERE text_hash = new.text_hash; "
+        "END"
+    ),
+}
+
+
+def create_full_text_triggers(
+    conn: Connection, triggers: dict[str, str] = MESSAGES_FTS_TRIGGERS
+):
+    for name, definition in triggers.items():
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {definition}")
+
+
+def drop_full_text_triggers(conn: Connection):
+    for name in MESSAGES_FTS_TRIGGERS:
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def create_full_text_index(conn: Connection):
+    """The full text index over message_contents, the text of every message"""
+    conn.exec_driver_sql(
+        "CREATE VIEW IF NOT EXISTS message_contents AS "
+        "SELECT m.message_id, t.message_text FROM messages m "
+        "JOIN message_texts t ON t.text_hash = m.text_hash"
+    )
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "message_text, content='message_contents', content_rowid='message_id')"
+    )
+    create_full_text_triggers(conn)
+    rebuild_full_text_index(conn)
+
+
+def rebuild_full_text_index(conn: Connection):
+    # re-reads every message, used instead of the triggers after a bulk load
+    conn.exec_driver_sql("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+##
+# Migrations, append only - never edit one that has been released
+##
+
+
+def create_tables(conn: Connection):
+    # creates any table missing from the models (with their indexes)
+    Base.metadata.create_all(bind=conn)
+
+
+def keywords_per_compliance_version(conn: Connection):
+    if "compliance_version" in column_names(conn, "anykeywords"):
+        return
+
+    # sqlite cannot change a primary key so the table is rebuilt, before this migration a
+    # keyword belonged to the rule id of every version
+    conn.exec_driver_sql("ALTER TABLE anykeywords RENAME TO anykeywords_old")
+    Base.metadata.tables["anykeywords"].create(conn)
+    conn.exec_driver_sql(
+        "INSERT INTO anykeywords (rule_id, compliance_version, keyword) "
+        "SELECT k.rule_id, r.compliance_version, k.keyword "
+        "FROM anykeywords_old k JOIN rules r ON r.id = k.rule_id"
+    )
+    conn.exec_driver_sql("DROP TABLE anykeywords_old")
+
+
+def search_indexes(conn: Connection):
+    # virtual generated columns can be added to an existing table and are never stale
+    existing_columns = column_names(conn, "physicians")
+    for column in Base.metadata.tables["physicians"].columns:
+        if column.computed is None or column.name in existing_columns:
+            continue
+        conn.exec_driver_sql(
+            f"ALTER TABLE physicians ADD COLUMN {column.name} TEXT "
+            f"GENERATED ALWAYS AS ({column.computed.sqltext}) VIRTUAL"
+        )
+
+    create_declared_indexes(conn)
+
+
+def messages_full_text_search(conn: Connection):
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "message_text, content='messages', content_rowid='message_id')"
+    )
+    create_full_text_triggers(conn, INLINE_TEXT_FTS_TRIGGERS)
+    # index the messages loaded before this migration
+    rebuild_full_text_index(conn)
+
+
+def data_version(conn: Connection):
+    DataVersion.__table__.create(conn, checkfirst=True)
+    conn.execute(
+        insert(DataVersion.__table__).values(id=1, version=0).on_conflict_do_nothing()
+    )
+
+
+def message_rollups(conn: Connection):
+    MessageRollup.__table__.create(conn, checkfirst=True)
+    MonthlyRollup.__table__.create(conn, checkfirst=True)
+    create_rollup_triggers(conn)
+    # roll up the messages loaded before this migration
+    rebuild_rollups(conn)
+
+
+def export_jobs(conn: Connection):
+    ExportJob.__table__.create(conn, checkfirst=True)
+
+
+def message_partitions(conn: Connection):
+    MessagePartition.__table__.create(conn, checkfirst=True)
+
+
+def move_texts_to_message_texts(conn: Connection):
+    """Stores the inline texts of messages in message_texts and points the messages at them
+
+    the full text index is recreated over the message_contents view
+    """
+    MessageText.__table__.create(conn, checkfirst=True)
+    if "text_hash" not in column_names(conn, "messages"):
+        conn.exec_driver_sql(
+            "ALTER TABLE messages ADD COLUMN text_hash INTEGER "
+            "REFERENCES message_texts (text_hash)"
+        )
+    # the index is rebuilt from the view once the texts have moved
+    drop_full_text_triggers(conn)
+    conn.exec_driver_sql("DROP TABLE IF EXISTS messages_fts")
+
+    register_text_hash_function(conn)
+    conn.exec_driver_sql(
+        "INSERT INTO message_texts (text_hash, message_text) "
+        "SELECT text_hash(message_text), message_text FROM messages "
+        "WHERE text_hash IS NULL ON CONFLICT DO NOTHING"
+    )
+    conn.exec_driver_sql(
+        "UPDATE messages SET text_hash = text_hash(message_text) WHERE text_hash IS NULL"
+    )
+    collision_count = conn.exec_driver_sql(
+        "SELECT count(*) FROM messages m JOIN message_texts t ON t.text_hash = m.text_hash "
+        "WHERE m.message_text != '' AND m.message_text != t.message_text"
+    ).scalar_one()
+    if collision_count:
+        raise TextHashCollision(
+            f"{collision_count} messages have a colliding text hash"
+        )
+    conn.exec_driver_sql(
+        "UPDATE messages SET message_text = '' WHERE message_text != ''"
+    )
+
+    create_full_text_index(conn)
+
+
+def message_texts(conn: Connection):
+    move_texts_to_message_texts(conn)
+
+    # classifications and postings of a message become the ones of its text
+    TextClassification.__table__.create(conn, checkfirst=True)
+    if inspect(conn).has_table("message_classifications"):
+        conn.exec_driver_sql(
+            "INSERT INTO text_classifications (text_hash, compliance_version, matches) "
+            "SELECT m.text_hash, c.compliance_version, c.matches "
+            "FROM message_classifications c JOIN messages m ON m.message_id = c.message_id "
+            "WHERE true ON CONFLICT DO NOTHING"
+        )
+        conn.exec_driver_sql("DROP TABLE message_classifications")
+    if "message_id" in column_names(conn, "keyword_postings"):
+        conn.exec_driver_sql(
+            "ALTER TABLE keyword_postings RENAME TO keyword_postings_old"
+        )
+        KeywordPosting.__table__.create(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO keyword_postings (keyword, text_hash) "
+            "SELECT p.keyword, m.text_hash "
+            "FROM keyword_postings_old p JOIN messages m ON m.message_id = p.message_id "
+            "WHERE true ON CONFLICT DO NOTHING"
+        )
+        conn.exec_driver_sql("DROP TABLE keyword_postings_old")
+
+    # partition files have a messages table of their own
+    partitions = conn.execute(select(MessagePartition.path, MessagePartition.read_only))
+    for path, read_only in partitions:
+        if read_only:
+            os.chmod(path, 0o644)
+        partition_engine = create_engine(f"sqlite:///{path}")
+        try:
+            with partition_engine.begin() as partition_conn:
+                move_texts_to_message_texts(partition_conn)
+        finally:
+            partition_engine.dispose()
+            if read_only:
+                os.chmod(path, 0o444)
+
+
+def load_checkpoints(conn: Connection):
+    LoadCheckpoint.__table__.create(conn, checkfirst=True)
+
+
+def rules_revisions(conn: Connection):
+    if "rules_revision" not in column_names(conn, "compliance_versions"):
+        conn.exec_driver_sql(
+            "ALTER TABLE compliance_versions "
+            "ADD COLUMN rules_revision INTEGER NOT NULL DEFAULT 0"
+        )
+
+
+def export_job_owners(conn: Connection):
+    if "owner" not in column_names(conn, "export_jobs"):
+        conn.exec_driver_sql("ALTER TABLE export_jobs ADD COLUMN owner TEXT")
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create_tables", create_tables),
+    (2, "keywords_per_compliance_version", keywords_per_compliance_version),
+    (3, "search_indexes", search_indexes),
+    (4, "messages_full_text_search", messages_full_text_search),
+    (5, "data_version", data_version),
+    (6, "message_rollups", message_rollups),
+    (7, "export_jobs", export_jobs),
+    (8, "message_partitions", message_partitions),
+    (9, "message_texts", message_texts),
+    (10, "load_checkpoints", load_checkpoints),
+    (11, "rules_revisions", rules_revisions),
+    (12, "export_job_owners", export_job_owners),
+]
+
+
+def applied_versions(conn: Connection) -> set[int]:
+    return set(conn.execute(select(SchemaMigration.version)).scalars())
+
+
+def migrate(engine: Engine) -> list[str]:
+    """Applies every pending migration in order, each in its own transaction, returns the applied names"""
+    applied_names = []
+    with engine.begin() as conn:
+        SchemaMigration.__table__.create(conn, checkfirst=True)
+
+    for version, name, migration in MIGRATIONS:
+        with engine.begin() as conn:
+            if version in applied_versions(conn):
+                continue
+            migration(conn)
+            conn.execute(
+                insert(SchemaMigration.__table__).values(
+                    version=version, name=name, applied_at=datetime.now()
+                )
+            )
+        applied_names.append(name)
+    return applied_names
+
+
+def pending_migrations(engine: Engine) -> list[str]:
+    if not inspect(engine).has_table(SchemaMigration.__tablename__):
+        return [name for _, name, _ in MIGRATIONS]
+    with engine.connect() as conn:
+        applied = applied_versions(conn)
+    return [name for version, name, _ in MIGRATIONS if version not in applied]
@@ -3,8 +3,23 @@
 #####
 
 from typing import List, Optional
-from sqlalchemy import ForeignKey, Integer, Boolean, CHAR, Text, Float, TIMESTAMP
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import (
+    Computed,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    Column,
+    Boolean,
+    CHAR,
+    Text,
+    Float,
+    TIMESTAMP,
+    select,
+)
+from sqlalchemy.orm import Mapped, column_property, mapped_column, relationship
 from datetime import datetime
 from .database import Base
 
@@ -25,26 +40,64 @@ class Physician(Base):
     consent_opt_in: Mapped[bool] = mapped_column(Boolean)
     preferred_channel: Mapped[str] = mapped_column(Text)
 
+    # case normalized copies kept by sqlite so case insensitive filters can use an index
+    state_normalized: Mapped[str] = mapped_column(
+        Text, Computed("lower(state)", persisted=False), index=True
+    )
+    specialty_normalized: Mapped[str] = mapped_column(
+        Text, Computed("lower(specialty)", persisted=False), index=True
+    )
+
     messages: Mapped[List["Message"]] = relationship(
         back_populates="physician", lazy="raise_on_sql"
     )
 
 
+class MessageText(Base):
+    """A message text stored once however many messages share it, see db/texts.py"""
+
+    __tablename__ = "message_texts"
+
+    # 64 bit hash of the text (db/texts.py text_hash), an integer primary key is the rowid
+    text_hash: Mapped[int] = mapped_column(
+        Integer, primary_key=True, autoincrement=False
+    )
+    message_text: Mapped[str] = mapped_column(Text)
+
+
 class Message(Base):
     __tablename__ = "messages"
+    # the integer primary key is the rowid so both indexes also end in message_id,
+    # which matches the (timestamp, message_id) ordering of the message search
+    __table_args__ = (
+        Index("ix_messages_physician_id_timestamp", "physician_id", "timestamp"),
+        Index("ix_messages_timestamp", "timestamp"),
+    )
 
     message_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     physician_id: Mapped[int] = mapped_column(ForeignKey("physicians.physician_id"))
     channel: Mapped[str] = mapped_column(Text)
     is_outbound: Mapped[bool] = mapped_column(Boolean)
     timestamp: Mapped[datetime] = mapped_column(TIMESTAMP)
-    message_text: Mapped[str] = mapped_column(Text)
+    # the texts moved to message_texts, this column only held them before that migration
+    # and is left empty since (sqlite cannot drop a column the full text index was built on)
+    inline_message_text: Mapped[str] = mapped_column(
+        "message_text", Text, default="", deferred=True
+    )
     campaign_id: Mapped[str] = mapped_column(Text)
     topic: Mapped[str] = mapped_column(Text)
     compliance_tag: Mapped[str] = mapped_column(Text)
     sentiment: Mapped[str] = mapped_column(Text)
     delivery_status: Mapped[str] = mapped_column(Text)
     response_latency_sec: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    text_hash: Mapped[int] = mapped_column(ForeignKey("message_texts.text_hash"))
+
+    # read through a primary key lookup so selects of the text are unchanged
+    message_text: Mapped[str] = column_property(
+        select(MessageText.message_text)
+        .where(MessageText.text_hash == text_hash)
+        .scalar_subquery()
+    )
 
     physician: Mapped["Physician"] = relationship(
         back_populates="messages", lazy="raise_on_sql"
@@ -56,6 +109,9 @@ class ComplianceVersion(Base):
 
     version: Mapped[str] = mapped_column(Text, primary_key=True)
     first_name: Mapped[str] = mapped_column(Text)
+    # bumped by every change to the rules or keywords of the version, a process compares
+    # it with the revision its compiled matcher was built from (see services/matcher.py)
+    rules_revision: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
 
     rules: Mapped[List["Rule"]] = relationship(
         back_populates="compliance_version_ref", lazy="raise_on_sql"
@@ -67,7 +123,7 @@ class Rule(Base):
 
     id: Mapped[str] = mapped_column(Text, primary_key=True)
     compliance_version: Mapped[str] = mapped_column(
-        ForeignKey("compliance_versions.version"), primary_key=True
+        ForeignKey("compliance_versions.version"), primary_key=True, index=True
     )
     name: Mapped[str] = mapped_column(Text)
     result_type: Mapped[str] = mapped_column(Text)
@@ -83,8 +139,209 @@ class Rule(Base):
 
 class AnyKeyword(Base):
     __tablename__ = "anykeywords"
+    # rule ids are reused between compliance versions so a keyword belongs to a (rule, version)
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["rule_id", "compliance_version"], ["rules.id", "rules.compliance_version"]
+        ),
+        Index("ix_anykeywords_compliance_version", "compliance_version"),
+    )
 
-    rule_id: Mapped[str] = mapped_column(ForeignKey("rules.id"), primary_key=True)
+    rule_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    compliance_version: Mapped[str] = mapped_column(Text, primary_key=True)
     keyword: Mapped[str] = mapped_column(Text, primary_key=True)
 
     rule: Mapped["Rule"] = relationship(back_populates="keywords", lazy="raise_on_sql")
+
+
+class TextClassification(Base):
+    """Stored result of classifying a message text against a compliance version
+
+    a text never changes so the result only has to be recomputed when the keywords of the
+    compliance version change, every message sharing the text reads the same row
+    """
+
+    __tablename__ = "text_classifications"
+
+    text_hash: Mapped[int] = mapped_column(
+        ForeignKey("message_texts.text_hash"), primary_key=True
+    )
+    compliance_version: Mapped[str] = mapped_column(
+        ForeignKey("compliance_versions.version"), primary_key=True, index=True
+    )
+    # json object of rule id -> matched keywords, rule details are looked up from the rules
+    matches: Mapped[str] = mapped_column(Text)
+
+
+class KeywordPosting(Base):
+    """Inverted index of (case folded) keyword -> message texts containing it"""
+
+    __tablename__ = "keyword_postings"
+
+    keyword: Mapped[str] = mapped_column(Text, primary_key=True)
+    text_hash: Mapped[int] = mapped_column(
+        ForeignKey("message_texts.text_hash"), primary_key=True
+    )
+
+
+class IndexedKeyword(Base):
+    """Keywords whose postings are complete for every message text"""
+
+    __tablename__ = "indexed_keywords"
+
+    keyword: Mapped[str] = mapped_column(Text, primary_key=True)
+
+
+class SchemaMigration(Base):
+    """Migrations from db/migrations.py that have been applied to the database"""
+
+    __tablename__ = "schema_migrations"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(Text)
+    applied_at: Mapped[datetime] = mapped_column(TIMESTAMP)
+
+
+class RollupTotals:
+    """Engagement totals of the messages in one rollup group"""
+
+    message_count: Mapped[int] = mapped_column(Integer)
+    outbound_count: Mapped[int] = mapped_column(Integer)
+    delivered_count: Mapped[int] = mapped_column(Integer)
+    bounced_count: Mapped[int] = mapped_column(Integer)
+    failed_count: Mapped[int] = mapped_column(Integer)
+    positive_count: Mapped[int] = mapped_column(Integer)
+    neutral_count: Mapped[int] = mapped_column(Integer)
+    negative_count: Mapped[int] = mapped_column(Integer)
+    # messages with a response latency, the sum / count is the mean latency
+    latency_count: Mapped[int] = mapped_column(Integer)
+    latency_sum: Mapped[float] = mapped_column(Float)
+    latency_min: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    latency_max: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+
+class MessageRollup(RollupTotals, Base):
+    """Totals per (physician, campaign, channel, day), kept up to date by triggers on messages
+
+    see db/rollups.py, /stats answers grouped queries from the rollups instead of the messages
+    """
+
+    __tablename__ = "message_rollups"
+    __table_args__ = (Index("ix_message_rollups_day", "day"),)
+
+    physician_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    campaign_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    channel: Mapped[str] = mapped_column(Text, primary_key=True)
+    # YYYY-MM-DD of the message timestamp
+    day: Mapped[str] = mapped_column(Text, primary_key=True)
+
+
+class MonthlyRollup(RollupTotals, Base):
+    """Totals per (campaign, channel, month), small enough to scan for any query without a physician"""
+
+    __tablename__ = "monthly_rollups"
+
+    campaign_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    channel: Mapped[str] = mapped_column(Text, primary_key=True)
+    # YYYY-MM of the message timestamp
+    month: Mapped[str] = mapped_column(Text, primary_key=True)
+
+
+class DataVersion(Base):
+    """A single row counter bumped by every write to physicians or messages
+
+    cached responses remember the version they were rendered at, so a bump from any
+    process (a load, another api worker) makes them stale
+    """
+
+    __tablename__ = "data_version"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer)
+
+
+class ExportJob(Base):
+    """A background export of messages with their classification, see services/exports.py
+
+    kept in the database so every api worker can report the status and serve the file
+    """
+
+    __tablename__ = "export_jobs"
+
+    job_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    # pending, running, completed or failed
+    status: Mapped[str] = mapped_column(Text)
+    # csv or ndjson, gzip compressed
+    format: Mapped[str] = mapped_column(Text)
+    compliance_version: Mapped[str] = mapped_column(Text)
+    physician_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    start_date: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True)
+    end_date: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True)
+    # matching messages counted when the job starts, rows_written / total_rows is the progress
+    total_rows: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    rows_written: Mapped[int] = mapped_column(Integer)
+    # compressed size of the file so far
+    bytes_written: Mapped[int] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True)
+    # the api process running the job, its unfinished jobs are failed once it is gone
+    owner: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+
+class MessagePartition(Base):
+    """A month of messages moved out of messages into its own sqlite file, see db/partitions.py
+
+    the catalog of the partitions, a query only opens the files of the months it overlaps
+    """
+
+    __tablename__ = "message_partitions"
+
+    # YYYY-MM of the message timestamps in the partition
+    month: Mapped[str] = mapped_column(Text, primary_key=True)
+    path: Mapped[str] = mapped_column(Text)
+    # read only partitions are opened immutable and never written to again
+    read_only: Mapped[bool] = mapped_column(Boolean)
+    message_count: Mapped[int] = mapped_column(Integer)
+    # message id range of the partition, a lookup by id only opens the ones that can hold it
+    min_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    max_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # when the file was created, a file recreated at the same path gets new connections
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP)
+
+
+class LoadCheckpoint(Base):
+    """How far an incremental load (db/incremental_load.py) has read a csv export
+
+    a rerun reads on from byte_offset if the first byte_offset bytes still hash to prefix_hash
+    """
+
+    __tablename__ = "load_checkpoints"
+
+    # absolute path of the csv file
+    path: Mapped[str] = mapped_column(Text, primary_key=True)
+    # end of the last loaded row, always the start of a line
+    byte_offset: Mapped[int] = mapped_column(Integer)
+    # blake2b of the file up to byte_offset (hex)
+    prefix_hash: Mapped[str] = mapped_column(Text)
+    # rows read up to byte_offset
+    row_count: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP)
+
+# FTS5 full text index over the message texts, an external content table (reading the
+# message_contents view of messages joined with message_texts) so the text is not stored
+# twice. It is created and kept in sync (triggers) by db/migrations.py,
+# its own metadata keeps create_all from creating it as a plain table
+fts_metadata = MetaData()
+
+messages_fts = Table(
+    "messages_fts",
+    fts_metadata,
+    # the message_id of the indexed message
+    Column("rowid", Integer),
+    Column("message_text", Text),
+    # bm25 relevance of the current MATCH, lower is more relevant
+    Column("rank", Float),
+    # hidden column named like the table, MATCH on it searches every indexed column
+    Column("messages_fts", Text),
+)
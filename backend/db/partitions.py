@@ -0,0 +1,363 @@
+#####
+# Monthly partitions of the messages
+#    - whole months are moved out of messages into a sqlite file per month under
+#      MESSAGE_PARTITION_DIR, each file has the same messages table, indexes and full text
+#      index so the statements of the routers run unchanged against it
+#    - message_partitions in the main database is the catalog, a date range query only
+#      opens the partitions of the months it overlaps and merges them with the hot table
+#    - the move runs in one transaction over the attached file, the rollup triggers are
+#      dropped meanwhile so the rollups keep the totals of archived messages (/stats is
+#      unchanged), the texts of the moved messages are copied along (message_texts keeps
+#      them too) and classifications stay in the main database keyed by text hash
+#    - detaching a partition only drops it from the catalog (the file is kept), a read only
+#      partition is chmod-ed and opened immutable, both are cheap
+#    - exports and batch classification merge the partitions the range overlaps with the
+#      hot table, reclassification reads message_texts which keeps the archived texts, ingest
+#      and incremental loads skip message ids already stored in the partition of their month
+#####
+
+import os
+import threading
+from datetime import date, datetime
+from itertools import batched
+from typing import Sequence
+
+from sqlalchemy import Connection, Engine, Select, create_engine, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import make_url
+
+from db.database import POOL_OPTIONS, create_db_engine, read_only_url
+from db.migrations import create_full_text_index
+from db.models import Message, MessagePartition, MessageText
+from db.rollups import create_rollup_triggers, drop_rollup_triggers
+from services.response_cache import bump_data_version
+
+MESSAGE_PARTITION_DIR = os.environ.get("MESSAGE_PARTITION_DIR", "partitions")
+
+# message ids per IN (...) when looking them up in a partition, below the sqlite variable limit
+ID_BATCH_SIZE = 500
+
+MESSAGE_COLUMNS = ", ".join(column.name for column in Message.__table__.columns)
+
+
+class PartitionError(Exception):
+    pass
+
+
+##
+# Months
+##
+
+
+def month_key(timestamp: datetime | date) -> str:
+    return timestamp.strftime("%Y-%m")
+
+
+def month_bounds(month: str) -> tuple[str, str]:
+    """[start, end) of a YYYY-MM month comparable with the stored timestamp text"""
+    try:
+        start = datetime.strptime(month, "%Y-%m").date()
+    except ValueError:
+        raise PartitionError(f"Invalid month {month!r}, expected YYYY-MM")
+    end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def partition_path(month: str, partition_dir: str = MESSAGE_PARTITION_DIR) -> str:
+    return os.path.join(partition_dir, f"messages_{month}.db")
+
+
+##
+# Catalog
+##
+
+
+def partitions_overlapping(start: datetime | None, end: datetime | None) -> Select:
+    """Catalog rows of the months a [start, end] timestamp range overlaps, oldest first"""
+    stmt = select(MessagePartition).order_by(MessagePartition.month)
+    if start is not None:
+        stmt = stmt.filter(MessagePartition.month >= month_key(start))
+    if end is not None:
+        stmt = stmt.filter(MessagePartition.month <= month_key(end))
+    return stmt
+
+
+def partitions_containing(message_id: int) -> Select:
+    return select(MessagePartition).filter(
+        MessagePartition.min_message_id <= message_id,
+        MessagePartition.max_message_id >= message_id,
+    )
+
+
+def get_partition(conn: Connection, month: str) -> MessagePartition | None:
+    row = conn.execute(
+        select(MessagePartition.__table__).where(MessagePartition.month == month)
+    ).one_or_none()
+    return MessagePartition(**row._mapping) if row is not None else None
+
+
+##
+# Moving months between the hot table and their partitions
+##
+
+
+def create_partition_file(path: str):
+    """An empty partition with the messages and message_texts tables and the full text index"""
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        with engine.begin() as conn:
+            MessageText.__table__.create(conn, checkfirst=True)
+            Message.__table__.create(conn, checkfirst=True)
+            create_full_text_index(conn)
+    finally:
+        engine.dispose()
+
+
+def move_messages(conn: Connection, path: str, month: str, to_partition: bool) -> int:
+    """Moves the messages of a month between messages and the partition file, returns the count
+
+    one transaction over both databases, the rollups are left as they are
+    """
+    start, end = month_bounds(month)
+    source, target = ("main", "partition") if to_partition else ("partition", "main")
+    conn.exec_driver_sql("ATTACH DATABASE ? AS partition", (path,))
+    try:
+        # attach has to run outside of a transaction, the moves take the write lock at once
+        conn.commit()
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        drop_rollup_triggers(conn)
+        # the full text triggers of the target read the text from its message_texts
+        conn.exec_driver_sql(
+            f"INSERT INTO {target}.message_texts (text_hash, message_text) "
+            f"SELECT text_hash, message_text FROM {source}.message_texts "
+            f"WHERE text_hash IN (SELECT text_hash FROM {source}.messages "
+            "WHERE timestamp >= ? AND timestamp < ?) ON CONFLICT DO NOTHING",
+            (start, end),
+        )
+        moved_count = conn.exec_driver_sql(
+            f"INSERT INTO {target}.messages ({MESSAGE_COLUMNS}) "
+            f"SELECT {MESSAGE_COLUMNS} FROM {source}.messages "
+            "WHERE timestamp >= ? AND timestamp < ?",
+            (start, end),
+        ).rowcount
+        conn.exec_driver_sql(
+            f"DELETE FROM {source}.messages WHERE timestamp >= ? AND timestamp < ?",
+            (start, end),
+        )
+        create_rollup_triggers(conn)
+        if to_partition:
+            register_partition(conn, month, path)
+        else:
+            conn.execute(
+                MessagePartition.__table__.delete().where(
+                    MessagePartition.month == month
+                )
+            )
+        bump_data_version(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.exec_driver_sql("DETACH DATABASE partition")
+    return moved_count
+
+
+def register_partition(conn: Connection, month: str, path: str):
+    """Adds (or updates) the catalog row of an attached partition"""
+    message_count, min_message_id, max_message_id = conn.exec_driver_sql(
+        "SELECT count(*), min(message_id), max(message_id) FROM partition.messages"
+    ).one()
+    values = dict(
+        path=path,
+        message_count=message_count,
+        min_message_id=min_message_id,
+        max_message_id=max_message_id,
+    )
+    conn.execute(
+        insert(MessagePartition.__table__)
+        .values(month=month, read_only=False, created_at=datetime.now(), **values)
+        .on_conflict_do_update(index_elements=["month"], set_=values)
+    )
+
+
+def archive_month(
+    engine: Engine, month: str, partition_dir: str = MESSAGE_PARTITION_DIR
+) -> int:
+    """Moves the hot messages of a month to its partition, returns the moved count
+
+    messages that arrived for an already archived month are appended to its partition
+    """
+    with engine.connect() as conn:
+        partition = get_partition(conn, month)
+        if partition is not None and partition.read_only:
+            raise PartitionError(f"Partition {month} is read only")
+        if partition is None:
+            path = partition_path(month, partition_dir)
+            if os.path.exists(path):
+                raise PartitionError(f"{path} exists but is not in the catalog")
+            os.makedirs(partition_dir, exist_ok=True)
+            create_partition_file(path)
+        else:
+            path = partition.path
+        return move_messages(conn, path, month, to_partition=True)
+
+
+def hot_months(engine: Engine, before_month: str | None = None) -> list[str]:
+    """Months with messages in the hot table, only the ones older than before_month if set"""
+    stmt = "SELECT DISTINCT strftime('%Y-%m', timestamp) FROM messages"
+    params: tuple = ()
+    if before_month is not None:
+        stmt += " WHERE timestamp < ?"
+        params = (month_bounds(before_month)[0],)
+    with engine.connect() as conn:
+        return list(conn.exec_driver_sql(f"{stmt} ORDER BY 1", params).scalars())
+
+
+def archived_months(engine: Engine) -> dict[str, bool]:
+    """Month -> read only of every partition in the catalog"""
+    with engine.connect() as conn:
+        rows = conn.execute(select(MessagePartition.month, MessagePartition.read_only))
+        return {month: read_only for month, read_only in rows}
+
+
+def restore_month(engine: Engine, month: str) -> int:
+    """Moves a partition back into the hot table and deletes its file, returns the count"""
+    with engine.connect() as conn:
+        partition = get_partition(conn, month)
+    if partition is None:
+        raise PartitionError(f"No partition for {month}")
+    if partition.read_only:
+        set_read_only(engine, month, False)
+    with engine.connect() as conn:
+        moved_count = move_messages(conn, partition.path, month, to_partition=False)
+    os.remove(partition.path)
+    return moved_count
+
+
+def detach_month(engine: Engine, month: str) -> str:
+    """Drops a partition from the catalog, its messages are no longer served, returns the file
+
+    the rollups keep counting them, attach_month brings the file back
+    """
+    with engine.begin() as conn:
+        partition = get_partition(conn, month)
+        if partition is None:
+            raise PartitionError(f"No partition for {month}")
+        conn.execute(
+            MessagePartition.__table__.delete().where(MessagePartition.month == month)
+        )
+        bump_data_version(conn)
+    return partition.path
+
+
+def attach_month(engine: Engine, month: str, path: str, read_only: bool = False):
+    """Adds a partition file (e.g. one detached before) back to the catalog"""
+    month_bounds(month)
+    if not os.path.exists(path):
+        raise PartitionError(f"{path} does not exist")
+    with engine.connect() as conn:
+        if get_partition(conn, month) is not None:
+            raise PartitionError(f"Partition {month} is already attached")
+        conn.exec_driver_sql("ATTACH DATABASE ? AS partition", (path,))
+        try:
+            register_partition(conn, month, path)
+            bump_data_version(conn)
+            conn.commit()
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE partition")
+    if read_only:
+        set_read_only(engine, month, True)
+
+
+def set_read_only(engine: Engine, month: str, read_only: bool = True):
+    """Freezes (or unfreezes) a partition, read only files are opened immutable"""
+    with engine.begin() as conn:
+        partition = get_partition(conn, month)
+        if partition is None:
+            raise PartitionError(f"No partition for {month}")
+        os.chmod(partition.path, 0o444 if read_only else 0o644)
+        conn.execute(
+            MessagePartition.__table__.update()
+            .where(MessagePartition.month == month)
+            .values(read_only=read_only)
+        )
+        bump_data_version(conn)
+
+
+##
+# Engines of the api
+##
+
+_engines: dict[str, tuple[tuple, Engine]] = {}
+_engines_lock = threading.Lock()
+
+
+def create_partition_engine(path: str, read_only: bool) -> Engine:
+    if not read_only:
+        return create_db_engine(f"sqlite:///{path}")
+    # immutable, sqlite skips the locking and change checks of a file that never changes
+    url = read_only_url(make_url(f"sqlite:///{path}"))
+    url = url.update_query_dict({"immutable": "1"})
+    return create_engine(url, **POOL_OPTIONS)
+
+
+def partition_engine(partition: MessagePartition) -> Engine:
+    """Pooled engine of a partition, kept for the life of the process"""
+    key = (partition.read_only, partition.created_at)
+    cached = _engines.get(partition.path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with _engines_lock:
+        cached = _engines.get(partition.path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if cached is not None:
+            # frozen or recreated since, its connections may see a deleted file
+            cached[1].dispose()
+        engine = create_partition_engine(partition.path, partition.read_only)
+        _engines[partition.path] = (key, engine)
+        return engine
+
+
+def read_partition_message(
+    partitions: Sequence[MessagePartition], message_id: int
+) -> tuple[int, int, str] | None:
+    """(message_id, text_hash, message_text) of a message in one of the partitions"""
+    stmt = select(Message.message_id, Message.text_hash, Message.message_text).where(
+        Message.message_id == message_id
+    )
+    for partition in partitions:
+        with partition_engine(partition).connect() as conn:
+            row = conn.execute(stmt).one_or_none()
+        if row is not None:
+            message_id, text_hash, message_text = row
+            return message_id, text_hash, message_text
+    return None
+
+
+def archived_message_ids(
+    conn: Connection, messages: Sequence[tuple[int, datetime]]
+) -> set[int]:
+    """Ids of the (message_id, timestamp) messages already stored in the partition of their month"""
+    ids_by_month: dict[str, list[int]] = {}
+    for message_id, timestamp in messages:
+        ids_by_month.setdefault(month_key(timestamp), []).append(message_id)
+    rows = conn.execute(
+        select(MessagePartition.__table__).where(
+            MessagePartition.month.in_(ids_by_month)
+        )
+    )
+    archived_ids = set()
+    for row in rows:
+        partition = MessagePartition(**row._mapping)
+        with partition_engine(partition).connect() as partition_conn:
+            for message_ids in batched(ids_by_month[partition.month], ID_BATCH_SIZE):
+                archived_ids.update(
+                    partition_conn.execute(
+                        select(Message.message_id).where(
+                            Message.message_id.in_(message_ids)
+                        )
+                    ).scalars()
+                )
+    return archived_ids
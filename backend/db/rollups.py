@@ -0,0 +1,175 @@
+#####
+# Engagement rollups of the messages
+#    - message_rollups has the totals per (physician, campaign, channel, day), monthly_rollups
+#      per (campaign, channel, month) so queries without a physician scan a small table
+#    - triggers on messages keep both current for every write path, an insert adds the
+#      message to its groups, a delete/ update recomputes the groups it touched
+#    - bulk loads drop the triggers and add the loaded messages per group once at the end
+#####
+
+from sqlalchemy import Connection
+
+# group key -> value of a single message
+MESSAGE_KEYS = {
+    "physician_id": "{row}.physician_id",
+    "campaign_id": "{row}.campaign_id",
+    "channel": "{row}.channel",
+    "day": "date({row}.timestamp)",
+    "month": "strftime('%Y-%m', {row}.timestamp)",
+}
+
+ROLLUP_TABLES = {
+    "message_rollups": ["physician_id", "campaign_id", "channel", "day"],
+    "monthly_rollups": ["campaign_id", "channel", "month"],
+}
+
+# rollup column -> value of a single message, added up per group
+ROLLUP_SUMS = {
+    "message_count": "1",
+    "outbound_count": "{row}.is_outbound",
+    "delivered_count": "{row}.delivery_status = 'delivered'",
+    "bounced_count": "{row}.delivery_status = 'bounced'",
+    "failed_count": "{row}.delivery_status = 'failed'",
+    "positive_count": "{row}.sentiment = 'positive'",
+    "neutral_count": "{row}.sentiment = 'neutral'",
+    "negative_count": "{row}.sentiment = 'negative'",
+    "latency_count": "{row}.response_latency_sec IS NOT NULL",
+    "latency_sum": "coalesce({row}.response_latency_sec, 0)",
+}
+
+ROLLUP_TRIGGER_NAMES = [
+    "messages_rollup_insert",
+    "messages_rollup_delete",
+    "messages_rollup_update",
+]
+
+
+def rollup_columns(table: str) -> list[str]:
+    return [*ROLLUP_TABLES[table], *ROLLUP_SUMS, "latency_min", "latency_max"]
+
+
+def messages_select(table: str, where: str) -> str:
+    """The rollup rows of the messages (aliased m) matching the where clause"""
+    keys = [MESSAGE_KEYS[key].format(row="m") for key in ROLLUP_TABLES[table]]
+    sums = [f"sum({expression.format(row='m')})" for expression in ROLLUP_SUMS.values()]
+    return (
+        f"SELECT {', '.join(keys + sums)}, "
+        "min(m.response_latency_sec), max(m.response_latency_sec) "
+        f"FROM messages m WHERE {where} GROUP BY {', '.join(keys)}"
+    )
+
+
+def message_rollups_select(where: str) -> str:
+    """The monthly rollup rows of the daily rollups (aliased r) matching the where clause"""
+    keys = ["r.campaign_id", "r.channel", "substr(r.day, 1, 7)"]
+    sums = [f"sum(r.{column})" for column in ROLLUP_SUMS]
+    return (
+        f"SELECT {', '.join(keys + sums)}, min(r.latency_min), max(r.latency_max) "
+        f"FROM message_rollups r WHERE {where} GROUP BY {', '.join(keys)}"
+    )
+
+
+def upsert(table: str, select: str) -> str:
+    """Adds the rows of the select to the rollup table, merging them into existing groups"""
+    # the where clause every select has keeps sqlite from reading ON CONFLICT as a join
+    updates = [f"{column} = {column} + excluded.{column}" for column in ROLLUP_SUMS]
+    updates += [
+        f"{column} = {function}(coalesce({column}, excluded.{column}), "
+        f"coalesce(excluded.{column}, {column}))"
+        for column, function in (("latency_min", "min"), ("latency_max", "max"))
+    ]
+    return (
+        f"INSERT INTO {table} ({', '.join(rollup_columns(table))}) {select} "
+        f"ON CONFLICT ({', '.join(ROLLUP_TABLES[table])}) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+def add_message(table: str, row: str) -> str:
+    values = [MESSAGE_KEYS[key].format(row=row) for key in ROLLUP_TABLES[table]]
+    values += [expression.format(row=row) for expression in ROLLUP_SUMS.values()]
+    values += [f"{row}.response_latency_sec", f"{row}.response_latency_sec"]
+    return upsert(table, f"SELECT {', '.join(values)} WHERE true") + "; "
+
+
+def recompute_groups(row: str) -> str:
+    """Statements that rebuild the rollups of the groups the trigger row (old/ new) belongs to"""
+    statements = []
+    for table in ROLLUP_TABLES:
+        key_matches = " AND ".join(
+            f"{key} = {MESSAGE_KEYS[key].format(row=row)}"
+            for key in ROLLUP_TABLES[table]
+        )
+        statements.append(f"DELETE FROM {table} WHERE {key_matches}; ")
+
+    # day ranges instead of date(timestamp) so the timestamp indexes can be used
+    day_messages = (
+        f"m.physician_id = {row}.physician_id AND m.campaign_id = {row}.campaign_id "
+        f"AND m.channel = {row}.channel AND m.timestamp >= date({row}.timestamp) "
+        f"AND m.timestamp < date({row}.timestamp, '+1 day')"
+    )
+    statements.append(
+        f"INSERT INTO message_rollups ({', '.join(rollup_columns('message_rollups'))}) "
+        f"{messages_select('message_rollups', day_messages)}; "
+    )
+    # the month is summed from the (already recomputed) daily rollups
+    month_rollups = (
+        f"r.campaign_id = {row}.campaign_id AND r.channel = {row}.channel "
+        f"AND r.day >= date({row}.timestamp, 'start of month') "
+        f"AND r.day < date({row}.timestamp, 'start of month', '+1 month')"
+    )
+    statements.append(
+        f"INSERT INTO monthly_rollups ({', '.join(rollup_columns('monthly_rollups'))}) "
+        f"{message_rollups_select(month_rollups)}; "
+    )
+    return "".join(statements)
+
+
+def create_rollup_triggers(conn: Connection):
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS messages_rollup_insert AFTER INSERT ON messages "
+        f"BEGIN {''.join(add_message(table, 'new') for table in ROLLUP_TABLES)} END"
+    )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS messages_rollup_delete AFTER DELETE ON messages "
+        f"BEGIN {recompute_groups('old')} END"
+    )
+    # when the groups did not change the second recompute finds the same rows
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS messages_rollup_update AFTER UPDATE OF "
+        "physician_id, campaign_id, channel, timestamp, is_outbound, delivery_status, "
+        "sentiment, response_latency_sec ON messages "
+        f"BEGIN {recompute_groups('old')} {recompute_groups('new')} END"
+    )
+
+
+def drop_rollup_triggers(conn: Connection):
+    for name in ROLLUP_TRIGGER_NAMES:
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def rebuild_rollups(conn: Connection):
+    for table in ROLLUP_TABLES:
+        conn.exec_driver_sql(f"DELETE FROM {table}")
+    conn.exec_driver_sql(
+        upsert("message_rollups", messages_select("message_rollups", "true"))
+    )
+    conn.exec_driver_sql(upsert("monthly_rollups", message_rollups_select("true")))
+
+
+def add_to_rollups(conn: Connection, after_message_id: int, message_count: int):
+    """Adds messages inserted while the triggers were dropped to the rollups
+
+    the loaded messages are found as the ones after the largest message id before the
+    load, when a load inserted lower ids the rollups are rebuilt instead
+    """
+    new_count = conn.exec_driver_sql(
+        "SELECT count(*) FROM messages WHERE message_id > ?", (after_message_id,)
+    ).scalar_one()
+    if new_count != message_count:
+        rebuild_rollups(conn)
+        return
+    for table in ROLLUP_TABLES:
+        conn.exec_driver_sql(
+            upsert(table, messages_select(table, "m.message_id > ?")),
+            (after_message_id,),
+        )
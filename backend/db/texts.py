@@ -0,0 +1,77 @@
+#####
+# Content addressed message texts
+#    - campaigns send the same templated copy to many physicians, every distinct text is
+#      stored once in message_texts keyed by a 64 bit hash of it and messages reference it
+#    - classifications and keyword postings are kept per text too, so a text is matched
+#      once per compliance version however many messages share it
+#    - the hash is computed in python (the loader workers, ingest), the migration of
+#      existing databases registers it as an sqlite function
+#####
+
+import hashlib
+from itertools import batched
+from typing import Iterable
+
+from sqlalchemy import Connection, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from db.models import MessageText
+
+# hashes per IN (...) when checking stored texts, below the sqlite variable limit
+TEXT_CHECK_BATCH_SIZE = 500
+
+
+class TextHashCollision(Exception):
+    pass
+
+
+def text_hash(text: str) -> int:
+    """blake2b of the text as a signed 64 bit integer, the rowid of its message_texts row"""
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def register_text_hash_function(conn: Connection):
+    """Makes text_hash(text) callable from the sql of this connection"""
+    conn.connection.driver_connection.create_function(
+        "text_hash", 1, text_hash, deterministic=True
+    )
+
+
+def store_texts(conn: Connection | Session, texts: dict[int, str]):
+    """Inserts the texts (hash -> text) that are not stored yet, the caller commits
+
+    a hash already stored for another text is a collision, unlikely at 64 bits but it
+    would silently attach the wrong text so it fails the write
+    """
+    if not texts:
+        return
+    conn.execute(
+        insert(MessageText.__table__).on_conflict_do_nothing(),
+        [{"text_hash": hash_, "message_text": text} for hash_, text in texts.items()],
+    )
+    for hashes in batched(texts, TEXT_CHECK_BATCH_SIZE):
+        stored = conn.execute(
+            select(MessageText.text_hash, MessageText.message_text).where(
+                MessageText.text_hash.in_(hashes)
+            )
+        )
+        for hash_, text in stored:
+            if texts[hash_] != text:
+                raise TextHashCollision(f"Text hash {hash_} is used by another text")
+
+
+def store_message_texts(conn: Connection | Session, rows: Iterable[dict]) -> list[dict]:
+    """Stores the texts of message rows (with message_text and text_hash)
+
+    returns the rows without their text, ready to insert into messages
+    """
+    message_rows = []
+    texts = {}
+    for row in rows:
+        row = dict(row)
+        texts[row["text_hash"]] = row.pop("message_text")
+        message_rows.append(row)
+    store_texts(conn, texts)
+    return message_rows
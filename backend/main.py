@@ -2,14 +2,65 @@
 # Collect routes and run the FastAPI server
 #####
 
-from fastapi import FastAPI, Request
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-import time
 import logging
 
-from routers import classify, search
+from db.database import IS_ASYNC
+from routers import (
+    classify,
+    search,
+    stats,
+    async_classify,
+    async_search,
+    async_stats,
+    exports,
+    health,
+    ingest,
+    metrics,
+    overview,
+    profiling,
+)
+from services.admission import admission_middleware, configure_threadpool
+from services.exports import fail_interrupted_jobs
+from services.ingest import ingest_queue
+from services.metrics import metrics_middleware
+from services.profiling import SAMPLING_PROFILER, profiling_middleware, stack_sampler
+from services.response_cache import response_cache_middleware
+from services.warmup import warm_up
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_threadpool()
+    # exports left pending/ running by a stopped process would be polled forever
+    await run_in_threadpool(fail_interrupted_jobs)
+    # caches and compiled statements are primed next to the server, /ready tells when
+    warmup = asyncio.create_task(warm_up())
+    if SAMPLING_PROFILER:
+        stack_sampler.start()
+    yield
+    stack_sampler.stop()
+    await warmup
+    # ingested messages that are still queued are written before the process exits
+    await run_in_threadpool(ingest_queue.close)
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# innermost, a profiled request (PROFILE_TOKEN) times its handler, not the admission wait
+app.middleware("http")(profiling_middleware)
+
+# innermost so a response served from the cache never waits for an admission slot,
+# overloaded route classes are answered with a 503 and Retry-After
+app.middleware("http")(admission_middleware)
+
+# registered before the CORS middleware so it runs inside it, cached responses never
+# carry the CORS headers of another origin
+app.middleware("http")(response_cache_middleware)
 
 # CORS middleware to allow local traffic
 origins = [
@@ -26,25 +77,29 @@ app.add_middleware(
 )
 
 
-# middleware to log requests with latency
-# (would be put with other metrics code if there was any)
-LATENT_REQUEST_THRESHOLD_SECONDS = 0.1
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
 )
+# aiosqlite logs every cursor operation at debug level, which would drown out the request logs
+logging.getLogger("aiosqlite").setLevel(logging.INFO)
 
-
-@app.middleware("http")
-async def log_slow_requests(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    if process_time > LATENT_REQUEST_THRESHOLD_SECONDS:
-        logging.warning(f"Slow request '{request.url.path}' took {process_time:.2f}s")
-    else:
-        logging.debug(f"Request '{request.url.path}' took {process_time:.2f}s")
-    return response
+# per route latency, error and SQL metrics (served on /metrics), slow requests are logged
+app.middleware("http")(metrics_middleware)
 
 
-app.include_router(search.router)
-app.include_router(classify.router)
+# an async DB_URL driver serves the same routes with async handlers and sessions
+if IS_ASYNC:
+    app.include_router(async_search.router)
+    app.include_router(async_classify.router)
+    app.include_router(async_stats.router)
+else:
+    app.include_router(search.router)
+    app.include_router(classify.router)
+    app.include_router(stats.router)
+# export jobs, the ingest writer and the physician overviews use sync sessions in both modes
+app.include_router(overview.router)
+app.include_router(exports.router)
+app.include_router(ingest.router)
+app.include_router(metrics.router)
+app.include_router(health.router)
+app.include_router(profiling.router)
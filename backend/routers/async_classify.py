@@ -0,0 +1,159 @@
+#####
+# Async versions of the classify routes, used when DB_URL has an async driver
+#    - the matcher and stored classifications are sync code, they run on the
+#      async connection through AsyncSession.run_sync without blocking the event loop
+#####
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator
+
+from db import database
+from db.database import get_async_db
+from db.models import Message
+from db.partitions import partitions_containing, read_partition_message
+from routers.classify import (
+    BATCH_RESPONSES,
+    ArchivedMessage,
+    ClassifyBatchRequest,
+    ClassifyMessageResponse,
+    ClassifyTextRequest,
+    ClassifyTextResponse,
+    classify_chunk,
+    classify_draft,
+    classify_row,
+    is_chunk_complete,
+    iter_batch_id_chunks,
+    merge_chunk_rows,
+    read_archived_rows,
+    select_archived_chunk,
+    select_batch_chunk,
+    select_chunk_partitions,
+    select_stored_matches,
+    select_stored_matches_of,
+    select_with_classification,
+    validate_batch,
+)
+from services.matcher import get_matcher
+
+router = APIRouter(prefix="/classify", tags=["classify"])
+
+
+async def find_archived_message(
+    db: AsyncSession, message_id: int, compliance_version: str
+) -> ArchivedMessage | None:
+    partitions = (await db.execute(partitions_containing(message_id))).scalars().all()
+    if not partitions:
+        return None
+    # the partition files are read with sync engines, off the event loop
+    found = await run_in_threadpool(read_partition_message, partitions, message_id)
+    if found is None:
+        return None
+    matches = (
+        await db.execute(select_stored_matches(found[1], compliance_version))
+    ).scalar_one_or_none()
+    return ArchivedMessage(*found, matches)
+
+
+async def read_message_chunk(
+    db: AsyncSession,
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> list[tuple[int, int, str, str | None]]:
+    """Async read_message_chunk from routers/classify.py"""
+    stmt = select_batch_chunk(batch, chunk_ids, last_message_id)
+    hot_rows = [tuple(row) for row in await db.execute(stmt)]
+    if is_chunk_complete(chunk_ids, hot_rows):
+        return hot_rows
+    partitions = (
+        (await db.execute(select_chunk_partitions(batch, chunk_ids, last_message_id)))
+        .scalars()
+        .all()
+    )
+    if not partitions:
+        return hot_rows
+    # the partition files are read with sync engines, off the event loop
+    archived_rows = await run_in_threadpool(
+        read_archived_rows,
+        partitions,
+        select_archived_chunk(batch, chunk_ids, last_message_id),
+    )
+    if not archived_rows:
+        return hot_rows
+    text_hashes = {text_hash for _, text_hash, _ in archived_rows}
+    stored = dict(
+        (
+            await db.execute(
+                select_stored_matches_of(text_hashes, batch.compliance_version)
+            )
+        ).all()
+    )
+    return merge_chunk_rows(hot_rows, archived_rows, stored)
+
+
+async def aiter_message_chunks(
+    db: AsyncSession, batch: ClassifyBatchRequest
+) -> AsyncIterator[list[tuple[int, int, str, str | None]]]:
+    """Async iter_message_chunks from routers/classify.py"""
+    if batch.message_ids is not None:
+        for chunk_ids in iter_batch_id_chunks(batch):
+            yield await read_message_chunk(db, batch, chunk_ids, None)
+        return
+
+    last_message_id: int | None = None
+    while True:
+        rows = await read_message_chunk(db, batch, None, last_message_id)
+        if not rows:
+            return
+        yield rows
+        last_message_id = rows[-1][0]
+
+
+@router.post("/batch", response_class=StreamingResponse, responses=BATCH_RESPONSES)
+async def classify_batch(batch: ClassifyBatchRequest):
+    validate_batch(batch)
+
+    async def stream_results() -> AsyncIterator[bytes]:
+        # the response outlives the request scoped dependencies so the stream owns its session
+        async with database.AsyncSessionLocal() as db:  # pyright: ignore (only routed in async mode)
+            # rules are loaded once for the whole batch
+            matcher = await db.run_sync(get_matcher, batch.compliance_version)
+            async for chunk in aiter_message_chunks(db, batch):
+                if chunk:
+                    yield await db.run_sync(
+                        classify_chunk, matcher, batch.compliance_version, chunk
+                    )
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+# declared before /{message_id} so "text" is not read as a message id
+@router.post("/text", response_model=ClassifyTextResponse)
+async def classify_text_draft(
+    request: ClassifyTextRequest, db: AsyncSession = Depends(get_async_db)
+):
+    # a single row lookup of the rules revision, only a new revision builds the matcher
+    matcher = await db.run_sync(get_matcher, request.compliance_version)
+    return classify_draft(matcher, request)
+
+
+@router.post("/{message_id}", response_model=ClassifyMessageResponse)
+async def classify_message(
+    message_id: int,
+    compliance_version: str = "v1",  # assumed that users would only be interested in a single compliance version at a time
+    db: AsyncSession = Depends(get_async_db),
+):
+    # already classified messages are answered by this single primary key lookup
+    message_stmt = select_with_classification(compliance_version).where(
+        Message.message_id == message_id
+    )
+    row = (await db.execute(message_stmt)).one_or_none()
+    if row is None:
+        row = await find_archived_message(db, message_id, compliance_version)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    return await db.run_sync(classify_row, compliance_version, row)
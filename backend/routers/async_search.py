@@ -0,0 +1,95 @@
+#####
+# Async versions of the search routes, used when DB_URL has an async driver
+#    - queries and responses are shared with routers/search.py, only the db calls are awaited
+#####
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+
+from db.database import get_async_read_db
+from db.partitions import partitions_overlapping
+from services.physician_directory import physician_directory
+from routers.search import (
+    DEFAULT_PAGE_LIMIT,
+    DEFAULT_SUGGESTION_LIMIT,
+    MAX_PAGE_LIMIT,
+    MAX_SUGGESTION_LIMIT,
+    SEARCH_QUERY_DESCRIPTION,
+    MessagePage,
+    PhysicianPage,
+    PhysicianSearchResponse,
+    fetch_message_items,
+    merge_message_items,
+    messages_page_items,
+    physician_suggestions,
+    physicians_page,
+    prepare_messages_query,
+    prepare_physicians_query,
+    read_partition_items,
+)
+
+router = APIRouter(prefix="", tags=["search"])
+
+
+@router.get("/physicians", response_model=PhysicianPage)
+async def get_physicians(
+    state: str | None = None,
+    specialty: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: str | None = None,
+    fields: str | None = Query(
+        None, description="Comma separated response fields to return"
+    ),
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    stmt, requested = prepare_physicians_query(state, specialty, limit, cursor, fields)
+    return physicians_page(await db.execute(stmt), limit, requested)
+
+
+@router.get("/physicians/search", response_model=PhysicianSearchResponse)
+async def search_physicians(
+    prefix: str = Query(
+        ...,
+        min_length=1,
+        description="Start of a last name, first name, npi or specialty, every word must match",
+    ),
+    state: str | None = None,
+    specialty: str | None = None,
+    limit: int = Query(DEFAULT_SUGGESTION_LIMIT, ge=1, le=MAX_SUGGESTION_LIMIT),
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    # a rebuild after a data change runs in the threadpool, the rows are read on the loop
+    directory = await physician_directory.current_async(db)
+    return physician_suggestions(directory, prefix, state, specialty, limit)
+
+
+@router.get("/messages", response_model=MessagePage)
+async def get_messages(
+    physician_id: str | None = None,
+    start_date: datetime | None = None,
+    end_date: datetime | None = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: str | None = None,
+    fields: str | None = Query(
+        None, description="Comma separated response fields to return"
+    ),
+    q: str | None = Query(None, min_length=1, description=SEARCH_QUERY_DESCRIPTION),
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    stmt, requested = prepare_messages_query(
+        physician_id, start_date, end_date, limit, cursor, fields, q
+    )
+    ranked = q is not None
+    items = fetch_message_items(await db.execute(stmt), requested)
+    partitions = (
+        (await db.execute(partitions_overlapping(start_date, end_date))).scalars().all()
+    )
+    if partitions:
+        # the partition files are read with sync engines, off the event loop
+        pages = await run_in_threadpool(
+            read_partition_items, partitions, stmt, limit, requested, ranked
+        )
+        items = merge_message_items([items, *pages], limit, requested)
+    return messages_page_items(items, limit, requested, ranked)
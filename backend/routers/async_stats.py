@@ -0,0 +1,44 @@
+#####
+# Async version of the stats route, used when DB_URL has an async driver
+#####
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date
+
+from db.database import get_async_read_db
+from routers.stats import (
+    DEFAULT_STATS_LIMIT,
+    GROUP_BY_DESCRIPTION,
+    MAX_STATS_LIMIT,
+    StatsPage,
+    prepare_stats_query,
+    stats_page,
+)
+
+router = APIRouter(prefix="", tags=["stats"])
+
+
+@router.get("/stats", response_model=StatsPage)
+async def get_stats(
+    group_by: str | None = Query(None, description=GROUP_BY_DESCRIPTION),
+    physician_id: int | None = None,
+    campaign_id: str | None = None,
+    channel: str | None = None,
+    start_date: date | None = None,
+    end_date: date | None = None,
+    limit: int = Query(DEFAULT_STATS_LIMIT, ge=1, le=MAX_STATS_LIMIT),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_read_db),
+):
+    stmt, group_keys = prepare_stats_query(
+        group_by,
+        physician_id,
+        campaign_id,
+        channel,
+        start_date,
+        end_date,
+        limit,
+        cursor,
+    )
+    return stats_page(await db.execute(stmt), limit, group_keys)
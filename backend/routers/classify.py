@@ -1,12 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select, func, literal
-from sqlalchemy.orm import Session, joinedload
-from pydantic import BaseModel
-from itertools import groupby
-from operator import attrgetter
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Row, Select, select, and_
+from sqlalchemy.orm import Session
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import Iterator, NamedTuple, Sequence
 
-from db.database import get_db
-from db.models import Message, Rule, AnyKeyword
+from db.database import get_db, SessionLocal
+from db.models import Message, MessagePartition, TextClassification
+from db.partitions import (
+    partition_engine,
+    partitions_containing,
+    partitions_overlapping,
+    read_partition_message,
+)
+from services.matcher import KeywordMatcher, get_matcher
+from services.classifications import Matches, resolve_classifications
+from services.text_classifications import classify_text
 
 router = APIRouter(prefix="/classify", tags=["classify"])
 
@@ -26,60 +36,398 @@ class ClassifyMessageResponse(BaseModel):
     matched_rules: list[RuleResponse] = []
 
 
-@router.post("/{message_id}", response_model=ClassifyMessageResponse)
-def classify_message(
-    message_id: int,
-    compliance_version: str = "v1",  # assumed that users would only be interested in a single compliance version at a time
-    db: Session = Depends(get_db),
-):
-    message_stmt = select(Message.message_text).where(Message.message_id == message_id)
-    message_text = db.execute(message_stmt).scalar_one_or_none()
-    if message_text is None:
-        raise HTTPException(status_code=404, detail="Message not found")
+class ClassifyBatchRequest(BaseModel):
+    # select the messages either by id or by physician and/or a timestamp range
+    message_ids: list[int] | None = None
+    physician_id: int | None = None
+    start_date: datetime | None = None
+    end_date: datetime | None = None
+    compliance_version: str = "v1"
 
-    keyword_stmt = (
-        select(AnyKeyword)
-        .distinct()
-        .join(Rule)
-        .where(
-            Rule.compliance_version == compliance_version,
-            func.lower(literal(message_text)).contains(func.lower(AnyKeyword.keyword)),
-        )
-        .order_by(
-            Rule.id
-        )  # order by is important for the linear group by Rule.id later
-        .options(joinedload(AnyKeyword.rule))
-    )
 
-    matching_keywords = db.execute(keyword_stmt).scalars()
+# number of messages loaded from the db and classified at a time
+BATCH_CHUNK_SIZE = 500
+
+# longer drafts would hold a worker for a long single pass
+MAX_CLASSIFY_TEXT_LENGTH = 100_000
 
+
+class ArchivedMessage(NamedTuple):
+    """A message of a monthly partition in the shape of select_with_classification"""
+
+    message_id: int
+    text_hash: int
+    message_text: str
+    matches: str | None
+
+
+class ClassifyTextRequest(BaseModel):
+    text: str = Field(max_length=MAX_CLASSIFY_TEXT_LENGTH)
+    compliance_version: str = "v1"
+
+
+class ClassifyTextResponse(BaseModel):
+    compliance_version: str
+    matched_rules: list[RuleResponse] = []
+
+
+def build_rule_responses(
+    matcher: KeywordMatcher, matches: Matches
+) -> list[RuleResponse]:
     # it could be dangerous to expose the reason why a message triggers a certain
     # rule, for this exercise i've chosen to expose the keyword(s) that match and
     # not any other keywords (mainly because that was the most fun to implement)
 
     matched_rules_response: list[RuleResponse] = []
 
-    # group the keywords by their rule id, since we do not want to expose all trigger keywords
-    # this has to be done here instead of just joinedloading the keywords from rule
-    for _, group in groupby(matching_keywords, key=attrgetter("rule.id")):
-        keywords_for_rule = list(group)
-
-        # each object has the same rule
-        first_keyword_in_group = keywords_for_rule[0]
-        associated_rule = first_keyword_in_group.rule
+    # the matches are already grouped by their rule id, since we do not want to expose all trigger keywords
+    for rule_id, keywords_for_rule in matches.items():
+        # a stored result can name a rule of a newer revision than the matcher
+        associated_rule = matcher.rules.get(rule_id)
+        if associated_rule is None:
+            continue
 
         rule_response = RuleResponse(
             id=associated_rule.id,
             name=associated_rule.name,
             result_type=associated_rule.result_type,
             result_text=associated_rule.result_text,
-            matched_keywords=[k.keyword for k in keywords_for_rule],
+            matched_keywords=keywords_for_rule,
         )
         matched_rules_response.append(rule_response)
+    return matched_rules_response
+
 
+def build_classify_response(
+    matcher: KeywordMatcher,
+    message_id: int,
+    message_text: str,
+    compliance_version: str,
+    matches: Matches,
+) -> ClassifyMessageResponse:
     return ClassifyMessageResponse(
         message_id=message_id,
         message_text=message_text,
         compliance_version=compliance_version,
-        matched_rules=matched_rules_response,
+        matched_rules=build_rule_responses(matcher, matches),
+    )
+
+
+def select_with_classification(compliance_version: str):
+    """(message_id, text_hash, message_text, stored matches or None) through primary key joins"""
+    return select(
+        Message.message_id,
+        Message.text_hash,
+        Message.message_text,
+        TextClassification.matches,
+    ).outerjoin(
+        TextClassification,
+        and_(
+            TextClassification.text_hash == Message.text_hash,
+            TextClassification.compliance_version == compliance_version,
+        ),
+    )
+
+
+def select_stored_matches(text_hash: int, compliance_version: str):
+    return select(TextClassification.matches).where(
+        TextClassification.text_hash == text_hash,
+        TextClassification.compliance_version == compliance_version,
+    )
+
+
+def find_archived_message(
+    db: Session, message_id: int, compliance_version: str
+) -> ArchivedMessage | None:
+    """A message moved to a partition, its classification stays in the main database"""
+    partitions = db.execute(partitions_containing(message_id)).scalars().all()
+    found = read_partition_message(partitions, message_id) if partitions else None
+    if found is None:
+        return None
+    matches = db.execute(
+        select_stored_matches(found[1], compliance_version)
+    ).scalar_one_or_none()
+    return ArchivedMessage(*found, matches)
+
+
+def validate_batch(batch: ClassifyBatchRequest):
+    has_range = batch.physician_id is not None or (
+        batch.start_date is not None or batch.end_date is not None
+    )
+    if (batch.message_ids is None) == (not has_range):
+        raise HTTPException(
+            status_code=400,
+            detail="Select messages either by message_ids or by physician_id/start_date/end_date",
+        )
+    is_full_range_set = (batch.start_date is not None) and (batch.end_date is not None)
+    if is_full_range_set and batch.start_date > batch.end_date:  # pyright: ignore
+        raise HTTPException(
+            status_code=400, detail="Start date must come before end date"
+        )
+
+
+def iter_batch_id_chunks(batch: ClassifyBatchRequest) -> Iterator[list[int]]:
+    message_ids = sorted(set(batch.message_ids or []))
+    for start in range(0, len(message_ids), BATCH_CHUNK_SIZE):
+        yield message_ids[start : start + BATCH_CHUNK_SIZE]
+
+
+def filter_batch_chunk(
+    stmt: Select,
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> Select:
+    """A chunk of either the given ids or, keyset paginated on the message id, the physician/ date range"""
+    stmt = stmt.order_by(Message.message_id)
+    if chunk_ids is not None:
+        return stmt.where(Message.message_id.in_(chunk_ids))
+
+    if batch.physician_id is not None:
+        stmt = stmt.filter(Message.physician_id == batch.physician_id)
+    if batch.start_date is not None:
+        stmt = stmt.filter(Message.timestamp >= batch.start_date)
+    if batch.end_date is not None:
+        stmt = stmt.filter(Message.timestamp <= batch.end_date)
+    if last_message_id is not None:
+        stmt = stmt.filter(Message.message_id > last_message_id)
+    return stmt.limit(BATCH_CHUNK_SIZE)
+
+
+def select_batch_chunk(
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> Select:
+    return filter_batch_chunk(
+        select_with_classification(batch.compliance_version),
+        batch,
+        chunk_ids,
+        last_message_id,
+    )
+
+
+def select_archived_chunk(
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> Select:
+    """The chunk in a partition file, its classifications are in the main database"""
+    stmt = select(Message.message_id, Message.text_hash, Message.message_text)
+    return filter_batch_chunk(stmt, batch, chunk_ids, last_message_id)
+
+
+def select_chunk_partitions(
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> Select:
+    """Catalog rows of the partitions that can hold messages of the chunk"""
+    if chunk_ids is not None:
+        return select(MessagePartition).where(
+            MessagePartition.min_message_id <= chunk_ids[-1],
+            MessagePartition.max_message_id >= chunk_ids[0],
+        )
+    stmt = partitions_overlapping(batch.start_date, batch.end_date)
+    if last_message_id is not None:
+        stmt = stmt.where(MessagePartition.max_message_id > last_message_id)
+    return stmt
+
+
+def select_stored_matches_of(text_hashes: set[int], compliance_version: str):
+    return select(TextClassification.text_hash, TextClassification.matches).where(
+        TextClassification.text_hash.in_(text_hashes),
+        TextClassification.compliance_version == compliance_version,
     )
+
+
+def is_chunk_complete(chunk_ids: list[int] | None, hot_rows: list) -> bool:
+    # every id of the chunk is in the hot table, no partition has to be opened
+    return chunk_ids is not None and len(hot_rows) == len(chunk_ids)
+
+
+def read_archived_rows(
+    partitions: Sequence[MessagePartition], stmt: Select
+) -> list[tuple[int, int, str]]:
+    """(message_id, text_hash, message_text) rows of the chunk statement in every partition"""
+    rows = []
+    for partition in partitions:
+        with partition_engine(partition).connect() as conn:
+            rows.extend(tuple(row) for row in conn.execute(stmt))
+    return rows
+
+
+def merge_chunk_rows(
+    hot_rows: list, archived_rows: list[tuple[int, int, str]], stored: dict[int, str]
+) -> list[tuple[int, int, str, str | None]]:
+    """The first BATCH_CHUNK_SIZE rows by message id of the hot and the archived rows"""
+    # a month archived between reading the hot table and the catalog is read twice
+    rows = {
+        message_id: (message_id, text_hash, message_text, stored.get(text_hash))
+        for message_id, text_hash, message_text in archived_rows
+    }
+    rows.update((row[0], row) for row in hot_rows)
+    return [rows[message_id] for message_id in sorted(rows)][:BATCH_CHUNK_SIZE]
+
+
+def read_message_chunk(
+    db: Session,
+    batch: ClassifyBatchRequest,
+    chunk_ids: list[int] | None,
+    last_message_id: int | None,
+) -> list[tuple[int, int, str, str | None]]:
+    """A chunk of the hot messages merged with the messages of the monthly partitions"""
+    stmt = select_batch_chunk(batch, chunk_ids, last_message_id)
+    hot_rows = [tuple(row) for row in db.execute(stmt)]
+    if is_chunk_complete(chunk_ids, hot_rows):
+        return hot_rows
+    # the hot table is read before the catalog, see merge_chunk_rows
+    partitions = (
+        db.execute(select_chunk_partitions(batch, chunk_ids, last_message_id))
+        .scalars()
+        .all()
+    )
+    if not partitions:
+        return hot_rows
+    archived_rows = read_archived_rows(
+        partitions, select_archived_chunk(batch, chunk_ids, last_message_id)
+    )
+    if not archived_rows:
+        return hot_rows
+    text_hashes = {text_hash for _, text_hash, _ in archived_rows}
+    stored = dict(
+        db.execute(
+            select_stored_matches_of(text_hashes, batch.compliance_version)
+        ).all()
+    )
+    return merge_chunk_rows(hot_rows, archived_rows, stored)
+
+
+def iter_message_chunks(
+    db: Session, batch: ClassifyBatchRequest
+) -> Iterator[list[tuple[int, int, str, str | None]]]:
+    """Yields (message_id, text_hash, message_text, stored matches) rows in chunks ordered by message id"""
+    if batch.message_ids is not None:
+        for chunk_ids in iter_batch_id_chunks(batch):
+            yield read_message_chunk(db, batch, chunk_ids, None)
+        return
+
+    # keyset pagination on the message id so each chunk is a bounded query
+    last_message_id: int | None = None
+    while True:
+        rows = read_message_chunk(db, batch, None, last_message_id)
+        if not rows:
+            return
+        yield rows
+        last_message_id = rows[-1][0]
+
+
+def classify_chunk(
+    db: Session,
+    matcher: KeywordMatcher,
+    compliance_version: str,
+    chunk: list[tuple[int, int, str, str | None]],
+) -> bytes:
+    """NDJSON lines for a chunk of rows, stored results are reused and the rest are classified and stored"""
+    if not chunk:
+        return b""
+    matches = resolve_classifications(db, matcher, compliance_version, chunk)
+    db.commit()
+    lines = [
+        build_classify_response(
+            matcher, message_id, message_text, compliance_version, message_matches
+        ).model_dump_json()
+        for (message_id, _, message_text, _), message_matches in zip(chunk, matches)
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def require_rules(matcher: KeywordMatcher) -> KeywordMatcher:
+    # a typo in the version would otherwise be answered as matching no rule
+    if not matcher.rules:
+        raise HTTPException(status_code=400, detail="Unknown compliance version")
+    return matcher
+
+
+def classify_row(
+    db: Session, compliance_version: str, row: Row | ArchivedMessage
+) -> ClassifyMessageResponse:
+    """Response for a (message_id, text_hash, message_text, stored matches) row"""
+    # the keywords of the compliance version are compiled once into an automaton
+    # so classifying is a single pass over the text without any keyword sql
+    matcher = get_matcher(db, compliance_version)
+    [matches] = resolve_classifications(db, matcher, compliance_version, [tuple(row)])
+    if row.matches is None:
+        db.commit()
+
+    return build_classify_response(
+        matcher, row.message_id, row.message_text, compliance_version, matches
+    )
+
+
+def classify_draft(
+    matcher: KeywordMatcher, request: ClassifyTextRequest
+) -> ClassifyTextResponse:
+    # unlike a stored message a draft is checked before it is sent, a typo in the
+    # version must not pass it with no rules
+    require_rules(matcher)
+    matches = classify_text(matcher, request.compliance_version, request.text)
+    return ClassifyTextResponse(
+        compliance_version=request.compliance_version,
+        matched_rules=build_rule_responses(matcher, matches),
+    )
+
+
+# the batch response documentation is shared with the async router
+BATCH_RESPONSES: dict = {
+    200: {
+        "description": "One ClassifyMessageResponse per line (NDJSON) ordered by message id, unknown message ids are skipped",
+        "content": {"application/x-ndjson": {}},
+    }
+}
+
+
+@router.post("/batch", response_class=StreamingResponse, responses=BATCH_RESPONSES)
+def classify_batch(batch: ClassifyBatchRequest):
+    validate_batch(batch)
+
+    def stream_results() -> Iterator[bytes]:
+        # the response outlives the request scoped dependencies so the stream owns its session
+        db = SessionLocal()
+        try:
+            # rules are loaded once for the whole batch
+            matcher = get_matcher(db, batch.compliance_version)
+            for chunk in iter_message_chunks(db, batch):
+                if chunk:
+                    yield classify_chunk(db, matcher, batch.compliance_version, chunk)
+        finally:
+            db.close()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+# declared before /{message_id} so "text" is not read as a message id
+@router.post("/text", response_model=ClassifyTextResponse)
+def classify_text_draft(request: ClassifyTextRequest, db: Session = Depends(get_db)):
+    """Classifies a draft that is not stored, repeated texts are answered from an in memory cache"""
+    matcher = get_matcher(db, request.compliance_version)
+    return classify_draft(matcher, request)
+
+
+@router.post("/{message_id}", response_model=ClassifyMessageResponse)
+def classify_message(
+    message_id: int,
+    compliance_version: str = "v1",  # assumed that users would only be interested in a single compliance version at a time
+    db: Session = Depends(get_db),
+):
+    # already classified messages are answered by this single primary key lookup
+    message_stmt = select_with_classification(compliance_version).where(
+        Message.message_id == message_id
+    )
+    row = db.execute(message_stmt).one_or_none()
+    if row is None:
+        row = find_archived_message(db, message_id, compliance_version)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    return classify_row(db, compliance_version, row)
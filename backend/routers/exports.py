@@ -0,0 +1,118 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Literal, Optional
+
+from db.database import get_db
+from db.models import ComplianceVersion, ExportJob
+from services.exports import create_export_job, export_path
+
+router = APIRouter(prefix="/exports", tags=["exports"])
+
+
+class ExportRequest(BaseModel):
+    # every message of the physician and/or timestamp range, all messages when none are set
+    physician_id: int | None = None
+    start_date: datetime | None = None
+    end_date: datetime | None = None
+    compliance_version: str = "v1"
+    format: Literal["csv", "ndjson"] = "csv"
+
+
+class ExportJobResponse(BaseModel):
+    job_id: str
+    # pending, running, completed or failed
+    status: str
+    format: str
+    compliance_version: str
+    physician_id: Optional[int] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    # counted when the job starts running
+    total_rows: Optional[int] = None
+    rows_written: int
+    # compressed size of the file so far
+    bytes_written: int
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    # set once the job is completed
+    download_url: Optional[str] = None
+
+    @staticmethod
+    def from_db(job: ExportJob) -> "ExportJobResponse":
+        return ExportJobResponse(
+            job_id=job.job_id,
+            status=job.status,
+            format=job.format,
+            compliance_version=job.compliance_version,
+            physician_id=job.physician_id,
+            start_date=job.start_date,
+            end_date=job.end_date,
+            total_rows=job.total_rows,
+            rows_written=job.rows_written,
+            bytes_written=job.bytes_written,
+            error=job.error,
+            created_at=job.created_at,
+            finished_at=job.finished_at,
+            download_url=(
+                f"/exports/{job.job_id}/download" if job.status == "completed" else None
+            ),
+        )
+
+
+def get_export_job(db: Session, job_id: str) -> ExportJob:
+    job = db.get(ExportJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return job
+
+
+@router.post("", response_model=ExportJobResponse, status_code=202)
+def create_export(export: ExportRequest, db: Session = Depends(get_db)):
+    """Starts a background export of the matching messages with their classification, poll the returned job for its progress"""
+    is_full_range_set = (export.start_date is not None) and (
+        export.end_date is not None
+    )
+    if is_full_range_set and export.start_date > export.end_date:  # pyright: ignore
+        raise HTTPException(
+            status_code=400, detail="Start date must come before end date"
+        )
+    if db.get(ComplianceVersion, export.compliance_version) is None:
+        raise HTTPException(status_code=400, detail="Unknown compliance version")
+
+    job = create_export_job(
+        db,
+        export.format,
+        export.compliance_version,
+        export.physician_id,
+        export.start_date,
+        export.end_date,
+    )
+    return ExportJobResponse.from_db(job)
+
+
+@router.get("/{job_id}", response_model=ExportJobResponse)
+def get_export(job_id: str, db: Session = Depends(get_db)):
+    return ExportJobResponse.from_db(get_export_job(db, job_id))
+
+
+@router.get(
+    "/{job_id}/download",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "The gzip compressed file, Range requests get a 206"}
+    },
+)
+def download_export(job_id: str, db: Session = Depends(get_db)):
+    job = get_export_job(db, job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Export is {job.status}")
+    path = export_path(job)
+    if not path.exists():
+        # e.g. the export directory of another machine or a cleaned up file
+        raise HTTPException(status_code=404, detail="Export file not found")
+    # FileResponse answers Range requests (206) and sends Accept-Ranges
+    return FileResponse(path, media_type="application/gzip", filename=path.name)
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from services.warmup import warmup_state
+
+router = APIRouter(prefix="", tags=["health"])
+
+
+class ReadyResponse(BaseModel):
+    status: str
+    # None when the warm-up is turned off (WARMUP=0)
+    warmup_seconds: float | None = None
+    warmup_steps: dict[str, float]
+
+
+@router.get(
+    "/ready",
+    response_model=ReadyResponse,
+    responses={503: {"description": "The startup warm-up is running or failed"}},
+)
+def get_ready():
+    """Readiness probe, ready once the startup warm-up has finished"""
+    if warmup_state.error is not None:
+        raise HTTPException(
+            status_code=503, detail=f"Warm-up failed: {warmup_state.error}"
+        )
+    if not warmup_state.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return ReadyResponse(
+        status="ready",
+        warmup_seconds=warmup_state.seconds,
+        warmup_steps=warmup_state.steps,
+    )
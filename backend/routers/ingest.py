@@ -0,0 +1,88 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
+
+from db.manage import Message
+from services.ingest import INGEST_RETRY_AFTER, ingest_queue
+
+router = APIRouter(prefix="/messages", tags=["ingest"])
+
+
+class IngestResponse(BaseModel):
+    accepted: int
+    # messages waiting for the writer, these included
+    queued: int
+
+
+INGEST_REQUEST_BODY: dict = {
+    "requestBody": {
+        "description": "One message per line (NDJSON) in the messages.csv shape of db/manage.py",
+        "required": True,
+        "content": {"application/x-ndjson": {"schema": {"type": "string"}}},
+    }
+}
+
+
+# optional fields of the csv shape the messages table requires, an empty csv column loads
+# as "" so a field left out of a line is stored the same way
+EMPTY_TEXT_COLUMNS = (
+    "campaign_id",
+    "topic",
+    "compliance_tag",
+    "sentiment",
+    "delivery_status",
+)
+
+
+def format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, detail['loc'])) or 'message'}: {detail['msg']}"
+        for detail in error.errors()
+    )
+
+
+def parse_ingest_body(body: bytes) -> list[dict]:
+    """Validated db rows of every NDJSON line, the batch is rejected as a whole"""
+    rows = []
+    for line_number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = Message.model_validate_json(line).to_db()
+        except ValidationError as error:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Line {line_number}: {format_validation_error(error)}",
+            )
+        for column in EMPTY_TEXT_COLUMNS:
+            if row[column] is None:
+                row[column] = ""
+        rows.append(row)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No messages in the request body")
+    return rows
+
+
+@router.post(
+    "/ingest",
+    response_model=IngestResponse,
+    status_code=202,
+    openapi_extra=INGEST_REQUEST_BODY,
+    responses={429: {"description": "The ingest queue is full, retry after a while"}},
+)
+async def ingest_messages(request: Request):
+    """Queues a batch of new messages, they are written and classified in the background"""
+    # validating a large batch would hold up the event loop
+    rows = await run_in_threadpool(parse_ingest_body, await request.body())
+    if len(rows) > ingest_queue.max_messages:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {ingest_queue.max_messages} messages per request",
+        )
+    if not ingest_queue.offer(rows):
+        raise HTTPException(
+            status_code=429,
+            detail="Ingest queue is full",
+            headers={"Retry-After": str(INGEST_RETRY_AFTER)},
+        )
+    return IngestResponse(accepted=len(rows), queued=len(ingest_queue))
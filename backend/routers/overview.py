@@ -0,0 +1,245 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
+from sqlalchemy import Select, select, tuple_, union_all
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Optional
+
+from db.database import get_db
+from db.models import Message, MessageText, Physician, TextClassification
+from db.partitions import partition_engine, partitions_overlapping
+from routers.classify import RuleResponse, build_rule_responses, require_rules
+from routers.search import (
+    MESSAGE_FIELDS,
+    MESSAGE_TIMESTAMP_TEXT,
+    PHYSICIAN_FIELDS,
+    MessageResponse,
+    PhysicianResponse,
+    decode_timestamp_cursor,
+    encode_cursor,
+)
+from services.classifications import resolve_classifications
+from services.matcher import KeywordMatcher, get_matcher
+
+router = APIRouter(prefix="/physicians", tags=["overview"])
+
+
+class OverviewMessageResponse(MessageResponse):
+    matched_rules: list[RuleResponse] = []
+
+
+class PhysicianOverview(BaseModel):
+    physician: PhysicianResponse
+    compliance_version: str
+    # most recent first
+    messages: list[OverviewMessageResponse]
+    # pass back as `cursor` to get older messages, None when there are none
+    next_cursor: Optional[str] = None
+
+
+DEFAULT_MESSAGE_LIMIT = 20
+MAX_MESSAGE_LIMIT = 100
+MAX_BATCH_PHYSICIANS = 50
+
+
+class PhysicianOverviewBatchRequest(BaseModel):
+    physician_ids: list[int] = Field(min_length=1, max_length=MAX_BATCH_PHYSICIANS)
+    compliance_version: str = "v1"
+    limit: int = Field(DEFAULT_MESSAGE_LIMIT, ge=1, le=MAX_MESSAGE_LIMIT)
+
+
+class PhysicianOverviewBatch(BaseModel):
+    # in the order of the request, unknown physician ids are skipped
+    items: list[PhysicianOverview]
+
+
+##
+# Loading the overviews of any number of physicians in a fixed number of statements
+##
+
+# every message field but the text, it is joined once the page rows are known
+PAGE_FIELDS = [field for field in MESSAGE_FIELDS if field != "message_text"]
+
+
+def recent_messages_stmt(
+    physician_ids: list[int], limit: int, before: tuple[datetime, int] | None
+) -> Select:
+    """The limit + 1 most recent messages of each physician in one statement
+
+    a branch per physician walks its (physician_id, timestamp) index backwards and stops
+    after limit + 1 rows, a window over every message of the physicians would read them all
+    """
+    branches = []
+    for physician_id in physician_ids:
+        branch = select(
+            MESSAGE_TIMESTAMP_TEXT,
+            Message.text_hash,
+            *(MESSAGE_FIELDS[field] for field in PAGE_FIELDS),
+        ).where(Message.physician_id == physician_id)
+        if before is not None:
+            branch = branch.where(
+                tuple_(Message.timestamp, Message.message_id) < tuple_(*before)
+            )
+        branch = branch.order_by(
+            Message.timestamp.desc(), Message.message_id.desc()
+        ).limit(limit + 1)
+        # sqlite only allows a limit on a compound select member inside a subquery
+        branches.append(select(branch.subquery()))
+    recent = union_all(*branches).subquery("recent")
+    return select(recent, MessageText.message_text).join(
+        MessageText, MessageText.text_hash == recent.c.text_hash
+    )
+
+
+def read_recent_messages(
+    db: Session,
+    physician_ids: list[int],
+    limit: int,
+    before: tuple[datetime, int] | None,
+) -> dict[int, list]:
+    """physician id -> its limit + 1 most recent message rows, newest first"""
+    pages: dict[int, list] = {physician_id: [] for physician_id in physician_ids}
+    for row in db.execute(recent_messages_stmt(physician_ids, limit, before)):
+        pages[row.physician_id].append(row)
+
+    # the hot table is read before the catalog (a month archived in between is read twice),
+    # partitions are only opened for physicians short of a full page, newest month first
+    before_timestamp = before[0] if before is not None else None
+    partitions = (
+        db.execute(partitions_overlapping(None, before_timestamp)).scalars().all()
+    )
+    short_ids = [id_ for id_, rows in pages.items() if len(rows) <= limit]
+    for partition in reversed(partitions):
+        if not short_ids:
+            break
+        with Session(partition_engine(partition)) as partition_db:
+            stmt = recent_messages_stmt(short_ids, limit, before)
+            for row in partition_db.execute(stmt):
+                pages[row.physician_id].append(row)
+        short_ids = [id_ for id_ in short_ids if len(pages[id_]) <= limit]
+
+    for physician_id, rows in pages.items():
+        # a month archived between reading the hot table and the catalog is read twice
+        unique_rows = {row.message_id: row for row in rows}.values()
+        pages[physician_id] = sorted(
+            unique_rows,
+            key=lambda row: (row.timestamp_text, row.message_id),
+            reverse=True,
+        )[: limit + 1]
+    return pages
+
+
+def resolve_page_matches(
+    db: Session, matcher: KeywordMatcher, compliance_version: str, rows: list
+) -> list:
+    """Matches of the page rows, texts without a stored result are classified and stored"""
+    if not rows:
+        return []
+    text_hashes = {row.text_hash for row in rows}
+    stored = dict(
+        db.execute(
+            select(TextClassification.text_hash, TextClassification.matches).where(
+                TextClassification.compliance_version == compliance_version,
+                TextClassification.text_hash.in_(text_hashes),
+            )
+        ).all()
+    )
+    matches = resolve_classifications(
+        db,
+        matcher,
+        compliance_version,
+        [
+            (row.message_id, row.text_hash, row.message_text, stored.get(row.text_hash))
+            for row in rows
+        ],
+    )
+    if len(stored) < len(text_hashes):
+        db.commit()
+    return matches
+
+
+def load_overviews(
+    db: Session,
+    physician_ids: list[int],
+    compliance_version: str,
+    limit: int,
+    before: tuple[datetime, int] | None = None,
+) -> list[PhysicianOverview]:
+    """Overviews of the physicians that exist, in the order of the ids"""
+    matcher = require_rules(get_matcher(db, compliance_version))
+
+    physician_ids = list(dict.fromkeys(physician_ids))
+    physicians = {
+        row.physician_id: row
+        for row in db.execute(
+            select(*PHYSICIAN_FIELDS.values()).where(
+                Physician.physician_id.in_(physician_ids)
+            )
+        )
+    }
+    physician_ids = [id_ for id_ in physician_ids if id_ in physicians]
+    if not physician_ids:
+        return []
+
+    pages = read_recent_messages(db, physician_ids, limit, before)
+    rows = [row for page in pages.values() for row in page[:limit]]
+    matches = dict(
+        zip(
+            (row.message_id for row in rows),
+            resolve_page_matches(db, matcher, compliance_version, rows),
+        )
+    )
+
+    overviews = []
+    for physician_id in physician_ids:
+        page = pages[physician_id]
+        next_cursor = None
+        if len(page) > limit:
+            last = page[limit - 1]
+            last_timestamp = datetime.fromisoformat(last.timestamp_text)
+            next_cursor = encode_cursor(last_timestamp.isoformat(), last.message_id)
+        messages = [
+            OverviewMessageResponse(
+                **{field: row._mapping[field] for field in MESSAGE_FIELDS},
+                matched_rules=build_rule_responses(matcher, matches[row.message_id]),
+            )
+            for row in page[:limit]
+        ]
+        overviews.append(
+            PhysicianOverview(
+                physician=PhysicianResponse(**physicians[physician_id]._mapping),
+                compliance_version=compliance_version,
+                messages=messages,
+                next_cursor=next_cursor,
+            )
+        )
+    return overviews
+
+
+@router.post("/overview", response_model=PhysicianOverviewBatch)
+def get_physician_overviews(
+    request: PhysicianOverviewBatchRequest, db: Session = Depends(get_db)
+):
+    """Overviews of many physicians, the same statements as a single one"""
+    items = load_overviews(
+        db, request.physician_ids, request.compliance_version, request.limit
+    )
+    return PhysicianOverviewBatch(items=items)
+
+
+@router.get("/{physician_id}/overview", response_model=PhysicianOverview)
+def get_physician_overview(
+    physician_id: int,
+    compliance_version: str = "v1",
+    limit: int = Query(DEFAULT_MESSAGE_LIMIT, ge=1, le=MAX_MESSAGE_LIMIT),
+    cursor: str | None = None,
+    db: Session = Depends(get_db),
+):
+    """The physician, its most recent messages and their classifications"""
+    before = None
+    if cursor is not None:
+        before = decode_timestamp_cursor(cursor)
+    overviews = load_overviews(db, [physician_id], compliance_version, limit, before)
+    if not overviews:
+        raise HTTPException(status_code=404, detail="Physician not found")
+    return overviews[0]
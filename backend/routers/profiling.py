@@ -0,0 +1,55 @@
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from services.profiling import (
+    collapsed_stacks,
+    profiling_enabled,
+    read_report,
+    stack_sampler,
+    valid_token,
+    write_flamegraph,
+)
+
+
+def require_profile_token(x_profile_token: str | None = Header(default=None)):
+    # without PROFILE_TOKEN the debug routes do not exist as far as clients can tell
+    if not profiling_enabled():
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not valid_token(x_profile_token):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+
+router = APIRouter(
+    prefix="/debug",
+    tags=["debug"],
+    dependencies=[Depends(require_profile_token)],
+)
+
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(profile_id: str):
+    """Call tree report of a profiled request (the X-Profile-Id of its response)"""
+    report = read_report(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(report)
+
+
+@router.post("/flamegraph", response_class=PlainTextResponse)
+def take_flamegraph():
+    """Collapsed stacks sampled since the previous call, also written to PROFILE_DIR"""
+    if not stack_sampler.running:
+        raise HTTPException(
+            status_code=409,
+            detail="The sampling profiler is not running (SAMPLING_PROFILER=1)",
+        )
+    samples, sample_count, seconds = stack_sampler.take()
+    path = write_flamegraph(samples)
+    return PlainTextResponse(
+        collapsed_stacks(samples),
+        headers={
+            "x-flamegraph-path": path,
+            "x-sample-count": str(sample_count),
+            "x-sampled-seconds": f"{seconds:.1f}",
+        },
+    )
@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+from sqlalchemy import Result, Select, String, case, func, select, tuple_, type_coerce
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Callable, Optional, Sequence
 from datetime import datetime
+from operator import itemgetter
+import base64
+import binascii
+import heapq
+import json
+import os
+import sqlite3
+import threading
 
-from db.database import get_db
-from db.models import Physician, Message
+from db.database import get_read_db
+from db.models import MessagePartition, Physician, Message, messages_fts
+from db.partitions import partition_engine, partitions_overlapping
+from services.physician_directory import PhysicianDirectory, physician_directory
 
 
 router = APIRouter(prefix="", tags=["search"])
@@ -38,6 +49,14 @@ class PhysicianResponse(BaseModel):
         )
 
 
+def format_timestamp(timestamp: datetime) -> str:
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S")  # same format as sample data
+
+
+def format_direction(is_outbound: bool) -> str:
+    return "outbound" if is_outbound else "inbound"
+
+
 class MessageResponse(BaseModel):
     message_id: int
     physician_id: int
@@ -58,10 +77,8 @@ class MessageResponse(BaseModel):
             message_id=message.message_id,
             physician_id=message.physician_id,
             channel=message.channel,
-            direction="outbound" if message.is_outbound else "inbound",
-            timestamp=message.timestamp.strftime(
-                "%Y-%m-%dT%H:%M:%S"
-            ),  # same format as sample data
+            direction=format_direction(message.is_outbound),
+            timestamp=format_timestamp(message.timestamp),
             message_text=message.message_text,
             campaign_id=message.campaign_id,
             topic=message.topic,
@@ -72,30 +89,334 @@ class MessageResponse(BaseModel):
         )
 
 
-@router.get("/physicians", response_model=list[PhysicianResponse])
-def get_physicians(
-    state: str | None = None,
-    specialty: str | None = None,
-    db: Session = Depends(get_db),
-):
-    stmt = select(Physician)
+class PhysicianPage(BaseModel):
+    items: list[PhysicianResponse]
+    # pass back as `cursor` to get the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+class PhysicianSearchResponse(BaseModel):
+    items: list[PhysicianResponse]
+
+
+class MessagePage(BaseModel):
+    items: list[MessageResponse]
+    # pass back as `cursor` to get the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+##
+# Pagination and projection helpers
+##
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+# type-ahead suggestions, not pages
+DEFAULT_SUGGESTION_LIMIT = 20
+MAX_SUGGESTION_LIMIT = 100
+
+SEARCH_QUERY_DESCRIPTION = (
+    'Full text search of the message text, e.g. `dosing`, `titr*` or `"clinical trial"`,'
+    " results are ordered by relevance"
+)
+
+# when on, full pages are selected as plain rows and encoded straight to json bytes
+# instead of building a response model per row that fastapi then validates again,
+# the output is byte identical and the documented response models are unchanged
+FAST_SERIALIZATION = os.environ.get("FAST_SERIALIZATION", "1") != "0"
+
+# response field -> column to select, every value is already in its response format
+# so rows can be encoded without any per row conversion
+PHYSICIAN_FIELDS: dict[str, Any] = {
+    "physician_id": Physician.physician_id,
+    "npi": Physician.npi,
+    "first_name": Physician.first_name,
+    "last_name": Physician.last_name,
+    "specialty": Physician.specialty,
+    "state": Physician.state,
+    "consent_opt_in": Physician.consent_opt_in,
+    "preferred_channel": Physician.preferred_channel,
+}
+
+MESSAGE_FIELDS: dict[str, Any] = {
+    "message_id": Message.message_id,
+    "physician_id": Message.physician_id,
+    "channel": Message.channel,
+    "direction": case((Message.is_outbound, "outbound"), else_="inbound").label(
+        "direction"
+    ),
+    # same format as format_timestamp, without parsing every value into a datetime
+    "timestamp": func.strftime("%Y-%m-%dT%H:%M:%S", Message.timestamp).label(
+        "timestamp"
+    ),
+    "message_text": Message.message_text,
+    "campaign_id": Message.campaign_id,
+    "topic": Message.topic,
+    "compliance_tag": Message.compliance_tag,
+    "sentiment": Message.sentiment,
+    "delivery_status": Message.delivery_status,
+    "response_latency_sec": Message.response_latency_sec,
+}
+
+# the stored timestamp text, only the last row of a page is parsed for its cursor
+MESSAGE_TIMESTAMP_TEXT = type_coerce(Message.timestamp, String).label("timestamp_text")
+
+
+def encode_cursor(*values: Any) -> str:
+    # opaque to clients so the ordering can change without breaking them
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+# a cursor value that can be bound as a parameter, e.g. a group key of /stats
+CURSOR_SCALAR = (str, int, float)
+
+
+def decode_cursor(cursor: str, *types: type | tuple[type, ...]) -> list[Any]:
+    """Values of a cursor from encode_cursor, a 400 unless there is one value of each type"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        # json true and false are python ints too, never a valid cursor value
+        or not all(
+            isinstance(value, value_type) and not isinstance(value, bool)
+            for value, value_type in zip(values, types)
+        )
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def decode_timestamp_cursor(cursor: str) -> tuple[datetime, int]:
+    """(timestamp, message id) of the last message of a page in timestamp order"""
+    last_timestamp, last_message_id = decode_cursor(cursor, str, int)
+    try:
+        return datetime.fromisoformat(last_timestamp), last_message_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
+
+
+def parse_fields(fields: str | None, known_fields: dict) -> list[str] | None:
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in known_fields]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return requested
+
+
+def resolve_fields(fields: str | None, known_fields: dict) -> list[str] | None:
+    """Fields to select as plain rows, None when full objects are selected"""
+    requested = parse_fields(fields, known_fields)
+    if requested is None and FAST_SERIALIZATION:
+        return list(known_fields)
+    return requested
+
+
+def project_rows(rows, requested: list[str], offset: int) -> list[dict[str, Any]]:
+    """Rows selected as (*key columns, *requested columns) -> response dicts with only the requested fields"""
+    return [dict(zip(requested, row[offset:])) for row in rows]
+
+
+def has_like_wildcards(pattern: str) -> bool:
+    return "%" in pattern or "_" in pattern
+
+
+def build_physicians_stmt(
+    state: str | None,
+    specialty: str | None,
+    last_physician_id: int | None,
+    requested: list[str] | None,
+) -> Select:
+    if requested is None:
+        stmt = select(Physician)
+    else:
+        # the physician id is always needed for the cursor
+        stmt = select(
+            Physician.physician_id, *(PHYSICIAN_FIELDS[f] for f in requested)
+        )
+
+    stmt = stmt.order_by(Physician.physician_id)
+    # sqlite LIKE is case insensitive, without wildcards that is an equality on the
+    # lower cased column which can use its index. Both sides are lowered by sqlite, it
+    # only folds ascii letters (like LIKE) where str.lower() would fold any letter
     if state is not None:
-        stmt = stmt.filter(Physician.state.ilike(state))
+        if has_like_wildcards(state):
+            stmt = stmt.filter(Physician.state.ilike(state))
+        else:
+            stmt = stmt.filter(Physician.state_normalized == func.lower(state))
     if specialty is not None:
-        stmt = stmt.filter(Physician.specialty.like(specialty))
+        if has_like_wildcards(specialty):
+            stmt = stmt.filter(Physician.specialty.like(specialty))
+        else:
+            stmt = stmt.filter(Physician.specialty_normalized == func.lower(specialty))
+    if last_physician_id is not None:
+        stmt = stmt.filter(Physician.physician_id > last_physician_id)
+    return stmt
 
-    physicians = db.execute(stmt).scalars()
 
-    return list(map(PhysicianResponse.from_db, physicians))
+def message_filters(
+    physician_id: str | None, start_date: datetime | None, end_date: datetime | None
+) -> list:
+    filters = []
+    if physician_id is not None:
+        filters.append(Message.physician_id == physician_id)
+    if start_date is not None:
+        filters.append(Message.timestamp >= start_date)
+    if end_date is not None:
+        filters.append(Message.timestamp <= end_date)
+    return filters
 
 
-@router.get("/messages", response_model=list[MessageResponse])
-def get_messages(
-    physician_id: str | None = None,
-    start_date: datetime | None = None,
-    end_date: datetime | None = None,
-    db: Session = Depends(get_db),
-):
+def build_messages_stmt(
+    physician_id: str | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+    after: tuple[datetime, int] | None,
+    requested: list[str] | None,
+) -> Select:
+    if requested is None:
+        stmt = select(Message)
+    else:
+        # the timestamp and message id are always needed for the cursor
+        stmt = select(
+            MESSAGE_TIMESTAMP_TEXT,
+            Message.message_id,
+            *(MESSAGE_FIELDS[f] for f in requested),
+        )
+
+    # the message id breaks ties between messages sent at the same time
+    stmt = stmt.order_by(Message.timestamp, Message.message_id)
+    stmt = stmt.filter(*message_filters(physician_id, start_date, end_date))
+    if after is not None:
+        stmt = stmt.filter(tuple_(Message.timestamp, Message.message_id) > tuple_(*after))
+    return stmt
+
+
+def build_message_search_stmt(
+    q: str,
+    physician_id: str | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+    after: tuple[float, int] | None,
+    requested: list[str],
+) -> Select:
+    """Messages matching a FTS5 query (terms, "phrases", prefix*), most relevant first"""
+    # the full text index finds the matches, each one is a primary key lookup in messages
+    stmt = (
+        select(
+            messages_fts.c.rank,
+            Message.message_id,
+            *(MESSAGE_FIELDS[f] for f in requested),
+        )
+        .select_from(messages_fts)
+        .join(Message, Message.message_id == messages_fts.c.rowid)
+        .filter(messages_fts.c.messages_fts.match(q))
+        .filter(*message_filters(physician_id, start_date, end_date))
+        .order_by(messages_fts.c.rank, Message.message_id)
+    )
+    if after is not None:
+        stmt = stmt.filter(
+            tuple_(messages_fts.c.rank, Message.message_id) > tuple_(*after)
+        )
+    return stmt
+
+
+# sqlite only parses a FTS5 query when the statement runs, its errors look like any
+# other OperationalError. the query is parsed first against an empty in memory index
+# with the same column so a bad query is a 400 before the database is touched
+_search_query_checker = threading.local()
+
+
+def validate_search_query(q: str):
+    conn = getattr(_search_query_checker, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message_text)")
+        _search_query_checker.conn = conn
+    try:
+        conn.execute(
+            "SELECT 1 FROM messages_fts WHERE messages_fts MATCH ?", (q,)
+        ).fetchall()
+    except sqlite3.OperationalError as error:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid search query: {error}"
+        ) from error
+
+
+def prepare_physicians_query(
+    state: str | None,
+    specialty: str | None,
+    limit: int,
+    cursor: str | None,
+    fields: str | None,
+) -> tuple[Select, list[str] | None]:
+    requested = resolve_fields(fields, PHYSICIAN_FIELDS)
+    last_physician_id = None
+    if cursor is not None:
+        [last_physician_id] = decode_cursor(cursor, int)
+    stmt = build_physicians_stmt(state, specialty, last_physician_id, requested)
+
+    # one extra row tells if there is a next page
+    return stmt.limit(limit + 1), requested
+
+
+def physicians_page(result: Result, limit: int, requested: list[str] | None):
+    if requested is None:
+        physicians = list(result.scalars())
+        has_next = len(physicians) > limit
+        physicians = physicians[:limit]
+        next_cursor = encode_cursor(physicians[-1].physician_id) if has_next else None
+        return PhysicianPage(
+            items=list(map(PhysicianResponse.from_db, physicians)),
+            next_cursor=next_cursor,
+        )
+
+    rows = result.all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1][0]) if has_next else None
+    return JSONResponse(
+        {
+            "items": project_rows(rows, requested, offset=1),
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+def physician_suggestions(
+    directory: PhysicianDirectory,
+    prefix: str,
+    state: str | None,
+    specialty: str | None,
+    limit: int,
+) -> JSONResponse:
+    records = directory.search(prefix, state, specialty, limit)
+    return JSONResponse(
+        {
+            "items": [
+                {field: getattr(record, field) for field in PHYSICIAN_FIELDS}
+                for record in records
+            ]
+        }
+    )
+
+
+def prepare_messages_query(
+    physician_id: str | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+    limit: int,
+    cursor: str | None,
+    fields: str | None,
+    q: str | None = None,
+) -> tuple[Select, list[str] | None]:
     # ensure start_date comes after end_date
     is_full_range_set = (start_date is not None) and (end_date is not None)
     if is_full_range_set and start_date > end_date:  # pyright: ignore (lsp not smart enough to realize both types arent't None)
@@ -103,15 +424,186 @@ def get_messages(
             status_code=400, detail="Start date must come before end date"
         )
 
-    stmt = select(Message).order_by(Message.timestamp)
-    if physician_id is not None:
-        stmt = stmt.filter(Message.physician_id == physician_id)
+    requested = resolve_fields(fields, MESSAGE_FIELDS)
+    if q is not None:
+        validate_search_query(q)
+        # ranked pages are always selected as rows, the cursor needs the rank
+        requested = requested or list(MESSAGE_FIELDS)
+        after = None
+        if cursor is not None:
+            after = decode_search_cursor(cursor)
+        stmt = build_message_search_stmt(
+            q, physician_id, start_date, end_date, after, requested
+        )
+        return stmt.limit(limit + 1), requested
 
-    if start_date is not None:
-        stmt = stmt.filter(Message.timestamp >= start_date)
-    if end_date is not None:
-        stmt = stmt.filter(Message.timestamp <= end_date)
+    after = None
+    if cursor is not None:
+        after = decode_timestamp_cursor(cursor)
+    stmt = build_messages_stmt(physician_id, start_date, end_date, after, requested)
+
+    # one extra row tells if there is a next page
+    return stmt.limit(limit + 1), requested
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    last_rank, last_message_id = decode_cursor(cursor, (int, float), int)
+    return last_rank, last_message_id
+
+
+def fetch_message_items(result: Result, requested: list[str] | None) -> list:
+    """Messages (full objects) or rows of a page statement"""
+    if requested is None:
+        return list(result.scalars())
+    return result.all()
+
+
+def message_sort_key(requested: list[str] | None) -> Callable[[Any], tuple]:
+    if requested is None:
+        return lambda message: (message.timestamp, message.message_id)
+    # rows start with the stored timestamp text (always in the same format) or the rank
+    return itemgetter(0, 1)
 
-    messages = db.execute(stmt).scalars()
 
-    return list(map(MessageResponse.from_db, messages))
+def read_partition_items(
+    partitions: Sequence[MessagePartition],
+    stmt: Select,
+    limit: int,
+    requested: list[str] | None,
+    ranked: bool,
+) -> list[list]:
+    """The page statement run unchanged against each partition file, oldest month first"""
+    pages = []
+    found_count = 0
+    for partition in partitions:
+        # every later partition only has later messages, they cannot make it into a full page
+        if not ranked and found_count > limit:
+            break
+        with Session(partition_engine(partition)) as partition_db:
+            items = fetch_message_items(partition_db.execute(stmt), requested)
+        pages.append(items)
+        found_count += len(items)
+    return pages
+
+
+def merge_message_items(
+    pages: list[list], limit: int, requested: list[str] | None
+) -> list:
+    """The first limit + 1 items of pages that are each in page order"""
+    key = message_sort_key(requested)
+    merged = []
+    seen_message_ids = set()
+    for item in heapq.merge(*pages, key=key):
+        # a month archived between reading the hot table and the catalog is read twice
+        message_id = key(item)[1]
+        if message_id in seen_message_ids:
+            continue
+        seen_message_ids.add(message_id)
+        merged.append(item)
+        if len(merged) > limit:
+            break
+    return merged
+
+
+def read_messages_page(
+    db: Session,
+    stmt: Select,
+    limit: int,
+    requested: list[str] | None,
+    ranked: bool,
+    start_date: datetime | None,
+    end_date: datetime | None,
+):
+    """Page of the hot messages merged with the monthly partitions the date range overlaps"""
+    # the hot table is read before the catalog, see merge_message_items
+    items = fetch_message_items(db.execute(stmt), requested)
+    partitions = (
+        db.execute(partitions_overlapping(start_date, end_date)).scalars().all()
+    )
+    if partitions:
+        pages = read_partition_items(partitions, stmt, limit, requested, ranked)
+        items = merge_message_items([items, *pages], limit, requested)
+    return messages_page_items(items, limit, requested, ranked)
+
+
+def messages_page_items(
+    items: list, limit: int, requested: list[str] | None, ranked: bool = False
+):
+    """Response of limit + 1 fetched items, the extra one tells if there is a next page"""
+    has_next = len(items) > limit
+    items = items[:limit]
+    if requested is None:
+        next_cursor = None
+        if has_next:
+            last = items[-1]
+            next_cursor = encode_cursor(last.timestamp.isoformat(), last.message_id)
+        return MessagePage(
+            items=list(map(MessageResponse.from_db, items)),
+            next_cursor=next_cursor,
+        )
+
+    next_cursor = None
+    if has_next and ranked:
+        next_cursor = encode_cursor(items[-1][0], items[-1][1])
+    elif has_next:
+        last_timestamp = datetime.fromisoformat(items[-1][0])
+        next_cursor = encode_cursor(last_timestamp.isoformat(), items[-1][1])
+    return JSONResponse(
+        {
+            "items": project_rows(items, requested, offset=2),
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@router.get("/physicians", response_model=PhysicianPage)
+def get_physicians(
+    state: str | None = None,
+    specialty: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: str | None = None,
+    fields: str | None = Query(
+        None, description="Comma separated response fields to return"
+    ),
+    db: Session = Depends(get_read_db),
+):
+    stmt, requested = prepare_physicians_query(state, specialty, limit, cursor, fields)
+    return physicians_page(db.execute(stmt), limit, requested)
+
+
+@router.get("/physicians/search", response_model=PhysicianSearchResponse)
+def search_physicians(
+    prefix: str = Query(
+        ...,
+        min_length=1,
+        description="Start of a last name, first name, npi or specialty, every word must match",
+    ),
+    state: str | None = None,
+    specialty: str | None = None,
+    limit: int = Query(DEFAULT_SUGGESTION_LIMIT, ge=1, le=MAX_SUGGESTION_LIMIT),
+    db: Session = Depends(get_read_db),
+):
+    """Type-ahead search of physicians from the in memory directory"""
+    directory = physician_directory.current(db)
+    return physician_suggestions(directory, prefix, state, specialty, limit)
+
+
+@router.get("/messages", response_model=MessagePage)
+def get_messages(
+    physician_id: str | None = None,
+    start_date: datetime | None = None,
+    end_date: datetime | None = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: str | None = None,
+    fields: str | None = Query(
+        None, description="Comma separated response fields to return"
+    ),
+    q: str | None = Query(None, min_length=1, description=SEARCH_QUERY_DESCRIPTION),
+    db: Session = Depends(get_read_db),
+):
+    stmt, requested = prepare_messages_query(
+        physician_id, start_date, end_date, limit, cursor, fields, q
+    )
+    return read_messages_page(
+        db, stmt, limit, requested, q is not None, start_date, end_date
+    )
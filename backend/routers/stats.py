@@ -0,0 +1,223 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+from sqlalchemy import Result, Select, func, select, tuple_
+from sqlalchemy.orm import Session
+from pydantic import BaseModel
+from typing import Any, Optional
+from datetime import date, timedelta
+
+from db.database import get_read_db
+from db.models import MessageRollup, MonthlyRollup, RollupTotals
+from db.rollups import ROLLUP_SUMS
+from routers.search import CURSOR_SCALAR, decode_cursor, encode_cursor, parse_fields
+
+router = APIRouter(prefix="", tags=["stats"])
+
+
+class StatsRow(BaseModel):
+    # only the keys in `group_by` are returned
+    physician_id: Optional[int] = None
+    campaign_id: Optional[str] = None
+    channel: Optional[str] = None
+    day: Optional[str] = None
+    month: Optional[str] = None
+
+    message_count: int
+    outbound_count: int
+    delivered_count: int
+    bounced_count: int
+    failed_count: int
+    positive_count: int
+    neutral_count: int
+    negative_count: int
+    # delivered / all messages
+    delivery_rate: Optional[float] = None
+    # messages with a response latency
+    latency_count: int
+    mean_latency_sec: Optional[float] = None
+    min_latency_sec: Optional[float] = None
+    max_latency_sec: Optional[float] = None
+
+
+class StatsPage(BaseModel):
+    items: list[StatsRow]
+    # pass back as `cursor` to get the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+DEFAULT_STATS_LIMIT = 1000
+MAX_STATS_LIMIT = 10000
+
+# group key -> column of each rollup table that has it
+DAILY_KEYS = {
+    "physician_id": MessageRollup.physician_id,
+    "campaign_id": MessageRollup.campaign_id,
+    "channel": MessageRollup.channel,
+    "day": MessageRollup.day,
+    "month": func.substr(MessageRollup.day, 1, 7),
+}
+MONTHLY_KEYS = {
+    "campaign_id": MonthlyRollup.campaign_id,
+    "channel": MonthlyRollup.channel,
+    "month": MonthlyRollup.month,
+}
+GROUP_BY_DESCRIPTION = (
+    f"Comma separated keys to group by ({', '.join(DAILY_KEYS)}),"
+    " totals over every matching message when not set"
+)
+
+
+def is_whole_months(start_date: date | None, end_date: date | None) -> bool:
+    return (start_date is None or start_date.day == 1) and (
+        end_date is None or (end_date + timedelta(days=1)).day == 1
+    )
+
+
+def choose_rollup(
+    group_keys: list[str],
+    physician_id: int | None,
+    start_date: date | None,
+    end_date: date | None,
+) -> tuple[type[RollupTotals], dict]:
+    """The smallest rollup table that can answer the query and its group key columns"""
+    if (
+        set(group_keys) <= MONTHLY_KEYS.keys()
+        and physician_id is None
+        and is_whole_months(start_date, end_date)
+    ):
+        return MonthlyRollup, MONTHLY_KEYS
+    return MessageRollup, DAILY_KEYS
+
+
+def build_stats_stmt(
+    group_keys: list[str],
+    physician_id: int | None,
+    campaign_id: str | None,
+    channel: str | None,
+    start_date: date | None,
+    end_date: date | None,
+    after: list[Any] | None,
+) -> Select:
+    """Totals of the rollup rows per group, ordered by the group keys"""
+    rollup, keys = choose_rollup(group_keys, physician_id, start_date, end_date)
+    columns = rollup.__table__.c
+    group_columns = [keys[key] for key in group_keys]
+    stmt = select(
+        *group_columns,
+        *(func.coalesce(func.sum(columns[column]), 0) for column in ROLLUP_SUMS),
+        func.min(columns.latency_min),
+        func.max(columns.latency_max),
+    )
+
+    if physician_id is not None:
+        stmt = stmt.filter(MessageRollup.physician_id == physician_id)
+    if campaign_id is not None:
+        stmt = stmt.filter(columns.campaign_id == campaign_id)
+    if channel is not None:
+        stmt = stmt.filter(columns.channel == channel)
+    # days (YYYY-MM-DD) and months (YYYY-MM) are text so they compare like dates
+    if rollup is MonthlyRollup:
+        if start_date is not None:
+            stmt = stmt.filter(MonthlyRollup.month >= start_date.strftime("%Y-%m"))
+        if end_date is not None:
+            stmt = stmt.filter(MonthlyRollup.month <= end_date.strftime("%Y-%m"))
+    else:
+        if start_date is not None:
+            stmt = stmt.filter(MessageRollup.day >= start_date.isoformat())
+        if end_date is not None:
+            stmt = stmt.filter(MessageRollup.day <= end_date.isoformat())
+
+    if group_columns:
+        stmt = stmt.group_by(*group_columns).order_by(*group_columns)
+        # the group keys are (expressions of) plain columns, later groups are filtered
+        # before grouping
+        if after is not None:
+            stmt = stmt.filter(tuple_(*group_columns) > tuple_(*after))
+    return stmt
+
+
+def prepare_stats_query(
+    group_by: str | None,
+    physician_id: int | None,
+    campaign_id: str | None,
+    channel: str | None,
+    start_date: date | None,
+    end_date: date | None,
+    limit: int,
+    cursor: str | None,
+) -> tuple[Select, list[str]]:
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise HTTPException(
+            status_code=400, detail="Start date must come before end date"
+        )
+    group_keys = list(dict.fromkeys(parse_fields(group_by, DAILY_KEYS) or []))
+
+    after = None
+    if cursor is not None:
+        if not group_keys:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        after = decode_cursor(cursor, *[CURSOR_SCALAR] * len(group_keys))
+    stmt = build_stats_stmt(
+        group_keys, physician_id, campaign_id, channel, start_date, end_date, after
+    )
+    # one extra row tells if there is a next page
+    return stmt.limit(limit + 1), group_keys
+
+
+def stats_row(group_keys: list[str], row) -> dict[str, Any]:
+    item = dict(zip(group_keys, row))
+    sums = dict(zip(ROLLUP_SUMS, row[len(group_keys) :]))
+    latency_min, latency_max = row[-2:]
+
+    latency_sum = sums.pop("latency_sum")
+    message_count = sums["message_count"]
+    latency_count = sums["latency_count"]
+    item.update(sums)
+    item["delivery_rate"] = (
+        sums["delivered_count"] / message_count if message_count else None
+    )
+    item["mean_latency_sec"] = latency_sum / latency_count if latency_count else None
+    item["min_latency_sec"] = latency_min
+    item["max_latency_sec"] = latency_max
+    return item
+
+
+def stats_page(result: Result, limit: int, group_keys: list[str]):
+    rows = result.all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_next:
+        next_cursor = encode_cursor(*rows[-1][: len(group_keys)])
+    return JSONResponse(
+        {
+            "items": [stats_row(group_keys, row) for row in rows],
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@router.get("/stats", response_model=StatsPage)
+def get_stats(
+    group_by: str | None = Query(None, description=GROUP_BY_DESCRIPTION),
+    physician_id: int | None = None,
+    campaign_id: str | None = None,
+    channel: str | None = None,
+    start_date: date | None = None,
+    end_date: date | None = None,
+    limit: int = Query(DEFAULT_STATS_LIMIT, ge=1, le=MAX_STATS_LIMIT),
+    cursor: str | None = None,
+    db: Session = Depends(get_read_db),
+):
+    """Message counts, delivery and sentiment totals and response latency per group, read from the rollups"""
+    stmt, group_keys = prepare_stats_query(
+        group_by,
+        physician_id,
+        campaign_id,
+        channel,
+        start_date,
+        end_date,
+        limit,
+        cursor,
+    )
+    return stats_page(db.execute(stmt), limit, group_keys)
@@ -0,0 +1,172 @@
+#####
+# Admission control of the request handlers
+#    - routes are grouped in classes with their own cap of requests handled at once, cheap
+#      physician lookups are not held up behind message range scans and classification
+#    - a request over the cap waits in a per class queue (first come first served), once it
+#      waited ADMISSION_QUEUE_TIMEOUT seconds it is shed with a 503 and Retry-After instead
+#      of piling up in the threadpool until every client times out
+#    - routes without a class (probes, metrics, exports, ingest with its own queue) are
+#      never held back
+#    - a slot is released once the response starts, a streamed body (the classify batch)
+#      is not counted
+#####
+
+import asyncio
+import os
+import time
+from collections import deque
+
+from anyio import to_thread
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from services.metrics import Counter, Gauge, Histogram, registry, route_template
+
+# worker threads of the sync handlers (and other run_in_threadpool calls), anyio's default
+# is 40, the caps below should add up to less so probes and metrics still get a thread
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "40"))
+# seconds a request may wait for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2"))
+# seconds a shed client should wait before retrying
+ADMISSION_RETRY_AFTER = 1
+
+# route template -> class
+ROUTE_CLASSES = {
+    "/physicians": "lookup",
+    "/physicians/search": "lookup",
+    "/stats": "lookup",
+    "/messages": "scan",
+    "/physicians/{physician_id}/overview": "scan",
+    "/physicians/overview": "scan",
+    "/classify/batch": "scan",
+    "/classify/{message_id}": "classify",
+    "/classify/text": "classify",
+}
+# requests of a class handled at once, e.g. ADMISSION_SCAN_LIMIT=8 overrides the default
+DEFAULT_CLASS_LIMITS = {"lookup": 16, "scan": 4, "classify": 4}
+
+ADMISSION_ACTIVE = registry.register(
+    Gauge(
+        "admission_active_requests",
+        "Requests holding an admission slot",
+        ("route_class",),
+    )
+)
+ADMISSION_QUEUED = registry.register(
+    Gauge(
+        "admission_queue_requests",
+        "Requests waiting for an admission slot",
+        ("route_class",),
+    )
+)
+ADMISSION_SHED = registry.register(
+    Counter(
+        "admission_shed_total",
+        "Requests answered with a 503 after waiting ADMISSION_QUEUE_TIMEOUT for a slot",
+        ("route_class",),
+    )
+)
+ADMISSION_WAIT = registry.register(
+    Histogram(
+        "admission_wait_seconds",
+        "Time admitted requests waited for their slot",
+        ("route_class",),
+    )
+)
+
+
+class AdmissionLimiter:
+    """At most `limit` holders at once, the others wait first come first served
+
+    only used from the event loop, a released slot is handed to the oldest waiter
+    directly so a newcomer cannot take it first
+    """
+
+    def __init__(self, route_class: str, limit: int):
+        self.route_class = route_class
+        self.limit = limit
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def __len__(self) -> int:
+        """Requests waiting for a slot"""
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> bool:
+        """Takes a slot, False when none was free within the timeout"""
+        labels = (self.route_class,)
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            ADMISSION_ACTIVE.inc(labels)
+            ADMISSION_WAIT.observe(0, labels)
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUED.inc(labels)
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # e.g. the client went away, a slot it was just handed goes to the next one
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            ADMISSION_QUEUED.dec(labels)
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters.remove(waiter)
+
+        # handed a slot by release(), even if that raced the timeout
+        if waiter.cancelled():
+            ADMISSION_SHED.inc(labels)
+            return False
+        ADMISSION_WAIT.observe(time.perf_counter() - start_time, labels)
+        return True
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot moves to the waiter, active stays the same
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        ADMISSION_ACTIVE.dec((self.route_class,))
+
+
+def class_limit(route_class: str) -> int:
+    env_name = f"ADMISSION_{route_class.upper()}_LIMIT"
+    return int(os.environ.get(env_name, DEFAULT_CLASS_LIMITS[route_class]))
+
+
+limiters = {
+    route_class: AdmissionLimiter(route_class, class_limit(route_class))
+    for route_class in DEFAULT_CLASS_LIMITS
+}
+
+
+def configure_threadpool(size: int = THREADPOOL_SIZE):
+    """Must run on the event loop (e.g. in the lifespan) before the first request"""
+    to_thread.current_default_thread_limiter().total_tokens = size
+
+
+async def admission_middleware(request: Request, call_next):
+    route_class = ROUTE_CLASSES.get(route_template(request))
+    if route_class is None:
+        return await call_next(request)
+
+    limiter = limiters[route_class]
+    if not await limiter.acquire(ADMISSION_QUEUE_TIMEOUT):
+        return JSONResponse(
+            {"detail": "Server is busy, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+    try:
+        return await call_next(request)
+    finally:
+        limiter.release()
@@ -0,0 +1,304 @@
+#####
+# Persisted message classifications
+#    - results are stored per (text_hash, compliance_version) so reads are a primary key
+#      lookup and a text shared by many messages is only matched once (see db/texts.py)
+#    - a keyword -> text inverted index lets a new compliance version re-evaluate
+#      only the texts that contain keywords which were added or removed
+#####
+
+import json
+
+from sqlalchemy import select, exists, func, literal, literal_column
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from db.models import (
+    MessageText,
+    TextClassification,
+    KeywordPosting,
+    IndexedKeyword,
+    ComplianceVersion,
+)
+from services.matcher import CompiledRule, KeywordMatcher, build_matcher
+
+# number of texts read and classified per transaction by the backfill
+CLASSIFY_CHUNK_SIZE = 1000
+
+Matches = dict[str, list[str]]
+
+
+def encode_matches(matches: Matches) -> str:
+    return json.dumps(matches, separators=(",", ":"))
+
+
+def decode_matches(matches: str) -> Matches:
+    return json.loads(matches)
+
+
+def keyword_only_matcher(keywords: set[str]) -> KeywordMatcher:
+    # the keywords are not attached to a rule, only matched_keywords is useful
+    return KeywordMatcher([CompiledRule("", "", "", "")], [("", k) for k in keywords])
+
+
+##
+# Indexed keywords - every text that contains one of these keywords has a posting
+##
+
+_index_matcher: tuple[int | None, KeywordMatcher] | None = None
+
+
+def get_index_matcher(db: Session) -> KeywordMatcher:
+    """Matcher over all indexed keywords, rebuilt when another keyword gets indexed"""
+    global _index_matcher
+
+    # rowids only grow while keywords are being indexed so the max is a cheap revision
+    revision_stmt = select(func.max(literal_column("rowid"))).select_from(
+        IndexedKeyword
+    )
+    revision = db.execute(revision_stmt).scalar_one()
+    cached = _index_matcher
+    if cached is not None and cached[0] == revision:
+        return cached[1]
+
+    # like get_matcher no lock is held across the query, a concurrent rebuild is harmless
+    keywords = set(db.execute(select(IndexedKeyword.keyword)).scalars())
+    matcher = keyword_only_matcher(keywords)
+    _index_matcher = (revision, matcher)
+    return matcher
+
+
+def mark_indexed(db: Session, keywords: set[str]):
+    if not keywords:
+        return
+    stmt = insert(IndexedKeyword.__table__).on_conflict_do_nothing()
+    db.execute(stmt, [{"keyword": keyword} for keyword in keywords])
+
+
+def index_keywords(db: Session, keywords: set[str]) -> int:
+    """Makes sure every text containing one of the (case folded) keywords has a posting
+
+    keywords already in the index are free, brand new keywords need a single pass
+    over the message texts. Returns the number of newly indexed keywords
+    """
+    indexed = set(
+        db.execute(
+            select(IndexedKeyword.keyword).where(IndexedKeyword.keyword.in_(keywords))
+        ).scalars()
+    )
+    new_keywords = keywords - indexed
+    if not new_keywords:
+        return 0
+
+    matcher = keyword_only_matcher(new_keywords)
+    posting_stmt = insert(KeywordPosting.__table__).on_conflict_do_nothing()
+    last_text_hash: int | None = None
+    while True:
+        stmt = (
+            select(MessageText.text_hash, MessageText.message_text)
+            .order_by(MessageText.text_hash)
+            .limit(CLASSIFY_CHUNK_SIZE)
+        )
+        if last_text_hash is not None:
+            stmt = stmt.where(MessageText.text_hash > last_text_hash)
+        rows = db.execute(stmt).all()
+        if not rows:
+            break
+
+        postings = [
+            {"keyword": keyword, "text_hash": text_hash}
+            for text_hash, message_text in rows
+            for keyword in matcher.matched_keywords(message_text)
+        ]
+        if postings:
+            db.execute(posting_stmt, postings)
+        last_text_hash = rows[-1][0]
+
+    mark_indexed(db, new_keywords)
+    db.commit()
+    return len(new_keywords)
+
+
+##
+# Storing and reading classifications
+##
+
+
+def store_classifications(
+    db: Session,
+    matcher: KeywordMatcher,
+    compliance_version: str,
+    rows: list[tuple[int, str]],
+) -> list[Matches]:
+    """Classifies distinct (text_hash, message_text) rows and stores the results, the caller commits"""
+    if not rows:
+        return []
+    index_matcher = get_index_matcher(db)
+
+    results: list[Matches] = []
+    classifications = []
+    postings = []
+    for text_hash, message_text in rows:
+        matches = matcher.match(message_text)
+        results.append(matches)
+        classifications.append(
+            {
+                "text_hash": text_hash,
+                "compliance_version": compliance_version,
+                "matches": encode_matches(matches),
+            }
+        )
+
+        # keep the inverted index complete for this version and every indexed keyword
+        posting_keywords = index_matcher.matched_keywords(message_text)
+        for keywords in matches.values():
+            posting_keywords.update(keyword.lower() for keyword in keywords)
+        postings.extend(
+            {"keyword": keyword, "text_hash": text_hash} for keyword in posting_keywords
+        )
+
+    # unknown compliance versions have no rules, there is nothing worth persisting
+    if classifications and matcher.rules:
+        db.execute(
+            insert(TextClassification.__table__).on_conflict_do_nothing(),
+            classifications,
+        )
+        if postings:
+            db.execute(
+                insert(KeywordPosting.__table__).on_conflict_do_nothing(), postings
+            )
+    return results
+
+
+def resolve_classifications(
+    db: Session,
+    matcher: KeywordMatcher,
+    compliance_version: str,
+    rows: list[tuple[int, int, str, str | None]],
+) -> list[Matches]:
+    """Matches for (message_id, text_hash, message_text, stored matches) rows
+
+    the missing ones are classified and stored once per distinct text
+    """
+    missing = {
+        text_hash: message_text
+        for _, text_hash, message_text, stored in rows
+        if stored is None
+    }
+    computed = dict(
+        zip(
+            missing,
+            store_classifications(
+                db, matcher, compliance_version, list(missing.items())
+            ),
+        )
+    )
+    return [
+        decode_matches(stored) if stored is not None else computed[text_hash]
+        for _, text_hash, _, stored in rows
+    ]
+
+
+def backfill_classifications(db: Session, compliance_version: str) -> int:
+    """Classifies every text without a stored result for the version, returns how many were classified"""
+    matcher = build_matcher(db, compliance_version)
+    if not matcher.rules:
+        raise ValueError(f"Compliance version '{compliance_version}' has no rules")
+
+    is_classified = exists().where(
+        TextClassification.text_hash == MessageText.text_hash,
+        TextClassification.compliance_version == compliance_version,
+    )
+
+    classified_count = 0
+    last_text_hash: int | None = None
+    while True:
+        stmt = (
+            select(MessageText.text_hash, MessageText.message_text)
+            .where(~is_classified)
+            .order_by(MessageText.text_hash)
+            .limit(CLASSIFY_CHUNK_SIZE)
+        )
+        if last_text_hash is not None:
+            stmt = stmt.where(MessageText.text_hash > last_text_hash)
+        rows = [(text_hash, text) for text_hash, text in db.execute(stmt)]
+        if not rows:
+            break
+
+        store_classifications(db, matcher, compliance_version, rows)
+        db.commit()
+        classified_count += len(rows)
+        last_text_hash = rows[-1][0]
+
+    # every text now has postings for the keywords of this version
+    mark_indexed(db, {keyword.lower() for _, keyword in matcher.keywords})
+    db.commit()
+    return classified_count
+
+
+def latest_classified_version(db: Session, exclude: str) -> str | None:
+    # compliance versions store their updated date in the first_name column
+    stmt = (
+        select(ComplianceVersion.version)
+        .where(
+            ComplianceVersion.version != exclude,
+            exists().where(
+                TextClassification.compliance_version == ComplianceVersion.version
+            ),
+        )
+        .order_by(ComplianceVersion.first_name.desc(), ComplianceVersion.version.desc())
+        .limit(1)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+
+def active_compliance_version(db: Session) -> str | None:
+    """The most recently updated compliance version, new messages are classified against it"""
+    stmt = (
+        select(ComplianceVersion.version)
+        .order_by(ComplianceVersion.first_name.desc(), ComplianceVersion.version.desc())
+        .limit(1)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+
+def reclassify_incremental(
+    db: Session, compliance_version: str, base_version: str
+) -> tuple[int, int]:
+    """Classifies a (new) compliance version starting from the results of a base version
+
+    only texts containing a keyword that was added or removed between the versions,
+    found through the keyword postings, and texts without a base result are matched
+    again, every other result is copied. Returns (copied, reclassified) counts
+    """
+    base_matcher = build_matcher(db, base_version)
+    new_matcher = build_matcher(db, compliance_version)
+    if not new_matcher.rules:
+        raise ValueError(f"Compliance version '{compliance_version}' has no rules")
+
+    # a keyword moving between rules changes the result just like an added/ removed one
+    changed_keywords = {
+        keyword.lower()
+        for _, keyword in set(base_matcher.keywords) ^ set(new_matcher.keywords)
+    }
+    index_keywords(db, changed_keywords)
+
+    # copy every base result that cannot be affected by the changed keywords
+    base = TextClassification.__table__.alias("base")
+    is_affected = exists().where(
+        KeywordPosting.text_hash == base.c.text_hash,
+        KeywordPosting.keyword.in_(changed_keywords),
+    )
+    copy_select = select(
+        base.c.text_hash, literal(compliance_version), base.c.matches
+    ).where(base.c.compliance_version == base_version, ~is_affected)
+    copy_stmt = (
+        insert(TextClassification.__table__)
+        .from_select(["text_hash", "compliance_version", "matches"], copy_select)
+        .on_conflict_do_nothing()
+    )
+    copied_count = db.execute(copy_stmt).rowcount
+    db.commit()
+
+    # what is left are the affected texts and the ones never classified under the base
+    reclassified_count = backfill_classifications(db, compliance_version)
+    return copied_count, reclassified_count
@@ -0,0 +1,383 @@
+#####
+# Background exports of messages with their classification (compliance audits)
+#    - a job is a row in export_jobs, a bounded pool of threads in the api process runs it
+#    - messages are read in windows of EXPORT_WINDOW_SIZE rows (keyset on timestamp,
+#      message id), each window is its own short read transaction so a long export never
+#      keeps writers waiting and the progress is saved between windows
+#    - a window of the hot table is merged with the same window of every monthly partition
+#      the date range overlaps (db/partitions.py), archived months are exported too
+#    - rows are written straight into a gzip compressed csv or ndjson file under EXPORT_DIR,
+#      memory stays the same whatever the number of rows
+#    - missing classifications are computed with the cached matcher but not stored, an
+#      export only reads
+#    - a job runs in the process that created it, which holds a lock on a file named after
+#      it while it lives (the kernel drops the lock when the process dies). On startup the
+#      pending and running jobs of a stopped process are marked failed
+#####
+
+import csv
+import fcntl
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import batched
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator
+
+from sqlalchemy import Select, func, select, update
+from sqlalchemy.orm import Session
+
+from db import database
+from db.models import ExportJob, Message
+from db.partitions import partition_engine, partitions_overlapping
+from routers.classify import select_stored_matches_of
+from routers.search import (
+    MESSAGE_FIELDS,
+    build_messages_stmt,
+    merge_message_items,
+    message_filters,
+    read_partition_items,
+)
+from services.classifications import Matches, decode_matches
+from services.matcher import KeywordMatcher, get_matcher
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = Path(os.environ.get("EXPORT_DIR", "exports"))
+# lock files of the processes running exports, shared by every api worker
+EXPORT_OWNER_DIR = Path(os.environ.get("EXPORT_OWNER_DIR", EXPORT_DIR / ".owners"))
+# jobs past this many wait as pending, each running job is one thread and one connection
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "2"))
+
+# rows per read transaction, the progress is saved after each one
+EXPORT_WINDOW_SIZE = 10000
+# rows classified and written at a time
+EXPORT_CHUNK_SIZE = 1000
+# the gzip command line default, 9 is much slower for a few percent
+EXPORT_COMPRESS_LEVEL = 6
+
+EXPORT_COLUMNS = [*MESSAGE_FIELDS, "compliance_version", "matched_rules"]
+
+export_executor = ThreadPoolExecutor(
+    max_workers=EXPORT_WORKERS, thread_name_prefix="export"
+)
+
+
+def export_path(job: ExportJob) -> Path:
+    return EXPORT_DIR / f"{job.job_id}.{job.format}.gz"
+
+
+##
+# Job owners
+##
+
+# (pid, owner id, locked file) of this process, created after a fork of the workers
+_owner: tuple[int, str, BinaryIO] | None = None
+_owner_lock = threading.Lock()
+
+
+def process_owner() -> str:
+    """Owner id of the jobs of this process, its lock file is held until the process exits"""
+    global _owner
+    with _owner_lock:
+        if _owner is None or _owner[0] != os.getpid():
+            owner = uuid.uuid4().hex
+            EXPORT_OWNER_DIR.mkdir(parents=True, exist_ok=True)
+            lock_file = open(EXPORT_OWNER_DIR / owner, "wb")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _owner = (os.getpid(), owner, lock_file)
+        return _owner[1]
+
+
+def owner_is_alive(owner: str) -> bool:
+    path = EXPORT_OWNER_DIR / owner
+    try:
+        lock_file = open(path, "rb")
+    except FileNotFoundError:
+        return False
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        path.unlink(missing_ok=True)
+    return False
+
+
+def fail_interrupted_jobs() -> int:
+    """Marks the pending and running jobs of stopped processes as failed, returns how many
+
+    run on startup, their clients would otherwise poll them forever
+    """
+    try:
+        with database.SessionLocal() as db:
+            jobs = db.execute(
+                select(ExportJob.job_id, ExportJob.format, ExportJob.owner).where(
+                    ExportJob.status.in_(("pending", "running"))
+                )
+            ).all()
+        alive: dict[str, bool] = {}
+        interrupted = []
+        for job in jobs:
+            # jobs created before owners were recorded belong to a stopped process too
+            if job.owner is not None and job.owner not in alive:
+                alive[job.owner] = owner_is_alive(job.owner)
+            if job.owner is None or not alive[job.owner]:
+                interrupted.append(job)
+        for job in interrupted:
+            path = export_path(job)
+            path.with_name(path.name + ".part").unlink(missing_ok=True)
+            update_job(
+                job.job_id,
+                status="failed",
+                error="Interrupted, the api process running the export stopped",
+                finished_at=datetime.now(),
+            )
+    except Exception:
+        # e.g. pending migrations, GET /ready reports those
+        logger.exception("failing interrupted exports failed")
+        return 0
+    if interrupted:
+        logger.warning("marked %d interrupted export jobs as failed", len(interrupted))
+    return len(interrupted)
+
+
+def create_export_job(
+    db: Session,
+    format: str,
+    compliance_version: str,
+    physician_id: int | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+) -> ExportJob:
+    """Stores a pending job and queues it, the caller validates the parameters"""
+    job = ExportJob(
+        job_id=uuid.uuid4().hex,
+        status="pending",
+        format=format,
+        compliance_version=compliance_version,
+        physician_id=physician_id,
+        start_date=start_date,
+        end_date=end_date,
+        rows_written=0,
+        bytes_written=0,
+        created_at=datetime.now(),
+        owner=process_owner(),
+    )
+    db.add(job)
+    db.commit()
+    export_executor.submit(run_export_job, job.job_id)
+    return job
+
+
+##
+# Reading
+##
+
+
+def export_window_stmt(job: ExportJob, after: tuple[datetime, int] | None) -> Select:
+    """(timestamp text, message id, *MESSAGE_FIELDS, text hash) rows of the next window
+
+    runs unchanged against the monthly partitions, the classifications are looked up in
+    the main database by text hash
+    """
+    stmt = build_messages_stmt(
+        job.physician_id, job.start_date, job.end_date, after, list(MESSAGE_FIELDS)
+    )
+    return stmt.add_columns(Message.text_hash).limit(EXPORT_WINDOW_SIZE)
+
+
+def iter_export_window(
+    job: ExportJob, after: tuple[datetime, int] | None
+) -> Iterator[list]:
+    """Chunks of (timestamp text, message id, *MESSAGE_FIELDS, text hash, stored matches) rows of the next window"""
+    stmt = export_window_stmt(job, after)
+    requested = list(MESSAGE_FIELDS)
+    with database.ReadSessionLocal() as db:
+        rows = db.execute(stmt).all()
+        # the hot table is read before the catalog, see merge_message_items
+        partitions = (
+            db.execute(partitions_overlapping(job.start_date, job.end_date))
+            .scalars()
+            .all()
+        )
+        if partitions:
+            # the limit + 1 merged rows are a full window
+            pages = read_partition_items(
+                partitions, stmt, EXPORT_WINDOW_SIZE - 1, requested, False
+            )
+            rows = merge_message_items(
+                [rows, *pages], EXPORT_WINDOW_SIZE - 1, requested
+            )
+
+        for chunk in batched(rows, EXPORT_CHUNK_SIZE):
+            text_hashes = {row[-1] for row in chunk}
+            stmt = select_stored_matches_of(text_hashes, job.compliance_version)
+            stored = dict(db.execute(stmt).all())
+            yield [(*row, stored.get(row[-1])) for row in chunk]
+
+
+def matched_rules(matcher: KeywordMatcher, matches: Matches) -> list[dict[str, Any]]:
+    # same shape as the matched_rules of ClassifyMessageResponse
+    rules = []
+    for rule_id, keywords in matches.items():
+        # a stored result can name a rule of a newer revision than the matcher
+        rule = matcher.rules.get(rule_id)
+        if rule is None:
+            continue
+        rules.append(
+            {
+                "id": rule.id,
+                "name": rule.name,
+                "result_type": rule.result_type,
+                "result_text": rule.result_text,
+                "matched_keywords": keywords,
+            }
+        )
+    return rules
+
+
+def export_record(job: ExportJob, matcher: KeywordMatcher, row) -> dict[str, Any]:
+    record = dict(zip(MESSAGE_FIELDS, row[2:-2]))
+    stored = row[-1]
+    matches = (
+        decode_matches(stored)
+        if stored is not None
+        else matcher.match(record["message_text"])
+    )
+    record["compliance_version"] = job.compliance_version
+    record["matched_rules"] = matched_rules(matcher, matches)
+    return record
+
+
+##
+# Writing
+##
+
+
+class ExportWriter:
+    """Gzip compressed csv or ndjson records, bytes_written is the compressed size so far
+
+    closing it ends the gzip stream, the file is closed by whoever opened it
+    """
+
+    def __init__(self, file: BinaryIO, format: str):
+        self._file = file
+        self._gzip = gzip.GzipFile(
+            fileobj=self._file, mode="wb", compresslevel=EXPORT_COMPRESS_LEVEL
+        )
+        self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+        self._csv = None
+        if format == "csv":
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(EXPORT_COLUMNS)
+
+    def write(self, records: list[dict[str, Any]]):
+        if self._csv is None:
+            self._text.writelines(
+                json.dumps(record, separators=(",", ":")) + "\n" for record in records
+            )
+            return
+        for record in records:
+            # nested values are json in their cell
+            record["matched_rules"] = json.dumps(
+                record["matched_rules"], separators=(",", ":")
+            )
+            self._csv.writerow(record.values())
+
+    @property
+    def bytes_written(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._text.close()
+
+    def __enter__(self) -> "ExportWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+##
+# Running
+##
+
+
+def update_job(job_id: str, **values):
+    with database.SessionLocal() as db:
+        db.execute(update(ExportJob).where(ExportJob.job_id == job_id).values(**values))
+        db.commit()
+
+
+def count_export_rows(job: ExportJob) -> int:
+    stmt = select(func.count()).select_from(Message)
+    stmt = stmt.filter(*message_filters(job.physician_id, job.start_date, job.end_date))
+    with database.ReadSessionLocal() as db:
+        total_rows = db.execute(stmt).scalar_one()
+        partitions = (
+            db.execute(partitions_overlapping(job.start_date, job.end_date))
+            .scalars()
+            .all()
+        )
+    for partition in partitions:
+        with partition_engine(partition).connect() as conn:
+            total_rows += conn.execute(stmt).scalar_one()
+    return total_rows
+
+
+def run_export_job(job_id: str):
+    with database.SessionLocal() as db:
+        job = db.get(ExportJob, job_id)
+        if job is None:
+            return
+        # rules are loaded once for the whole export
+        matcher = get_matcher(db, job.compliance_version)
+        db.expunge(job)
+
+    path = export_path(job)
+    part_path = path.with_name(path.name + ".part")
+    try:
+        update_job(job_id, status="running", total_rows=count_export_rows(job))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(part_path, "wb") as f, ExportWriter(f, job.format) as writer:
+            rows_written = 0
+            after = None
+            while True:
+                window_rows = 0
+                last_row = None
+                for rows in iter_export_window(job, after):
+                    writer.write([export_record(job, matcher, row) for row in rows])
+                    window_rows += len(rows)
+                    last_row = rows[-1]
+                if last_row is None:
+                    break
+                rows_written += window_rows
+                update_job(
+                    job_id,
+                    rows_written=rows_written,
+                    bytes_written=writer.bytes_written,
+                )
+                if window_rows < EXPORT_WINDOW_SIZE:
+                    break
+                after = (datetime.fromisoformat(last_row[0]), last_row[1])
+        # the file only shows up under its final name once it is complete
+        os.replace(part_path, path)
+        update_job(
+            job_id,
+            status="completed",
+            bytes_written=path.stat().st_size,
+            finished_at=datetime.now(),
+        )
+    except Exception as error:
+        logger.exception("export %s failed", job_id)
+        part_path.unlink(missing_ok=True)
+        update_job(
+            job_id, status="failed", error=str(error), finished_at=datetime.now()
+        )
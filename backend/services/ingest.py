@@ -0,0 +1,233 @@
+#####
+# Ingest of messages pushed by the messaging pipeline (POST /messages/ingest)
+#    - validated messages wait in a bounded in-process queue, a full queue is answered with
+#      a 429 so the pipeline slows down instead of the api running out of memory
+#    - one writer thread inserts the queue in batched transactions, messages that arrive
+#      while a batch is written make up the next one. A batch merges the messages of many
+#      requests, when it keeps failing its messages are written one at a time so a bad one
+#      only fails itself
+#    - a small pool classifies every written message against the active compliance version
+#    - accepted messages are buffered, not durable: a stopped process loses what it has not
+#      written yet, the lifespan of the app drains the queue on a clean shutdown
+#####
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.dialects.sqlite import insert
+
+from db import database
+from db.models import Message
+from db.partitions import archived_message_ids
+from db.texts import store_message_texts
+from routers.classify import select_with_classification
+from services.classifications import (
+    active_compliance_version,
+    resolve_classifications,
+)
+from services.matcher import get_matcher
+from services.metrics import Counter, Gauge, registry
+from services.response_cache import bump_data_version
+
+logger = logging.getLogger(__name__)
+
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "50000"))
+# sqlite has a single writer, more classify threads mostly wait on each other
+INGEST_CLASSIFY_WORKERS = int(os.environ.get("INGEST_CLASSIFY_WORKERS", "1"))
+
+# most messages per write transaction
+INGEST_BATCH_SIZE = 2000
+# attempts of a batch before it is dropped (e.g. the database stays locked)
+INGEST_WRITE_ATTEMPTS = 3
+# seconds a client should wait after a 429
+INGEST_RETRY_AFTER = 1
+
+INGEST_MESSAGES = registry.register(
+    Counter(
+        "ingest_messages_total",
+        "Ingested messages by result (accepted, rejected, written, failed, classified)",
+        ("result",),
+    )
+)
+INGEST_QUEUED = registry.register(
+    Gauge("ingest_queue_messages", "Messages waiting for the ingest writer")
+)
+
+
+##
+# Writing and classifying
+##
+
+
+def write_messages(rows: list[dict]):
+    """Inserts a batch of messages in one transaction, ids that already exist are skipped"""
+    # a retried pipeline batch is not an error, the stored message wins
+    with database.SessionLocal() as db:
+        # an id in messages is skipped by the conflict, one in a partition has to be looked up
+        archived_ids = archived_message_ids(
+            db.connection(), [(row["message_id"], row["timestamp"]) for row in rows]
+        )
+        rows = [row for row in rows if row["message_id"] not in archived_ids]
+        if not rows:
+            return
+        # repeated texts (e.g. campaign copy) are stored once
+        message_rows = store_message_texts(db, rows)
+        db.execute(insert(Message.__table__).on_conflict_do_nothing(), message_rows)
+        bump_data_version(db)
+        db.commit()
+
+
+def classify_messages(message_ids: list[int]):
+    """Stores the classification of the messages under the active compliance version"""
+    with database.SessionLocal() as db:
+        compliance_version = active_compliance_version(db)
+        if compliance_version is None:
+            return
+        matcher = get_matcher(db, compliance_version)
+        stmt = select_with_classification(compliance_version).where(
+            Message.message_id.in_(message_ids)
+        )
+        rows = [tuple(row) for row in db.execute(stmt)]
+        # already classified (e.g. duplicate) messages are reused, not matched again
+        resolve_classifications(db, matcher, compliance_version, rows)
+        db.commit()
+    INGEST_MESSAGES.inc(("classified",), len(rows))
+
+
+##
+# Queue
+##
+
+
+class IngestQueue:
+    """Bounded buffer of parsed messages between the ingest endpoint and the writer thread"""
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self._messages: deque[dict] = deque()
+        self._condition = threading.Condition()
+        # messages taken by the writer or the classify pool and not done yet
+        self._writing = 0
+        self._classifying = 0
+        self._writer: threading.Thread | None = None
+        self._closing = False
+        self._classify_executor = ThreadPoolExecutor(
+            max_workers=INGEST_CLASSIFY_WORKERS, thread_name_prefix="ingest-classify"
+        )
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def offer(self, messages: list[dict]) -> bool:
+        """Queues every message or, when they do not all fit, none of them"""
+        with self._condition:
+            if len(self._messages) + len(messages) > self.max_messages:
+                INGEST_MESSAGES.inc(("rejected",), len(messages))
+                return False
+            self._messages.extend(messages)
+            INGEST_MESSAGES.inc(("accepted",), len(messages))
+            INGEST_QUEUED.inc(amount=len(messages))
+            # started by the first ingest so imports (tests, db.manage) start no thread
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._run_writer, name="ingest-writer", daemon=True
+                )
+                self._writer.start()
+            self._condition.notify_all()
+        return True
+
+    def wait_until_idle(self, timeout: float | None = None) -> bool:
+        """Waits until every queued message is written and classified"""
+        with self._condition:
+            return self._condition.wait_for(self._is_idle, timeout)
+
+    def close(self, timeout: float | None = None):
+        """Writes what is queued and stops the writer, the next offer starts a new one"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+            writer = self._writer
+        if writer is not None:
+            writer.join(timeout)
+        self.wait_until_idle(timeout)
+        with self._condition:
+            self._writer = None
+            self._closing = False
+
+    def _is_idle(self) -> bool:
+        return not self._messages and not self._writing and not self._classifying
+
+    def _take_batch(self) -> list[dict] | None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._messages or self._closing)
+            if not self._messages:
+                return None
+            batch_size = min(len(self._messages), INGEST_BATCH_SIZE)
+            batch = [self._messages.popleft() for _ in range(batch_size)]
+            self._writing = batch_size
+            INGEST_QUEUED.dec(amount=batch_size)
+            return batch
+
+    def _run_writer(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            written = self._write_batch(batch)
+            with self._condition:
+                self._writing = 0
+                self._classifying += len(written)
+                self._condition.notify_all()
+            if written:
+                message_ids = [message["message_id"] for message in written]
+                future = self._classify_executor.submit(classify_messages, message_ids)
+                future.add_done_callback(
+                    lambda future, count=len(written): self._classified(future, count)
+                )
+
+    def _write_batch(self, batch: list[dict]) -> list[dict]:
+        """Writes the batch, returns the messages that were written"""
+        for attempt in range(INGEST_WRITE_ATTEMPTS):
+            try:
+                write_messages(batch)
+                INGEST_MESSAGES.inc(("written",), len(batch))
+                return batch
+            except Exception:
+                logger.exception(
+                    "ingest batch of %d messages failed (attempt %d of %d)",
+                    len(batch),
+                    attempt + 1,
+                    INGEST_WRITE_ATTEMPTS,
+                )
+                time.sleep(0.1 * 2**attempt)
+
+        # the messages of other requests in the batch are not dropped with a bad one
+        written = []
+        for message in batch:
+            try:
+                write_messages([message])
+            except Exception:
+                logger.exception("ingested message %s failed", message["message_id"])
+                INGEST_MESSAGES.inc(("failed",))
+                continue
+            INGEST_MESSAGES.inc(("written",))
+            written.append(message)
+        return written
+
+    def _classified(self, future, count: int):
+        if future.exception() is not None:
+            logger.error(
+                "classifying %d ingested messages failed",
+                count,
+                exc_info=future.exception(),
+            )
+        with self._condition:
+            self._classifying -= count
+            self._condition.notify_all()
+
+
+ingest_queue = IngestQueue(INGEST_QUEUE_SIZE)
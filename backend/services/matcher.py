@@ -0,0 +1,174 @@
+#####
+# Compiled keyword matching for compliance rules
+#    - one Aho-Corasick automaton per compliance version
+#    - built once from the rules/anykeywords tables and cached in process
+#    - a cached matcher is used while the rules revision of its version is unchanged, a
+#      policy load in any process (e.g. db.manage load-policy) bumps the revision
+#####
+
+from dataclasses import dataclass
+from collections import deque
+
+from sqlalchemy import Connection, Select, select, update
+from sqlalchemy.orm import Session
+
+from db.models import ComplianceVersion, Rule, AnyKeyword
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledRule:
+    id: str
+    name: str
+    result_type: str
+    result_text: str
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over the case folded keywords of a single compliance version
+
+    matching is a substring match, the same semantics as the old
+    `lower(message_text) LIKE '%' || lower(keyword) || '%'` query
+    """
+
+    def __init__(
+        self,
+        rules: list[CompiledRule],
+        keywords: list[tuple[str, str]],
+        revision: int | None = None,
+    ):
+        # rules revision of the compliance version the matcher was built from, None when
+        # the version does not exist
+        self.revision = revision
+        # rule id -> rule, iterated in rule id order to match the old `order by Rule.id`
+        self.rules = {rule.id: rule for rule in sorted(rules, key=lambda r: r.id)}
+
+        # distinct (rule_id, keyword) pairs, the old query selected distinct keywords
+        self.keywords: list[tuple[str, str]] = sorted(set(keywords))
+
+        # trie of the folded keywords, node 0 is the root
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[int]] = [[]]
+
+        for keyword_index, (_, keyword) in enumerate(self.keywords):
+            node = 0
+            for char in keyword.lower():
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][char] = next_node
+                node = next_node
+            self._out[node].append(keyword_index)
+
+        # breadth first to fill in the failure links, each node also inherits
+        # the outputs of its failure node so a match is never missed
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def _find(self, text: str) -> set[int]:
+        """Indexes into self.keywords of every keyword found in the text"""
+        goto, fail, out = self._goto, self._fail, self._out
+
+        # an empty keyword matches every message just like LIKE '%%'
+        found: set[int] = set(out[0])
+        node = 0
+        for char in text.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def match(self, text: str) -> dict[str, list[str]]:
+        """Single pass over the text returning matched keywords grouped by rule id (in rule id order)"""
+        matches: dict[str, list[str]] = {}
+        # keywords are sorted by (rule_id, keyword) so the indexes are already grouped
+        for keyword_index in sorted(self._find(text)):
+            rule_id, keyword = self.keywords[keyword_index]
+            if rule_id in self.rules:
+                matches.setdefault(rule_id, []).append(keyword)
+        return matches
+
+    def matched_keywords(self, text: str) -> set[str]:
+        """Case folded keywords found in the text regardless of their rule"""
+        return {self.keywords[i][1].lower() for i in self._find(text)}
+
+
+def select_rules(compliance_version: str) -> Select:
+    return select(Rule.id, Rule.name, Rule.result_type, Rule.result_text).where(
+        Rule.compliance_version == compliance_version
+    )
+
+
+def select_keywords(compliance_version: str) -> Select:
+    return select(AnyKeyword.rule_id, AnyKeyword.keyword).where(
+        AnyKeyword.compliance_version == compliance_version
+    )
+
+
+def select_rules_revision(compliance_version: str) -> Select:
+    return select(ComplianceVersion.rules_revision).where(
+        ComplianceVersion.version == compliance_version
+    )
+
+
+def bump_rules_revision(db: Session | Connection, compliance_version: str):
+    """Marks the compiled matchers of the version as stale in every process, call it in the
+    transaction that changes its rules or keywords"""
+    db.execute(
+        update(ComplianceVersion)
+        .where(ComplianceVersion.version == compliance_version)
+        .values(rules_revision=ComplianceVersion.rules_revision + 1)
+    )
+
+
+def build_matcher(
+    db: Session, compliance_version: str, revision: int | None = None
+) -> KeywordMatcher:
+    rules = [CompiledRule(*row) for row in db.execute(select_rules(compliance_version))]
+    keywords = [
+        (rule_id, keyword)
+        for rule_id, keyword in db.execute(select_keywords(compliance_version))
+    ]
+    return KeywordMatcher(rules, keywords, revision)
+
+
+# compiled matchers are shared by every request in the process
+_matchers: dict[str, KeywordMatcher] = {}
+
+
+def get_matcher(db: Session, compliance_version: str) -> KeywordMatcher:
+    # a single row lookup, the rules may have been changed by another process
+    revision = db.execute(
+        select_rules_revision(compliance_version)
+    ).scalar_one_or_none()
+    matcher = _matchers.get(compliance_version)
+    if matcher is not None and matcher.revision == revision:
+        return matcher
+
+    # no lock is held while building, concurrent first requests may both build the
+    # matcher but a lock held across the queries would block the event loop when this
+    # runs through AsyncSession.run_sync. A build that raced a policy load is labelled
+    # with the older revision it read first, so it is rebuilt on the next lookup
+    matcher = build_matcher(db, compliance_version, revision)
+    # a version without rules (e.g. a typo of a client) is not kept, any string can be sent
+    if matcher.rules:
+        _matchers[compliance_version] = matcher
+    return matcher
+
+
+def invalidate_matchers():
+    """Drops the matchers of this process, other processes rebuild on the next revision"""
+    _matchers.clear()
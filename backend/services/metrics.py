@@ -0,0 +1,331 @@
+#####
+# Request and SQL metrics, exposed in the prometheus text format on /metrics
+#    - every request records its latency, status and in flight count per route template
+#      (e.g. "/classify/{message_id}") so the number of label values stays bounded
+#    - every SQL statement executed while handling a request is counted and timed
+#      through sqlalchemy cursor events, a request over QUERY_BUDGET statements is flagged
+#    - a request is recorded once its response starts, a streamed body (the classify batch)
+#      and the statements it executes are not included
+#####
+
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterator
+
+from fastapi import Request
+from sqlalchemy import Engine, event
+from starlette.routing import BaseRoute, Match
+
+# statements per request above which the request is logged and counted, catches N+1 queries
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", "10"))
+LATENT_REQUEST_THRESHOLD_SECONDS = 0.1
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = tuple[str, ...]
+
+
+def format_labels(names: tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = Lock()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: Labels = ()) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: Labels = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: Labels = ()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        # labels -> (non cumulative count per bucket with a last +Inf bucket, sum)
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        with self._lock:
+            counts, _ = self._values.get(labels, ([0], [0.0]))
+            return sum(counts)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}"
+                )
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {format_value(total[0])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register[M: Metric](self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LABELS = ("method", "route")
+
+REQUESTS = registry.register(
+    Counter(
+        "http_requests_total",
+        "Requests by route and status",
+        (*REQUEST_LABELS, "status"),
+    )
+)
+REQUEST_ERRORS = registry.register(
+    Counter(
+        "http_request_errors_total",
+        "Requests answered with a 4xx/5xx status or an unhandled exception",
+        (*REQUEST_LABELS, "status"),
+    )
+)
+REQUESTS_IN_FLIGHT = registry.register(
+    Gauge("http_requests_in_flight", "Requests being handled", REQUEST_LABELS)
+)
+REQUEST_LATENCY = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time until the response starts, streamed bodies are not included",
+        REQUEST_LABELS,
+    )
+)
+REQUEST_QUERIES = registry.register(
+    Histogram(
+        "db_queries_per_request",
+        "SQL statements executed per request",
+        REQUEST_LABELS,
+        QUERY_COUNT_BUCKETS,
+    )
+)
+REQUEST_DB_TIME = registry.register(
+    Histogram(
+        "db_time_per_request_seconds",
+        "Time spent executing SQL statements per request",
+        REQUEST_LABELS,
+    )
+)
+QUERY_BUDGET_EXCEEDED = registry.register(
+    Counter(
+        "db_query_budget_exceeded_total",
+        f"Requests that executed more than QUERY_BUDGET ({QUERY_BUDGET}) statements",
+        REQUEST_LABELS,
+    )
+)
+
+
+##
+# SQL statement tracking
+##
+
+
+@dataclass(slots=True)
+class QueryStats:
+    query_count: int = 0
+    db_seconds: float = 0.0
+    # the tracking this one is nested in (a profiled request), it counts the statements too
+    parent: "QueryStats | None" = None
+
+
+# a mutable holder, the sync handlers run on a copy of the request context in the
+# threadpool so only changes to the object (not the variable) are seen by the middleware
+_query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """Counts and times every statement executed in this context (and tasks/ threads started from it)"""
+    stats = QueryStats(parent=_query_stats.get())
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+# the start time is kept on the execution context of the statement, a statement that
+# raises never reaches after_cursor_execute and its context is dropped with it
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _query_stats.get() is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _query_stats.get()
+    start_time = getattr(context, "_query_start", None)
+    if stats is None or start_time is None:
+        return
+    elapsed = time.perf_counter() - start_time
+    while stats is not None:
+        stats.query_count += 1
+        stats.db_seconds += elapsed
+        stats = stats.parent
+
+
+##
+# Request middleware
+##
+
+
+def iter_routes(routes: list[BaseRoute]) -> Iterator[BaseRoute]:
+    for route in routes:
+        # newer fastapi versions wrap an included router instead of copying its routes
+        original_router = getattr(route, "original_router", None)
+        if original_router is not None:
+            yield from iter_routes(original_router.routes)
+        else:
+            yield route
+
+
+def route_template(request: Request) -> str:
+    # the path template of the matching route, unmatched paths share one label value
+    template = request.scope.get("route_template")
+    if template is not None:
+        return template
+    template = "unmatched"
+    for route in iter_routes(request.app.router.routes):
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            template = getattr(route, "path", "unmatched")
+            break
+    # kept for the middlewares further in (admission control)
+    request.scope["route_template"] = template
+    return template
+
+
+def record_request(labels: Labels, status: int, seconds: float, stats: QueryStats):
+    status_label = str(status)
+    REQUESTS.inc((*labels, status_label))
+    if status >= 400:
+        REQUEST_ERRORS.inc((*labels, status_label))
+    REQUEST_LATENCY.observe(seconds, labels)
+    REQUEST_QUERIES.observe(stats.query_count, labels)
+    REQUEST_DB_TIME.observe(stats.db_seconds, labels)
+
+    method, route = labels
+    if stats.query_count > QUERY_BUDGET:
+        QUERY_BUDGET_EXCEEDED.inc(labels)
+        logging.warning(
+            f"Request '{method} {route}' executed {stats.query_count} SQL statements "
+            f"(budget {QUERY_BUDGET})"
+        )
+    if seconds > LATENT_REQUEST_THRESHOLD_SECONDS:
+        logging.warning(
+            f"Slow request '{method} {route}' took {seconds:.2f}s "
+            f"({stats.query_count} statements, {stats.db_seconds:.2f}s in the db)"
+        )
+    else:
+        logging.debug(f"Request '{method} {route}' took {seconds:.2f}s")
+
+
+async def metrics_middleware(request: Request, call_next):
+    labels = (request.method, route_template(request))
+    REQUESTS_IN_FLIGHT.inc(labels)
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        with track_queries() as stats:
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec(labels)
+        record_request(labels, status, time.perf_counter() - start_time, stats)
@@ -0,0 +1,341 @@
+#####
+# In-process physician directory for type-ahead search (/physicians/search)
+#    - a snapshot of every physician as slotted records, ordered by (last name, first
+#      name, id), rebuilt when the data version changes (checked every few seconds)
+#    - sorted prefix indexes on last name, first name, npi and specialty: a prefix is a
+#      contiguous range found with two binary searches
+#    - posting lists of record positions per state and per specialty, a filtered search
+#      walks the shorter of the posting list and the prefix ranges
+#####
+
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Callable, Iterable, Iterator
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from db.models import Physician
+from services.response_cache import DATA_VERSION_STMT
+
+# seconds a directory is served before the data version is checked again, the version
+# changes with every message write too (e.g. ingest) so this also bounds the rebuilds
+PHYSICIAN_DIRECTORY_REFRESH_SECONDS = float(
+    os.environ.get("PHYSICIAN_DIRECTORY_REFRESH_SECONDS", "5")
+)
+
+# searched in this order, a physician is listed under the first field a term matches
+PREFIX_FIELDS = ("last_name", "first_name", "npi", "specialty")
+# sorts after every character so (prefix + PREFIX_END) ends the range of a prefix
+PREFIX_END = "\U0010ffff"
+EMPTY_POSTING = array("i")
+
+
+@dataclass(slots=True)
+class PhysicianRecord:
+    physician_id: int
+    npi: str
+    first_name: str
+    last_name: str
+    specialty: str
+    state: str
+    consent_opt_in: bool
+    preferred_channel: str
+
+
+class PrefixIndex:
+    """Sorted (folded value, record position) pairs kept as two parallel columns"""
+
+    def __init__(self, values: list[str]):
+        order = sorted(range(len(values)), key=values.__getitem__)
+        self.keys = [values[position] for position in order]
+        self.positions = array("i", order)
+
+    def range(self, prefix: str) -> tuple[int, int]:
+        return (
+            bisect_left(self.keys, prefix),
+            bisect_right(self.keys, prefix + PREFIX_END),
+        )
+
+
+class PhysicianDirectory:
+    """Immutable snapshot of the physicians table at one data version"""
+
+    def __init__(self, records: list[PhysicianRecord], data_version: int):
+        self.data_version = data_version
+
+        def folded_column(field: str) -> list[str]:
+            column = list(map(attrgetter(field), records))
+            # names, specialties and states repeat a lot, each is folded once
+            folded = {value: value.casefold() for value in set(column)}
+            return [folded[value] for value in column]
+
+        columns = {field: folded_column(field) for field in [*PREFIX_FIELDS, "state"]}
+        # records are kept in last name order, so a last name range is a range of positions
+        last_names, first_names = columns["last_name"], columns["first_name"]
+        order = sorted(
+            range(len(records)),
+            key=lambda i: (last_names[i], first_names[i], records[i].physician_id),
+        )
+        self.records = [records[i] for i in order]
+        columns = {
+            field: [column[i] for i in order] for field, column in columns.items()
+        }
+
+        # folded field values per record, compared against the search terms
+        self.folded = {field: columns[field] for field in PREFIX_FIELDS}
+        self.last_names = columns["last_name"]
+        self.indexes = {
+            field: PrefixIndex(self.folded[field]) for field in PREFIX_FIELDS[1:]
+        }
+
+        # folded values of the exact match filters and their posting lists, both filters
+        # at once have their own lists so a combined filter is not an intersection
+        self.filter_values = {
+            "state": columns["state"],
+            "specialty": columns["specialty"],
+        }
+        pairs: dict[tuple[str, str], list[int]] = {}
+        for position, key in enumerate(zip(columns["state"], columns["specialty"])):
+            pairs.setdefault(key, []).append(position)
+        merged: dict[tuple[str | None, str | None], list[int]] = {}
+        for (state, specialty), positions in pairs.items():
+            merged.setdefault((state, None), []).extend(positions)
+            merged.setdefault((None, specialty), []).extend(positions)
+        self.postings: dict[tuple[str | None, str | None], array] = {
+            key: array("i", positions) for key, positions in pairs.items()
+        }
+        for key, positions in merged.items():
+            positions.sort()
+            self.postings[key] = array("i", positions)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _field_range(self, field_index: int, term: str) -> tuple[int, int]:
+        if field_index == 0:
+            return (
+                bisect_left(self.last_names, term),
+                bisect_right(self.last_names, term + PREFIX_END),
+            )
+        return self.indexes[PREFIX_FIELDS[field_index]].range(term)
+
+    def _first_matching_field(self, position: int, term: str) -> int | None:
+        for field_index, field in enumerate(PREFIX_FIELDS):
+            if self.folded[field][position].startswith(term):
+                return field_index
+        return None
+
+    def _matches_terms(self, position: int, terms: list[str]) -> bool:
+        return all(
+            self._first_matching_field(position, term) is not None for term in terms
+        )
+
+    def _iter_field(
+        self, field_index: int, term: str, posting: array | None, limit: int
+    ) -> Iterator[int]:
+        """Positions of records listed under the field for the term, in index order
+
+        walks the index range of the term, or the posting list of the filters when that
+        is expected to be shorter than finding `limit` filtered records in the range
+        """
+        start, end = self._field_range(field_index, term)
+        if posting is not None and field_index == 0:
+            # the posting list is sorted by position, the range is a slice of it
+            yield from posting[bisect_left(posting, start) : bisect_left(posting, end)]
+            return
+
+        expected_scan = end - start
+        if posting:
+            expected_scan = min(expected_scan, limit * len(self) // len(posting))
+        if posting is None or expected_scan <= len(posting):
+            positions = (
+                range(start, end)
+                if field_index == 0
+                else self.indexes[PREFIX_FIELDS[field_index]].positions[start:end]
+            )
+            for position in positions:
+                # listed under an earlier field already
+                if self._first_matching_field(position, term) == field_index:
+                    yield position
+            return
+
+        values = self.folded[PREFIX_FIELDS[field_index]]
+        matches = [
+            position
+            for position in posting
+            if values[position].startswith(term)
+            and self._first_matching_field(position, term) == field_index
+        ]
+        # index order is (folded value, position)
+        matches.sort(key=lambda position: (values[position], position))
+        yield from matches
+
+    def search(
+        self,
+        prefix: str,
+        state: str | None = None,
+        specialty: str | None = None,
+        limit: int = 20,
+    ) -> list[PhysicianRecord]:
+        """Physicians with a name, npi or specialty starting with every term of the prefix
+
+        ordered by the field the most selective term matches (last name, first name, npi,
+        specialty) and then by that field
+        """
+        terms = [term.casefold() for term in prefix.split()]
+        if not terms:
+            return []
+
+        # the term with the fewest candidates drives the search, the others are checks
+        def candidate_count(term: str) -> int:
+            return sum(
+                end - start
+                for start, end in (
+                    self._field_range(field_index, term)
+                    for field_index in range(len(PREFIX_FIELDS))
+                )
+            )
+
+        driving_term = min(terms, key=candidate_count)
+        other_terms = [term for term in terms if term != driving_term]
+
+        filters = {}
+        if state is not None:
+            filters["state"] = state.casefold()
+        if specialty is not None:
+            filters["specialty"] = specialty.casefold()
+        posting = None
+        if filters:
+            key = (filters.get("state"), filters.get("specialty"))
+            posting = self.postings.get(key, EMPTY_POSTING)
+
+        results = []
+        for field_index in range(len(PREFIX_FIELDS)):
+            for position in self._iter_field(field_index, driving_term, posting, limit):
+                if any(
+                    self.filter_values[name][position] != value
+                    for name, value in filters.items()
+                ):
+                    continue
+                if other_terms and not self._matches_terms(position, other_terms):
+                    continue
+                results.append(self.records[position])
+                if len(results) == limit:
+                    return results
+        return results
+
+
+PHYSICIAN_ROWS_STMT = select(
+    *(getattr(Physician, field) for field in PhysicianRecord.__slots__)
+)
+
+
+def physician_records(rows: Iterable[tuple]) -> list[PhysicianRecord]:
+    # one string object per distinct value instead of one per row
+    shared: dict[str, str] = {}
+    return [
+        PhysicianRecord(
+            physician_id,
+            npi,
+            shared.setdefault(first_name, first_name),
+            shared.setdefault(last_name, last_name),
+            shared.setdefault(specialty, specialty),
+            shared.setdefault(state, state),
+            consent_opt_in,
+            shared.setdefault(preferred_channel, preferred_channel),
+        )
+        for (
+            physician_id,
+            npi,
+            first_name,
+            last_name,
+            specialty,
+            state,
+            consent_opt_in,
+            preferred_channel,
+        ) in rows
+    ]
+
+
+class DirectoryHolder:
+    """The current directory, rebuilt by the first request that sees a new data version"""
+
+    def __init__(self):
+        self.directory: PhysicianDirectory | None = None
+        self._checked_at = 0.0
+        self._rebuild_lock = threading.Lock()
+
+    def _recently_checked(self, now: float) -> PhysicianDirectory | None:
+        directory = self.directory
+        if (
+            directory is not None
+            and now - self._checked_at < PHYSICIAN_DIRECTORY_REFRESH_SECONDS
+        ):
+            return directory
+        return None
+
+    def _rebuild(
+        self, now: float, data_version: int, read_rows: Callable[[], Iterable[tuple]]
+    ) -> PhysicianDirectory:
+        directory = self.directory
+        if directory is not None and directory.data_version == data_version:
+            self._checked_at = now
+            return directory
+
+        # other requests keep answering from the old snapshot while one rebuilds, only the
+        # first build is waited for
+        if not self._rebuild_lock.acquire(blocking=directory is None):
+            return directory
+        try:
+            current = self.directory
+            if current is None or current.data_version != data_version:
+                records = physician_records(read_rows())
+                self.directory = PhysicianDirectory(records, data_version)
+            self._checked_at = now
+            return self.directory
+        finally:
+            self._rebuild_lock.release()
+
+    def current(self, db: Session) -> PhysicianDirectory:
+        now = time.monotonic()
+        directory = self._recently_checked(now)
+        if directory is not None:
+            return directory
+        data_version = db.execute(DATA_VERSION_STMT).scalar_one()
+        return self._rebuild(
+            now,
+            data_version,
+            lambda: db.connection().execute(PHYSICIAN_ROWS_STMT).all(),
+        )
+
+    async def current_async(self, db: AsyncSession) -> PhysicianDirectory:
+        """current() for the async routes, the build never runs on the event loop
+
+        sorting and indexing the snapshot is cpu bound and waiting for the first build takes
+        the rebuild lock, both happen in the threadpool, only the reads are awaited
+        """
+        now = time.monotonic()
+        directory = self._recently_checked(now)
+        if directory is not None:
+            return directory
+        data_version = (await db.execute(DATA_VERSION_STMT)).scalar_one()
+        directory = self.directory
+        if directory is not None and directory.data_version == data_version:
+            self._checked_at = now
+            return directory
+        if directory is not None and self._rebuild_lock.locked():
+            return directory
+        connection = await db.connection()
+        rows = (await connection.execute(PHYSICIAN_ROWS_STMT)).all()
+        return await run_in_threadpool(self._rebuild, now, data_version, lambda: rows)
+
+
+physician_directory = DirectoryHolder()
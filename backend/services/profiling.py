@@ -0,0 +1,435 @@
+#####
+# Opt-in profiling of the live api
+#    - off unless PROFILE_TOKEN is set, a request with the token in its X-Profile-Token
+#      header runs under a deterministic profiler: every python and C call of the threads
+#      handling it (the event loop task and the threadpool workers of the sync handlers)
+#      is timed into a call tree
+#    - the self time of every call is attributed to a phase (db, orm, validation,
+#      serialization, app, framework) by the package it belongs to, a call outside of any
+#      (the stdlib, builtins) belongs to the phase of its caller
+#    - the report is saved to PROFILE_DIR, the response carries its id (X-Profile-Id) and
+#      the phases as a Server-Timing header
+#    - one request is profiled at a time, the profile hook slows every thread down while
+#      it is installed and the profiled request several times over
+#    - SAMPLING_PROFILER=1 starts a background thread that samples the stacks of every
+#      busy thread every SAMPLING_INTERVAL_MS, POST /debug/flamegraph writes the samples
+#      as collapsed stacks (flamegraph.pl, speedscope)
+#####
+
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from types import CodeType, FrameType
+from typing import Any
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from services.metrics import route_template, track_queries
+
+# profiling is off without a token, it is compared with the X-Profile-Token header
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_HEADER = "x-profile-token"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+SAMPLING_PROFILER = os.environ.get("SAMPLING_PROFILER", "0") == "1"
+SAMPLING_INTERVAL_MS = float(os.environ.get("SAMPLING_INTERVAL_MS", "10"))
+
+# calls under this share of the request are left out of the call tree report
+REPORT_MIN_SHARE = 0.01
+# distinct stacks kept by the sampler, later new stacks are counted as truncated
+SAMPLING_MAX_STACKS = 50_000
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ("db", "orm", "validation", "serialization", "app", "framework", "other")
+# top level modules and packages of the backend
+APP_MODULES = ("db", "routers", "services", "main.py")
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN)
+
+
+def valid_token(token: str | None) -> bool:
+    if not PROFILE_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def profile_requested(request: Request) -> bool:
+    """The request asked to be profiled with the right token"""
+    return valid_token(request.headers.get(PROFILE_HEADER))
+
+
+##
+# Names and phases of the profiled calls
+##
+
+# (file, first line, name), the file is relative to its sys.path entry, C functions
+# have no file
+CallKey = tuple[str, int, str]
+
+_short_paths: dict[str, str] = {}
+
+
+def short_path(filename: str) -> str:
+    """Path relative to the backend or its sys.path entry, e.g. sqlalchemy/orm/query.py"""
+    cached = _short_paths.get(filename)
+    if cached is not None:
+        return cached
+    roots = sorted(
+        (path for path in [BACKEND_DIR, *sys.path] if path and os.path.isabs(path)),
+        key=len,
+        reverse=True,
+    )
+    short = filename
+    for root in roots:
+        if filename.startswith(root + os.sep):
+            short = filename[len(root) + 1 :]
+            break
+    _short_paths[filename] = short
+    return short
+
+
+def code_key(code: CodeType) -> CallKey:
+    return short_path(code.co_filename), code.co_firstlineno, code.co_qualname
+
+
+def c_function_key(function: Any) -> CallKey:
+    # e.g. sqlite3.Cursor.execute, builtins.isinstance
+    owner = getattr(function, "__self__", None)
+    module = getattr(function, "__module__", None)
+    if module is None and owner is not None:
+        module = type(owner).__module__
+    name = getattr(function, "__qualname__", repr(function))
+    return "", 0, f"{module or 'builtins'}.{name}"
+
+
+def call_phase(key: CallKey) -> str | None:
+    """Phase of a call by its package, None for calls that belong to their caller"""
+    path, _, name = key
+    if not path:
+        if name.startswith(("sqlite3.", "_sqlite3.")):
+            return "db"
+        if "SchemaSerializer" in name or name.startswith(("_json.", "orjson.")):
+            return "serialization"
+        if "SchemaValidator" in name:
+            return "validation"
+        return None
+    if path.startswith("aiosqlite/"):
+        return "db"
+    if path.startswith("sqlalchemy/"):
+        return "orm"
+    if path.startswith(("pydantic/", "pydantic_core/")):
+        if name.startswith(("BaseModel.model_dump", "BaseModel.__repr")):
+            return "serialization"
+        return "validation"
+    if (
+        path.startswith(("json/", "fastapi/encoders.py", "starlette/responses.py"))
+        or name == "serialize_response"
+    ):
+        return "serialization"
+    if path.startswith(("fastapi/", "starlette/", "anyio/", "uvicorn/")):
+        return "framework"
+    if path.split("/", 1)[0] in APP_MODULES:
+        return "app"
+    return None
+
+
+##
+# Deterministic call tree of one request
+##
+
+
+@dataclass(slots=True)
+class CallNode:
+    key: CallKey
+    calls: int = 0
+    total_seconds: float = 0.0
+    children: dict[CallKey, "CallNode"] = field(default_factory=dict)
+
+    def child(self, key: CallKey) -> "CallNode":
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = CallNode(key)
+        return node
+
+    @property
+    def self_seconds(self) -> float:
+        children_seconds = sum(c.total_seconds for c in self.children.values())
+        return max(0.0, self.total_seconds - children_seconds)
+
+
+class CallTreeProfiler:
+    """Times every call of the threads running in the context of one request
+
+    installed on every thread (threading.setprofile_all_threads), calls of other requests
+    are skipped by the context variable check, each thread has its own stack of open calls
+    """
+
+    def __init__(self):
+        self.root = CallNode(("", 0, "request"))
+        # thread id -> [(node, start time)] of its open calls
+        self._stacks: dict[int, list[tuple[CallNode, float]]] = {}
+
+    def dispatch(self, frame: FrameType, event: str, arg: Any):
+        if _profiler.get() is not self:
+            return
+        now = time.perf_counter()
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        if event == "call" or event == "c_call":
+            key = code_key(frame.f_code) if event == "call" else c_function_key(arg)
+            parent = stack[-1][0] if stack else self.root
+            node = parent.child(key)
+            node.calls += 1
+            stack.append((node, now))
+        elif stack:
+            # return, c_return or c_exception, calls entered before the profiler was
+            # installed have no open entry
+            node, start_time = stack.pop()
+            node.total_seconds += now - start_time
+
+    def close(self):
+        """Ends the calls still open (e.g. the middleware itself)"""
+        now = time.perf_counter()
+        for stack in self._stacks.values():
+            while stack:
+                node, start_time = stack.pop()
+                node.total_seconds += now - start_time
+        self.root.total_seconds = sum(
+            c.total_seconds for c in self.root.children.values()
+        )
+
+
+_profiler: ContextVar[CallTreeProfiler | None] = ContextVar("profiler", default=None)
+# the profile hook is process wide, one profiled request at a time
+_profile_lock = threading.Lock()
+
+
+def phase_seconds(root: CallNode) -> dict[str, float]:
+    """Self time of every call added up per phase, calls without one inherit their caller's"""
+    seconds = dict.fromkeys(PHASES, 0.0)
+    pending = [(child, "other") for child in root.children.values()]
+    while pending:
+        node, inherited = pending.pop()
+        phase = call_phase(node.key) or inherited
+        seconds[phase] += node.self_seconds
+        pending.extend((child, phase) for child in node.children.values())
+    return seconds
+
+
+def format_call(key: CallKey) -> str:
+    path, line, name = key
+    return f"{name} ({path}:{line})" if path else name
+
+
+def format_report(
+    title: str, root: CallNode, phases: dict[str, float], query_count: int
+) -> str:
+    total = root.total_seconds or 1e-9
+    lines = [title, ""]
+    lines.append(f"{'phase':<14} {'ms':>10} {'share':>7}")
+    for phase, seconds in phases.items():
+        lines.append(f"{phase:<14} {seconds * 1000:>10.2f} {seconds / total:>7.1%}")
+    lines.append(f"{'total':<14} {total * 1000:>10.2f}   ({query_count} statements)")
+    lines.append("")
+    lines.append(f"call tree (calls over {REPORT_MIN_SHARE:.0%} of the total)")
+    lines.append(f"{'total ms':>10} {'self ms':>10} {'calls':>7}  call")
+
+    def add_node(node: CallNode, depth: int, inherited: str):
+        phase = call_phase(node.key) or inherited
+        lines.append(
+            f"{node.total_seconds * 1000:>10.2f} {node.self_seconds * 1000:>10.2f} "
+            f"{node.calls:>7}  {'  ' * depth}{format_call(node.key)} [{phase}]"
+        )
+        children = sorted(
+            node.children.values(), key=lambda c: c.total_seconds, reverse=True
+        )
+        for child in children:
+            if child.total_seconds >= total * REPORT_MIN_SHARE:
+                add_node(child, depth + 1, phase)
+
+    for child in sorted(
+        root.children.values(), key=lambda c: c.total_seconds, reverse=True
+    ):
+        if child.total_seconds >= total * REPORT_MIN_SHARE:
+            add_node(child, 0, "other")
+    return "\n".join(lines) + "\n"
+
+
+def profile_path(profile_id: str) -> str:
+    return os.path.join(PROFILE_DIR, f"request-{profile_id}.txt")
+
+
+def save_report(profile_id: str, report: str):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(profile_path(profile_id), "w") as f:
+        f.write(report)
+
+
+def read_report(profile_id: str) -> str | None:
+    # ids are generated hex strings, anything else is not a report
+    if not profile_id.isalnum():
+        return None
+    try:
+        with open(profile_path(profile_id)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def server_timing(phases: dict[str, float]) -> str:
+    return ", ".join(
+        f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in phases.items()
+    )
+
+
+async def profiling_middleware(request: Request, call_next):
+    if not profile_requested(request) or request.url.path.startswith("/debug/"):
+        return await call_next(request)
+    if not _profile_lock.acquire(blocking=False):
+        # another request is being profiled, this one runs as usual
+        response = await call_next(request)
+        response.headers["x-profile-id"] = "busy"
+        return response
+
+    profiler = CallTreeProfiler()
+    token = _profiler.set(profiler)
+    threading.setprofile_all_threads(profiler.dispatch)
+    try:
+        with track_queries() as stats:
+            response = await call_next(request)
+            # a streamed body (the classify batch) is produced while it is sent, it is
+            # read here so it is part of the profile like the rest of the handler
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            response = Response(body, response.status_code, dict(response.headers))
+    finally:
+        threading.setprofile_all_threads(None)
+        _profiler.reset(token)
+        _profile_lock.release()
+
+    profiler.close()
+    phases = phase_seconds(profiler.root)
+    profile_id = uuid.uuid4().hex
+    title = (
+        f"{request.method} {route_template(request)} {request.url.path}"
+        f"{'?' + request.url.query if request.url.query else ''} -> "
+        f"{response.status_code}"
+    )
+    report = format_report(title, profiler.root, phases, stats.query_count)
+    await run_in_threadpool(save_report, profile_id, report)
+    response.headers["x-profile-id"] = profile_id
+    response.headers["server-timing"] = server_timing(phases)
+    return response
+
+
+##
+# Background sampling of the live server
+##
+
+# leaf calls of a thread with nothing to do, such samples are not kept
+IDLE_CALLS = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("asyncio/base_events.py", "_run_once"),
+}
+
+
+def frame_name(code: CodeType) -> str:
+    return f"{short_path(code.co_filename)}:{code.co_qualname}"
+
+
+class StackSampler:
+    """Counts the stacks of every busy thread, sampled every `interval` seconds"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self.sample_count = 0
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(exclude=own_id)
+
+    def sample(self, exclude: int | None = None):
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == exclude:
+                continue
+            leaf = frame.f_code
+            if (short_path(leaf.co_filename), leaf.co_name) in IDLE_CALLS:
+                continue
+            names = []
+            current: FrameType | None = frame
+            while current is not None:
+                names.append(frame_name(current.f_code))
+                current = current.f_back
+            names.append(thread_names.get(thread_id, str(thread_id)))
+            stacks.append(";".join(reversed(names)))
+        with self._lock:
+            self.sample_count += 1
+            for stack in stacks:
+                if stack in self.samples or len(self.samples) < SAMPLING_MAX_STACKS:
+                    self.samples[stack] += 1
+                else:
+                    self.samples["[truncated]"] += 1
+
+    def take(self) -> tuple[Counter[str], int, float]:
+        """(collapsed stack counts, samples taken, seconds covered) since the last take"""
+        with self._lock:
+            samples, self.samples = self.samples, Counter()
+            sample_count, self.sample_count = self.sample_count, 0
+            started_at, self.started_at = self.started_at, time.time()
+        return samples, sample_count, self.started_at - started_at
+
+
+def collapsed_stacks(samples: Counter[str]) -> str:
+    """One `frame;frame;... count` line per stack, the flamegraph.pl input format"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+
+def write_flamegraph(samples: Counter[str]) -> str:
+    """Writes the collapsed stacks to PROFILE_DIR, returns the path"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(PROFILE_DIR, f"flamegraph-{stamp}-{os.getpid()}.folded")
+    with open(path, "w") as f:
+        f.write(collapsed_stacks(samples))
+    return path
+
+
+stack_sampler = StackSampler(SAMPLING_INTERVAL_MS / 1000)
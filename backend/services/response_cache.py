@@ -0,0 +1,218 @@
+#####
+# Response cache for the read heavy endpoints (/physicians, /messages, /stats)
+#    - responses are kept per path and normalized query string in an LRU bounded by
+#      RESPONSE_CACHE_MB (0 disables the cache)
+#    - every entry remembers the data version it was rendered at, a write to physicians or
+#      messages bumps the version in the database so no worker serves a stale page
+#    - identical concurrent requests are coalesced, only the first one runs the query
+#    - responses carry a strong ETag, a matching If-None-Match is answered with a 304
+#####
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Connection, select, update
+from sqlalchemy.orm import Session
+
+from db import database
+from db.models import DataVersion
+from services.metrics import Counter, registry
+from services.profiling import profile_requested
+
+RESPONSE_CACHE_MB = float(os.environ.get("RESPONSE_CACHE_MB", "64"))
+CACHED_PATHS = frozenset({"/physicians", "/messages", "/stats"})
+
+# browsers keep the response but revalidate it (If-None-Match) before every use
+CACHE_CONTROL = "no-cache"
+
+CACHE_REQUESTS = registry.register(
+    Counter(
+        "response_cache_requests_total",
+        "Cacheable requests by result (hit, miss, coalesced, not_modified)",
+        ("result",),
+    )
+)
+
+
+##
+# Data version
+##
+
+DATA_VERSION_STMT = select(DataVersion.version).where(DataVersion.id == 1)
+
+
+def bump_data_version(db: Session | Connection):
+    """Marks every cached response as stale, call it in the transaction that writes physicians or messages"""
+    db.execute(
+        update(DataVersion)
+        .where(DataVersion.id == 1)
+        .values(version=DataVersion.version + 1)
+    )
+
+
+def read_data_version() -> int:
+    with database.ReadSessionLocal() as db:
+        return db.execute(DATA_VERSION_STMT).scalar_one()
+
+
+async def current_data_version() -> int:
+    if database.IS_ASYNC:
+        assert database.AsyncReadSessionLocal is not None
+        async with database.AsyncReadSessionLocal() as db:
+            return (await db.execute(DATA_VERSION_STMT)).scalar_one()
+    return await run_in_threadpool(read_data_version)
+
+
+##
+# Cache
+##
+
+
+@dataclass(slots=True)
+class CachedResponse:
+    data_version: int
+    status_code: int
+    headers: dict[str, str]
+    body: bytes
+    etag: str
+
+
+class ResponseCache:
+    """LRU of rendered responses, only used from the event loop so it needs no lock"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._in_flight: dict[tuple[str, int], asyncio.Future] = {}
+
+    def get(self, key: str, data_version: int) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.data_version != data_version:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        if len(entry.body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        self.size -= len(self._entries.pop(key).body)
+
+    async def single_flight(
+        self,
+        key: str,
+        data_version: int,
+        render: Callable[[], Awaitable[CachedResponse]],
+    ) -> CachedResponse:
+        """Renders the response once for every identical request that arrives while it runs"""
+        flight_key = (key, data_version)
+        leader = self._in_flight.get(flight_key)
+        if leader is not None:
+            CACHE_REQUESTS.inc(("coalesced",))
+            # a failed leader leaves its followers to render their own response
+            entry = await asyncio.shield(leader)
+            if entry is not None:
+                return entry
+            return await render()
+
+        CACHE_REQUESTS.inc(("miss",))
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[flight_key] = future
+        try:
+            entry = await render()
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            del self._in_flight[flight_key]
+        future.set_result(entry)
+        if entry.status_code == 200:
+            self.put(key, entry)
+        return entry
+
+
+response_cache = ResponseCache(int(RESPONSE_CACHE_MB * 1024 * 1024))
+
+
+def cache_key(request: Request) -> str:
+    # the order of the query parameters does not change the response
+    params = sorted(parse_qsl(request.url.query, keep_blank_values=True))
+    return f"{request.url.path}?{urlencode(params)}"
+
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    # the comparison for If-None-Match is weak, W/"x" matches "x"
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+##
+# Middleware
+##
+
+
+async def response_cache_middleware(request: Request, call_next):
+    if (
+        request.method != "GET"
+        or request.url.path not in CACHED_PATHS
+        or response_cache.max_bytes <= 0
+        # a profiled request has to reach its handler
+        or profile_requested(request)
+    ):
+        return await call_next(request)
+
+    async def render() -> CachedResponse:
+        response = await call_next(request)
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        return CachedResponse(
+            data_version=data_version,
+            status_code=response.status_code,
+            headers=dict(response.headers),
+            body=body,
+            etag=make_etag(body),
+        )
+
+    data_version = await current_data_version()
+    key = cache_key(request)
+    entry = response_cache.get(key, data_version)
+    if entry is not None:
+        CACHE_REQUESTS.inc(("hit",))
+    else:
+        entry = await response_cache.single_flight(key, data_version, render)
+
+    if entry.status_code != 200:
+        return Response(entry.body, entry.status_code, entry.headers)
+
+    cache_headers = {"etag": entry.etag, "cache-control": CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        CACHE_REQUESTS.inc(("not_modified",))
+        return Response(status_code=304, headers=cache_headers)
+    return Response(entry.body, entry.status_code, {**entry.headers, **cache_headers})
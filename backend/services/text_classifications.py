@@ -0,0 +1,90 @@
+#####
+# LRU of ad hoc text classifications (POST /classify/text)
+#    - drafts of the send pipeline are mostly filled in templates, a repeated draft is
+#      answered from memory without running the matcher
+#    - keyed by (hash of the case folded text, compliance version, rules revision), the
+#      matcher folds the case itself and the revision changes with the rules of the version
+#      whichever process loaded them
+#    - bounded by CLASSIFY_CACHE_SIZE entries, only the 16 byte hash of a text is kept
+#####
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from services.classifications import Matches
+from services.matcher import KeywordMatcher
+from services.metrics import Counter, registry
+
+CLASSIFY_CACHE_SIZE = int(os.environ.get("CLASSIFY_CACHE_SIZE", "10000"))
+
+TEXT_CACHE_REQUESTS = registry.register(
+    Counter(
+        "classify_text_cache_requests_total",
+        "Ad hoc text classifications by cache result (hit, miss)",
+        ("result",),
+    )
+)
+
+TextCacheKey = tuple[bytes, str, int | None]
+
+
+def text_cache_key(
+    text: str, compliance_version: str, revision: int | None
+) -> TextCacheKey:
+    # only the case is normalized, any other change to the text can change the matches
+    digest = hashlib.blake2b(text.lower().encode(), digest_size=16).digest()
+    return digest, compliance_version, revision
+
+
+class TextClassificationCache:
+    """LRU of text -> matches, shared by the threadpool handlers so it is locked"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[TextCacheKey, Matches] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: TextCacheKey) -> Matches | None:
+        with self._lock:
+            matches = self._entries.get(key)
+            if matches is not None:
+                self._entries.move_to_end(key)
+            return matches
+
+    def put(self, key: TextCacheKey, matches: Matches):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = matches
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+text_classification_cache = TextClassificationCache(CLASSIFY_CACHE_SIZE)
+
+
+def classify_text(
+    matcher: KeywordMatcher, compliance_version: str, text: str
+) -> Matches:
+    """Matches of the text, cached results are shared so they must not be changed"""
+    # the revision the matcher was built from, not the latest one, names its results
+    key = text_cache_key(text, compliance_version, matcher.revision)
+    matches = text_classification_cache.get(key)
+    if matches is not None:
+        TEXT_CACHE_REQUESTS.inc(("hit",))
+        return matches
+
+    TEXT_CACHE_REQUESTS.inc(("miss",))
+    matches = matcher.match(text)
+    text_classification_cache.put(key, matches)
+    return matches
@@ -0,0 +1,209 @@
+#####
+# Startup warm-up of an api process, GET /ready answers 200 once it is done
+#    - checks the database answers and has every migration applied
+#    - opens the pooled connections and runs the statement shapes of the routers once,
+#      sqlalchemy compiles (and caches) a statement per engine on its first execution
+#    - builds the matcher of every compliance version and the physician directory
+#    - runs next to the server so probes are answered meanwhile, a load balancer should
+#      send traffic only once /ready does
+#####
+
+import contextlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Engine, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+
+from db import database
+from db.migrations import pending_migrations
+from db.models import ComplianceVersion, Message
+from routers.classify import select_with_classification
+from routers.search import (
+    DEFAULT_PAGE_LIMIT,
+    physicians_page,
+    prepare_messages_query,
+    prepare_physicians_query,
+    read_messages_page,
+)
+from routers.stats import DEFAULT_STATS_LIMIT, prepare_stats_query, stats_page
+from services.matcher import get_matcher
+from services.metrics import Gauge, registry
+from services.physician_directory import physician_directory
+
+logger = logging.getLogger(__name__)
+
+# WARMUP=0 starts serving (and is ready) right away, every cache fills on first use
+WARMUP = os.environ.get("WARMUP", "1") != "0"
+
+WARMUP_SECONDS = registry.register(
+    Gauge(
+        "startup_warmup_seconds",
+        "Time the startup warm-up took per step, total is the cold start",
+        ("step",),
+    )
+)
+
+
+class WarmupError(Exception):
+    pass
+
+
+@dataclass
+class WarmupState:
+    ready: bool = False
+    error: str | None = None
+    seconds: float | None = None
+    steps: dict[str, float] = field(default_factory=dict)
+
+
+warmup_state = WarmupState()
+
+
+##
+# Steps
+##
+
+
+def check_database(db: Session):
+    db.execute(select(1)).scalar_one()
+    pending = pending_migrations(db.get_bind())
+    if pending:
+        raise WarmupError(f"Pending migrations: {', '.join(pending)}")
+
+
+def pool_size(engine: Engine) -> int:
+    # a StaticPool (in memory database) has one connection and no size
+    size = getattr(engine.pool, "size", None)
+    return size() if callable(size) else 1
+
+
+def open_connections(engine: Engine):
+    """Opens every connection of the pool at once so concurrent first requests find them"""
+    with contextlib.ExitStack() as stack:
+        for _ in range(pool_size(engine)):
+            stack.enter_context(engine.connect())
+
+
+async def open_async_connections(engine: AsyncEngine):
+    async with contextlib.AsyncExitStack() as stack:
+        for _ in range(pool_size(engine.sync_engine)):
+            await stack.enter_async_context(engine.connect())
+
+
+def run_read_statements(db: Session):
+    """First pages of /physicians, /messages and /stats as the routers build them"""
+    stmt, requested = prepare_physicians_query(
+        None, None, DEFAULT_PAGE_LIMIT, None, None
+    )
+    physicians_page(db.execute(stmt), DEFAULT_PAGE_LIMIT, requested)
+    stmt, requested = prepare_messages_query(
+        None, None, None, DEFAULT_PAGE_LIMIT, None, None, None
+    )
+    read_messages_page(db, stmt, DEFAULT_PAGE_LIMIT, requested, False, None, None)
+    stmt, group_keys = prepare_stats_query(
+        None, None, None, None, None, None, DEFAULT_STATS_LIMIT, None
+    )
+    stats_page(db.execute(stmt), DEFAULT_STATS_LIMIT, group_keys)
+
+
+def run_write_statements(db: Session):
+    """The classify lookup and the matcher of every compliance version"""
+    versions = list(db.execute(select(ComplianceVersion.version)).scalars())
+    for version in versions:
+        db.execute(
+            select_with_classification(version).where(Message.message_id == 0)
+        ).one_or_none()
+        get_matcher(db, version)
+
+
+##
+# Runner
+##
+
+
+@contextlib.contextmanager
+def timed_step(state: WarmupState, name: str):
+    start_time = time.perf_counter()
+    yield
+    state.steps[name] = time.perf_counter() - start_time
+
+
+def warm_up_database():
+    with database.SessionLocal() as db:
+        check_database(db)
+
+
+def warm_up_physician_directory():
+    # one directory per process whichever engine built it
+    with database.ReadSessionLocal() as db:
+        physician_directory.current(db)
+
+
+def warm_up_sync(state: WarmupState):
+    with timed_step(state, "database"):
+        warm_up_database()
+    with timed_step(state, "connections"):
+        open_connections(database.engine)
+        if database.read_engine is not database.engine:
+            open_connections(database.read_engine)
+    with timed_step(state, "statements"):
+        with database.ReadSessionLocal() as db:
+            run_read_statements(db)
+        with database.SessionLocal() as db:
+            run_write_statements(db)
+    with timed_step(state, "physician_directory"):
+        warm_up_physician_directory()
+
+
+async def warm_up_async(state: WarmupState):
+    # the async engines have their own pools and compiled caches
+    assert database.AsyncSessionLocal is not None
+    assert database.AsyncReadSessionLocal is not None
+    with timed_step(state, "database"):
+        await run_in_threadpool(warm_up_database)
+    with timed_step(state, "connections"):
+        for engine in {database.async_engine, database.async_read_engine}:
+            await open_async_connections(engine)
+    with timed_step(state, "statements"):
+        async with database.AsyncReadSessionLocal() as db:
+            await db.run_sync(run_read_statements)
+        async with database.AsyncSessionLocal() as db:
+            await db.run_sync(run_write_statements)
+    with timed_step(state, "physician_directory"):
+        async with database.AsyncReadSessionLocal() as db:
+            await physician_directory.current_async(db)
+
+
+async def warm_up(state: WarmupState | None = None):
+    """Runs every warm-up step, the state is ready after it or holds the error"""
+    if state is None:
+        state = warmup_state
+    if not WARMUP:
+        state.ready = True
+        return
+
+    start_time = time.perf_counter()
+    try:
+        if database.IS_ASYNC:
+            await warm_up_async(state)
+        else:
+            await run_in_threadpool(warm_up_sync, state)
+    except Exception as error:
+        logger.exception("startup warm-up failed")
+        state.error = str(error)
+        return
+
+    state.seconds = time.perf_counter() - start_time
+    for step, seconds in {**state.steps, "total": state.seconds}.items():
+        WARMUP_SECONDS.set(seconds, (step,))
+    state.ready = True
+    logger.info(
+        "warm-up done in %.3fs (%s)",
+        state.seconds,
+        ", ".join(f"{step} {seconds:.3f}s" for step, seconds in state.steps.items()),
+    )
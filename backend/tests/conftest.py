@@ -5,7 +5,7 @@ import pytest
 from fastapi.testclient import TestClient
 from main import app
 from db.database import any_table_exist
-from db.manage import load_data, create_tables
+from db.manage import load_data, run_migrations
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -19,7 +19,7 @@ def setup_database():
     if any_table_exist():
         raise ValueError("Database is not empty, use an empty database for testing")
 
-    create_tables()
+    run_migrations()
     load_data()
 
 
@@ -0,0 +1,71 @@
+###
+# Test that admission control caps the requests of a route class and sheds the ones that
+# wait too long with a 503
+###
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from services import admission
+from services.admission import ADMISSION_SHED, AdmissionLimiter
+from services.response_cache import response_cache
+
+
+def test_limiter_hands_slots_to_waiters_in_order():
+    async def scenario() -> list[str]:
+        limiter = AdmissionLimiter("test", limit=1)
+        admitted = []
+
+        async def request(name: str):
+            assert await limiter.acquire(timeout=5)
+            admitted.append(name)
+            await asyncio.sleep(0.01)
+            limiter.release()
+
+        await asyncio.gather(*(request(name) for name in "abc"))
+        assert limiter.active == 0
+        assert len(limiter) == 0
+        return admitted
+
+    assert asyncio.run(scenario()) == ["a", "b", "c"]
+
+
+def test_limiter_sheds_after_the_timeout():
+    async def scenario():
+        limiter = AdmissionLimiter("test", limit=1)
+        shed_before = ADMISSION_SHED.value(("test",))
+        assert await limiter.acquire(timeout=0)
+        assert not await limiter.acquire(timeout=0.01)
+        assert ADMISSION_SHED.value(("test",)) == shed_before + 1
+        # the shed request left the queue, the slot is free again after the release
+        assert len(limiter) == 0
+        limiter.release()
+        assert limiter.active == 0
+        assert await limiter.acquire(timeout=0)
+
+    asyncio.run(scenario())
+
+
+def test_full_route_class_is_answered_with_503(test_client: TestClient, monkeypatch):
+    response_cache.clear()
+    # served before the lookup class is closed, then answered by the response cache
+    assert test_client.get("/physicians?limit=3").status_code == 200
+
+    limiters = {**admission.limiters, "lookup": AdmissionLimiter("lookup", limit=0)}
+    monkeypatch.setattr(admission, "limiters", limiters)
+    monkeypatch.setattr(admission, "ADMISSION_QUEUE_TIMEOUT", 0.01)
+
+    response = test_client.get("/physicians?limit=4")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert response.json()["detail"] == "Server is busy, retry later"
+    assert test_client.get("/physicians/search?prefix=le").status_code == 503
+
+    assert test_client.get("/physicians?limit=3").status_code == 200
+    # other classes and routes without a class (/metrics) are not held back
+    assert test_client.get("/messages?limit=1").status_code == 200
+    metrics = test_client.get("/metrics").text
+    assert 'admission_shed_total{route_class="lookup"} 2' in metrics
+    assert (
+        'http_requests_total{method="GET",route="/physicians",status="503"}' in metrics
+    )
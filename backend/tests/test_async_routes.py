@@ -0,0 +1,154 @@
+###
+# Test that the async routes (DB_URL with an async driver) answer the same as the sync routes
+###
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from db import database
+from db.bulk_load import bulk_load_csv
+from db.manage import load_compliance_policy, parse_message_rows, parse_physician_rows
+from db.migrations import migrate
+from db.models import Message, Physician
+from db.texts import store_message_texts
+from routers import async_classify, async_search, async_stats
+from services import physician_directory as directory_module
+
+
+@pytest.fixture(scope="module")
+def async_client(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("async") / "async.db"
+    engine = create_engine(f"sqlite:///{db_path}")
+    migrate(engine)
+    bulk_load_csv(
+        engine, Physician.__table__, "sample_data/physicians.csv", parse_physician_rows
+    )
+    bulk_load_csv(
+        engine,
+        Message.__table__,
+        "sample_data/messages.csv",
+        parse_message_rows,
+        before_insert=store_message_texts,
+    )
+    with Session(engine) as db:
+        load_compliance_policy(db, "sample_data/compliance_policies.json")
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    session_local = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+
+    app = FastAPI()
+    app.include_router(async_search.router)
+    app.include_router(async_classify.router)
+    app.include_router(async_stats.router)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(database, "AsyncSessionLocal", session_local)
+        monkeypatch.setattr(database, "AsyncReadSessionLocal", session_local)
+        with TestClient(app) as client:
+            yield client
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/physicians",
+        "/physicians?state=CA&fields=last_name,state",
+        "/physicians?limit=10&cursor=WzExMF0=",
+        "/physicians/search?prefix=le",
+        "/physicians/search?prefix=ca&state=CT&limit=3",
+        "/messages?physician_id=101",
+        "/messages?start_date=2024-01-10T00:00:00&end_date=2025-09-12T23:59:59&limit=20",
+        "/messages?fields=message_id,timestamp&limit=5",
+        "/messages?start_date=2025-09-12T00:00:00&end_date=2024-01-10T00:00:00",
+        "/messages?q=clinical trial&physician_id=101",
+        "/messages?q=samples OR trial&limit=5",
+        '/messages?q="unclosed',
+        "/stats?group_by=channel,day&physician_id=101",
+        "/stats?group_by=bogus",
+    ],
+)
+def test_async_search_matches_sync(async_client: TestClient, test_client: TestClient, url):
+    async_response = async_client.get(url)
+    sync_response = test_client.get(url)
+    assert async_response.status_code == sync_response.status_code
+    assert async_response.json() == sync_response.json()
+
+
+@pytest.mark.parametrize("message_id", [10013, 10153, 10193, 999999])
+def test_async_classify_matches_sync(
+    async_client: TestClient, test_client: TestClient, message_id: int
+):
+    async_response = async_client.post(f"/classify/{message_id}")
+    sync_response = test_client.post(f"/classify/{message_id}")
+    assert async_response.status_code == sync_response.status_code
+    assert async_response.json() == sync_response.json()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"text": "Clarify dosing schedule and titration."},
+        {"text": "Can I get SAMPLES?"},
+        {"text": "samples", "compliance_version": "v0"},
+    ],
+)
+def test_async_classify_text_matches_sync(
+    async_client: TestClient, test_client: TestClient, body: dict
+):
+    async_response = async_client.post("/classify/text", json=body)
+    sync_response = test_client.post("/classify/text", json=body)
+    assert async_response.status_code == sync_response.status_code
+    assert async_response.json() == sync_response.json()
+
+
+def test_async_classify_batch_matches_sync(
+    async_client: TestClient, test_client: TestClient
+):
+    body = {"physician_id": 101, "end_date": "2030-01-01T00:00:00"}
+    async_response = async_client.post("/classify/batch", json=body)
+    sync_response = test_client.post("/classify/batch", json=body)
+    assert async_response.status_code == 200
+    assert async_response.text == sync_response.text
+
+
+def test_cold_directory_builds_off_the_event_loop(
+    async_client: TestClient, monkeypatch
+):
+    building = threading.Event()
+    release = threading.Event()
+    builds = []
+
+    class SlowDirectory(directory_module.PhysicianDirectory):
+        def __init__(self, *args, **kwargs):
+            builds.append(threading.current_thread())
+            building.set()
+            # released by the test once another request was answered meanwhile
+            self.released = release.wait(timeout=5)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(directory_module, "PhysicianDirectory", SlowDirectory)
+    monkeypatch.setattr(directory_module.physician_directory, "directory", None)
+
+    with ThreadPoolExecutor(2) as pool:
+        searches = [
+            pool.submit(async_client.get, "/physicians/search?prefix=le")
+            for _ in range(2)
+        ]
+        assert building.wait(timeout=5)
+        # the event loop keeps serving while the first build runs
+        assert async_client.get("/physicians?limit=1").status_code == 200
+        release.set()
+        responses = [search.result(timeout=5) for search in searches]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].json() == responses[1].json()
+    assert len(builds) == 1
+    assert directory_module.physician_directory.directory.released
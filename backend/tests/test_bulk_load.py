@@ -0,0 +1,51 @@
+###
+# Test that the bulk loader loads the same rows as the orm loader
+###
+import pytest
+from sqlalchemy import create_engine, inspect, select
+
+from db.bulk_load import bulk_load_csv
+from db.database import engine as test_engine
+from db.manage import parse_message_rows, parse_physician_rows
+from db.migrations import migrate
+from db.models import Message, MessageText, Physician
+from db.texts import store_message_texts
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_bulk_load_matches_orm_load(tmp_path, workers: int):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bulk.db'}")
+    migrate(engine)
+
+    physician_count = bulk_load_csv(
+        engine,
+        Physician.__table__,
+        "sample_data/physicians.csv",
+        parse_physician_rows,
+        chunk_size=7,
+        workers=workers,
+    )
+    message_count = bulk_load_csv(
+        engine,
+        Message.__table__,
+        "sample_data/messages.csv",
+        parse_message_rows,
+        chunk_size=17,
+        workers=workers,
+        before_insert=store_message_texts,
+    )
+    assert (physician_count, message_count) == (25, 200)
+
+    # the dropped indexes are rebuilt after the load
+    indexes = {index["name"] for index in inspect(engine).get_indexes("messages")}
+    assert {"ix_messages_physician_id_timestamp", "ix_messages_timestamp"} <= indexes
+
+    # the session database was loaded with the orm by the conftest
+    for table, key in (
+        (Physician.__table__, "physician_id"),
+        (Message.__table__, "message_id"),
+        (MessageText.__table__, "text_hash"),
+    ):
+        stmt = select(table).order_by(table.c[key])
+        with engine.connect() as bulk_conn, test_engine.connect() as orm_conn:
+            assert bulk_conn.execute(stmt).all() == orm_conn.execute(stmt).all()
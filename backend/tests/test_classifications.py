@@ -0,0 +1,166 @@
+###
+# Test that stored classifications are reused and incrementally reclassified between compliance versions
+###
+import json
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+from db.database import SessionLocal
+from db.manage import load_compliance_policy
+from db.models import Message, MessageText, TextClassification, KeywordPosting
+from services.classifications import (
+    backfill_classifications,
+    decode_matches,
+    reclassify_incremental,
+)
+from services.matcher import build_matcher
+
+
+def test_classify_message_stores_result(test_client: TestClient):
+    response = test_client.post("/classify/10013")
+    assert response.status_code == 200
+
+    db = SessionLocal()
+    try:
+        message = db.get(Message, 10013)
+        assert message is not None
+        stored = db.get(TextClassification, (message.text_hash, "v1"))
+        assert stored is not None
+        assert decode_matches(stored.matches) == {"R-004": ["samples"]}
+        assert db.get(KeywordPosting, ("samples", message.text_hash)) is not None
+    finally:
+        db.close()
+
+    # the stored result is read back the same way
+    assert test_client.post("/classify/10013").json() == response.json()
+
+
+def test_unknown_compliance_version_is_not_stored(test_client: TestClient):
+    response = test_client.post("/classify/10013?compliance_version=v404")
+    assert response.status_code == 200
+    assert response.json()["matched_rules"] == []
+
+    db = SessionLocal()
+    try:
+        stored = db.execute(
+            select(TextClassification).where(
+                TextClassification.compliance_version == "v404"
+            )
+        )
+        assert stored.first() is None
+    finally:
+        db.close()
+
+
+def test_messages_sharing_a_text_are_classified_once(test_client: TestClient):
+    response = test_client.post(
+        "/classify/batch",
+        json={"start_date": "2025-08-01T00:00:00", "compliance_version": "v1"},
+    )
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    db = SessionLocal()
+    try:
+        batch_texts = select(Message.text_hash).where(Message.timestamp >= "2025-08-01")
+        classified_count = db.execute(
+            select(func.count())
+            .select_from(TextClassification)
+            .where(
+                TextClassification.compliance_version == "v1",
+                TextClassification.text_hash.in_(batch_texts),
+            )
+        ).scalar_one()
+        texts = dict(db.execute(select(Message.message_id, Message.message_text)).all())
+    finally:
+        db.close()
+
+    # 176 messages but only a handful of distinct sample texts, one result each
+    distinct_texts = {line["message_text"] for line in lines}
+    assert len(lines) == 176
+    assert classified_count == len(distinct_texts) < 10
+
+    matches_by_text: dict[str, list] = {}
+    for line in lines:
+        assert line["message_text"] == texts[line["message_id"]]
+        matched = matches_by_text.setdefault(
+            line["message_text"], line["matched_rules"]
+        )
+        assert line["matched_rules"] == matched
+
+
+def test_reclassify_incremental_new_version(tmp_path, test_client: TestClient):
+    policy = {
+        "version": "v2-incremental",
+        "updated": "2025-10-01",
+        "rules": [
+            # unchanged
+            {
+                "id": "R-002",
+                "name": "Include safety statement when mentioning dosing",
+                "keywords_any": ["dosing", "titration"],
+                "requires_append": "See PI for full safety info.",
+            },
+            # "sample request" removed
+            {
+                "id": "R-004",
+                "name": "Samples request needs rep follow-up",
+                "keywords_any": ["samples"],
+                "action": "route_to_rep",
+            },
+            # new keyword
+            {
+                "id": "R-006",
+                "name": "Safety questions go to medical information",
+                "keywords_any": ["contraindications"],
+                "action": "route_to_med_info",
+            },
+        ],
+    }
+    policy_path = tmp_path / "policy.json"
+    policy_path.write_text(json.dumps(policy))
+
+    db = SessionLocal()
+    try:
+        backfill_classifications(db, "v1")
+        version = load_compliance_policy(db, str(policy_path))
+        copied_count, reclassified_count = reclassify_incremental(db, version, "v1")
+
+        texts = db.execute(
+            select(MessageText.text_hash, MessageText.message_text)
+        ).all()
+        affected_words = (
+            "trial",
+            "off-label",
+            "unapproved use",
+            "dob:",
+            "ssn",
+            "mrn",
+            "sample request",
+            "contraindications",
+        )
+        affected_count = sum(
+            any(word in text.lower() for word in affected_words) for _, text in texts
+        )
+
+        # only texts containing a changed keyword were matched again
+        assert reclassified_count == affected_count > 0
+        assert copied_count == len(texts) - affected_count
+
+        # and every stored result is what a fresh classification gives
+        matcher = build_matcher(db, version)
+        stored = dict(
+            db.execute(
+                select(TextClassification.text_hash, TextClassification.matches).where(
+                    TextClassification.compliance_version == version
+                )
+            ).all()
+        )
+        assert len(stored) == len(texts)
+        for text_hash, message_text in texts:
+            assert decode_matches(stored[text_hash]) == matcher.match(message_text)
+    finally:
+        db.close()
+
+    response = test_client.post(f"/classify/10013?compliance_version={version}")
+    assert [rule["id"] for rule in response.json()["matched_rules"]] == ["R-004"]
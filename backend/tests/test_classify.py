@@ -2,7 +2,33 @@
 # Test that classify routes return current items for the sample data
 ###
 
+import json
 from fastapi.testclient import TestClient
+from sqlalchemy import select, func, literal
+
+from db import manage
+from db.database import SessionLocal
+from db.models import Message, Rule, AnyKeyword, TextClassification
+from routers import classify
+from services import matcher
+from services.matcher import (
+    CompiledRule,
+    KeywordMatcher,
+    bump_rules_revision,
+    get_matcher,
+    invalidate_matchers,
+)
+from services.text_classifications import (
+    TEXT_CACHE_REQUESTS,
+    TextClassificationCache,
+    text_cache_key,
+    text_classification_cache,
+)
+
+
+def matched_rule_ids(response) -> list[str]:
+    assert response.status_code == 200
+    return [rule["id"] for rule in response.json()["matched_rules"]]
 
 
 def test_classify_message_not_found(test_client: TestClient):
@@ -29,3 +55,237 @@ def test_classify_message_one_rule_matched(test_client: TestClient):
     rule = data["matched_rules"][0]
     assert rule["id"] == "R-004"
     assert "samples" in rule["matched_keywords"]
+
+
+def test_classify_message_multiple_keywords_matched(test_client: TestClient):
+    # Message ID 10193: "Clarify dosing schedule and titration."
+    response = test_client.post("/classify/10193")
+    assert response.status_code == 200
+    data = response.json()
+    assert [rule["id"] for rule in data["matched_rules"]] == ["R-002"]
+    assert data["matched_rules"][0]["matched_keywords"] == ["dosing", "titration"]
+
+
+def test_keyword_matcher_overlapping_keywords():
+    rules = [
+        CompiledRule("R-004", "Samples", "action", "route_to_rep"),
+        CompiledRule("R-005", "Trials", "requires_append", "cite registry"),
+    ]
+    keywords = [
+        ("R-005", "trial"),
+        ("R-005", "clinical trial"),
+        ("R-004", "samples"),
+        ("R-004", "sample request"),
+    ]
+    matcher = KeywordMatcher(rules, keywords)
+
+    assert matcher.match("Eligibility for CLINICAL TRIAL referral.") == {
+        "R-005": ["clinical trial", "trial"]
+    }
+    assert matcher.match("a sample request for samples") == {
+        "R-004": ["sample request", "samples"]
+    }
+    assert matcher.match("nothing to see") == {}
+
+
+def test_keyword_matcher_agrees_with_sql_like():
+    # the compiled matcher must give the same result as the sql LIKE scan it replaced
+    db = SessionLocal()
+    try:
+        matcher = get_matcher(db, "v1")
+        messages = db.execute(select(Message.message_id, Message.message_text)).all()
+        for message_id, message_text in messages:
+            like_stmt = (
+                select(AnyKeyword.rule_id, AnyKeyword.keyword)
+                .join(Rule)
+                .where(
+                    Rule.compliance_version == "v1",
+                    func.lower(literal(message_text)).contains(
+                        func.lower(AnyKeyword.keyword)
+                    ),
+                )
+                .order_by(Rule.id, AnyKeyword.keyword)
+            )
+            expected: dict[str, list[str]] = {}
+            for rule_id, keyword in db.execute(like_stmt):
+                expected.setdefault(rule_id, []).append(keyword)
+            assert matcher.match(message_text) == expected, message_id
+    finally:
+        db.close()
+
+
+def test_classify_batch_by_message_ids(test_client: TestClient):
+    response = test_client.post(
+        "/classify/batch", json={"message_ids": [10193, 10013, 10153, 999999]}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    results = [json.loads(line) for line in response.text.splitlines()]
+
+    # unknown ids are skipped and the results are ordered by message id
+    assert [result["message_id"] for result in results] == [10013, 10153, 10193]
+    for result in results:
+        single = test_client.post(f"/classify/{result['message_id']}").json()
+        assert result == single
+
+
+def test_classify_batch_by_physician_and_date_range(test_client: TestClient):
+    response = test_client.post(
+        "/classify/batch",
+        json={
+            "physician_id": 101,
+            "start_date": "2024-01-10T00:00:00",
+            "end_date": "2025-09-12T23:59:59",
+        },
+    )
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+
+    messages = test_client.get(
+        "/messages?physician_id=101&start_date=2024-01-10T00:00:00&end_date=2025-09-12T23:59:59"
+    ).json()["items"]
+    assert len(results) == len(messages) > 0
+    assert [r["message_id"] for r in results] == sorted(
+        m["message_id"] for m in messages
+    )
+
+
+def test_classify_batch_chunks_date_range(test_client: TestClient, monkeypatch):
+    monkeypatch.setattr(classify, "BATCH_CHUNK_SIZE", 7)
+    response = test_client.post(
+        "/classify/batch", json={"end_date": "2030-01-01T00:00:00"}
+    )
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert len(results) == 200
+    assert len({result["message_id"] for result in results}) == 200
+
+
+def test_classify_batch_requires_one_selector(test_client: TestClient):
+    assert test_client.post("/classify/batch", json={}).status_code == 400
+    response = test_client.post(
+        "/classify/batch", json={"message_ids": [10013], "physician_id": 101}
+    )
+    assert response.status_code == 400
+
+
+def test_unknown_compliance_versions_are_not_cached(test_client: TestClient):
+    for i in range(5):
+        response = test_client.post(f"/classify/10013?compliance_version=junk{i}")
+        assert response.status_code == 200
+        assert response.json()["matched_rules"] == []
+    response = test_client.post(
+        "/classify/batch", json={"message_ids": [10013], "compliance_version": "junk"}
+    )
+    assert response.status_code == 200
+    assert response.json()["matched_rules"] == []
+    assert not [version for version in matcher._matchers if version.startswith("junk")]
+
+    assert test_client.post("/classify/10013").status_code == 200
+    assert "v1" in matcher._matchers
+
+
+def test_policy_loaded_by_another_process_replaces_cached_matchers(
+    test_client: TestClient, tmp_path, monkeypatch
+):
+    assert matched_rule_ids(test_client.post("/classify/10013")) == ["R-004"]
+
+    # a load in another process cannot drop the matchers of this one
+    monkeypatch.setattr(manage, "invalidate_matchers", lambda: None)
+    with open("sample_data/compliance_policies.json") as f:
+        policy = json.load(f)
+    changed = json.loads(json.dumps(policy))
+    changed["rules"][3]["keywords_any"] = ["sample request"]
+    path = tmp_path / "compliance_policies.json"
+    path.write_text(json.dumps(changed))
+    db = SessionLocal()
+    try:
+        manage.load_compliance_policy(db, str(path))
+        assert matched_rule_ids(test_client.post("/classify/10013")) == []
+        # the result of the new rules is stored, not the one of the cached matcher
+        stored = db.execute(
+            select(TextClassification.matches)
+            .join(Message, Message.text_hash == TextClassification.text_hash)
+            .where(
+                Message.message_id == 10013,
+                TextClassification.compliance_version == "v1",
+            )
+        ).scalar_one()
+        assert json.loads(stored) == {}
+    finally:
+        path.write_text(json.dumps(policy))
+        manage.load_compliance_policy(db, str(path))
+        db.close()
+    assert matched_rule_ids(test_client.post("/classify/10013")) == ["R-004"]
+
+
+def test_stored_matches_of_unknown_rules_are_skipped():
+    rules = [CompiledRule("R-001", "Off label", "action", "Escalate")]
+    current = KeywordMatcher(rules, [("R-001", "off-label")])
+    responses = classify.build_rule_responses(
+        current, {"R-001": ["off-label"], "R-009": ["zeppelin"]}
+    )
+    assert [response.id for response in responses] == ["R-001"]
+
+
+def test_classify_text_matches_stored_message(test_client: TestClient):
+    # Message ID 10193: "Clarify dosing schedule and titration."
+    stored = test_client.post("/classify/10193").json()
+    response = test_client.post(
+        "/classify/text", json={"text": "Clarify dosing schedule and titration."}
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "compliance_version": "v1",
+        "matched_rules": stored["matched_rules"],
+    }
+
+
+def test_classify_text_cache(test_client: TestClient):
+    def counts() -> tuple[float, float]:
+        return TEXT_CACHE_REQUESTS.value(("hit",)), TEXT_CACHE_REQUESTS.value(("miss",))
+
+    text_classification_cache.clear()
+    hits, misses = counts()
+    # the matcher ignores case so differently cased drafts share an entry
+    for text in ["Can I get SAMPLES?", "can i get samples?", "Can I get samples?"]:
+        response = test_client.post("/classify/text", json={"text": text})
+        assert [rule["id"] for rule in response.json()["matched_rules"]] == ["R-004"]
+    assert counts() == (hits + 2, misses + 1)
+
+    # a rebuilt matcher of the same rules revision still hits
+    invalidate_matchers()
+    test_client.post("/classify/text", json={"text": "Can I get samples?"})
+    assert counts() == (hits + 3, misses + 1)
+
+    # a new revision (e.g. a policy loaded by another process) is a miss
+    with SessionLocal() as db:
+        bump_rules_revision(db, "v1")
+        db.commit()
+    test_client.post("/classify/text", json={"text": "Can I get samples?"})
+    assert counts() == (hits + 3, misses + 2)
+
+
+def test_classify_text_cache_is_bounded():
+    cache = TextClassificationCache(max_entries=2)
+    keys = [text_cache_key(text, "v1", 0) for text in ["a", "b", "c"]]
+    cache.put(keys[0], {})
+    cache.put(keys[1], {})
+    assert cache.get(keys[0]) == {}  # b is now the least recently used
+    cache.put(keys[2], {"R-001": ["c"]})
+    assert cache.get(keys[1]) is None
+    assert len(cache) == 2
+    assert text_cache_key("A", "v1", 0) == keys[0]
+    assert text_cache_key("a", "v1", 1) != keys[0]
+
+
+def test_classify_text_invalid_requests(test_client: TestClient):
+    response = test_client.post(
+        "/classify/text", json={"text": "samples", "compliance_version": "v0"}
+    )
+    assert response.status_code == 400
+    assert test_client.post("/classify/text", json={}).status_code == 422
+    too_long = "x" * (classify.MAX_CLASSIFY_TEXT_LENGTH + 1)
+    assert (
+        test_client.post("/classify/text", json={"text": too_long}).status_code == 422
+    )
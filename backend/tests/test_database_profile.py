@@ -0,0 +1,61 @@
+###
+# Test that the production profile tunes sqlite and keeps read only connections read only
+###
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from db.database import create_async_db_engine, create_db_engine
+
+
+def pragma(engine, name: str):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f"PRAGMA {name}").scalar_one()
+
+
+def test_production_profile_pragmas(tmp_path):
+    url = f"sqlite:///{tmp_path / 'production.db'}"
+    engine = create_db_engine(url, profile="production")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        conn.execute(text("INSERT INTO items (id) VALUES (1)"))
+
+    assert pragma(engine, "journal_mode") == "wal"
+    assert pragma(engine, "synchronous") == 1  # NORMAL
+    assert pragma(engine, "temp_store") == 2  # MEMORY
+    assert pragma(engine, "busy_timeout") == 5000
+
+    read_engine = create_db_engine(url, profile="production", read_only=True)
+    assert pragma(read_engine, "journal_mode") == "wal"
+    with read_engine.connect() as conn:
+        assert conn.execute(text("SELECT id FROM items")).scalars().all() == [1]
+        with pytest.raises(OperationalError, match="readonly"):
+            conn.execute(text("INSERT INTO items (id) VALUES (2)"))
+
+
+def test_default_profile_is_unchanged(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'default.db'}")
+    assert pragma(engine, "journal_mode") == "delete"
+
+
+def test_async_production_profile(tmp_path):
+    url = f"sqlite:///{tmp_path / 'async.db'}"
+    with create_db_engine(url, profile="production").begin() as conn:
+        conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+
+    async def read_only_insert():
+        engine = create_async_db_engine(
+            f"sqlite+aiosqlite:///{tmp_path / 'async.db'}",
+            profile="production",
+            read_only=True,
+        )
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("INSERT INTO items (id) VALUES (1)"))
+        finally:
+            await engine.dispose()
+
+    with pytest.raises(OperationalError, match="readonly"):
+        asyncio.run(read_only_insert())
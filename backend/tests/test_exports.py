@@ -0,0 +1,163 @@
+###
+# Test that export jobs write every matching message with its classification to a
+# gzip file, report their progress and serve the file with range requests
+###
+import csv
+import gzip
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services import exports
+
+
+class InlineExecutor:
+    """Runs a submitted job right away, the in memory test database is one connection"""
+
+    def submit(self, function, *args):
+        function(*args)
+
+
+class IdleExecutor:
+    """Never runs a submitted job, it stays pending"""
+
+    def submit(self, function, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def run_exports_inline(tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, "export_executor", InlineExecutor())
+    monkeypatch.setattr(exports, "EXPORT_DIR", tmp_path)
+
+
+def run_export(test_client: TestClient, **body) -> dict:
+    response = test_client.post("/exports", json=body)
+    assert response.status_code == 202
+    job = test_client.get(f"/exports/{response.json()['job_id']}").json()
+    assert job["status"] == "completed", job["error"]
+    return job
+
+
+def download(test_client: TestClient, job: dict) -> bytes:
+    response = test_client.get(job["download_url"])
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    return gzip.decompress(response.content)
+
+
+def test_ndjson_export_matches_messages_and_classification(test_client: TestClient):
+    job = run_export(
+        test_client,
+        physician_id=101,
+        start_date="2024-01-10T00:00:00",
+        end_date="2025-09-12T23:59:59",
+        format="ndjson",
+    )
+    records = [json.loads(line) for line in download(test_client, job).splitlines()]
+
+    messages = test_client.get(
+        "/messages?physician_id=101&start_date=2024-01-10T00:00:00"
+        "&end_date=2025-09-12T23:59:59&limit=1000"
+    ).json()["items"]
+    assert len(records) == len(messages) == job["rows_written"] == job["total_rows"]
+    assert [{k: r[k] for k in messages[0]} for r in records] == messages
+    assert job["bytes_written"] > 0
+
+    # the same rules as the classify endpoint
+    for record in records[:5]:
+        classified = test_client.post(f"/classify/{record['message_id']}").json()
+        assert record["compliance_version"] == "v1"
+        assert record["matched_rules"] == classified["matched_rules"]
+
+
+def test_csv_export_in_windows(test_client: TestClient, monkeypatch):
+    monkeypatch.setattr(exports, "EXPORT_WINDOW_SIZE", 7)
+    monkeypatch.setattr(exports, "EXPORT_CHUNK_SIZE", 3)
+    job = run_export(test_client)
+
+    rows = list(csv.DictReader(io.StringIO(download(test_client, job).decode())))
+    assert list(rows[0]) == exports.EXPORT_COLUMNS
+    assert len(rows) == job["rows_written"] == job["total_rows"] == 200
+    assert len({row["message_id"] for row in rows}) == 200
+    assert [(r["timestamp"], int(r["message_id"])) for r in rows] == sorted(
+        (r["timestamp"], int(r["message_id"])) for r in rows
+    )
+    assert all(isinstance(json.loads(r["matched_rules"]), list) for r in rows)
+
+
+def test_download_ranges(test_client: TestClient):
+    job = run_export(test_client, physician_id=101)
+    url = job["download_url"]
+    content = test_client.get(url).content
+
+    partial = test_client.get(url, headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == content[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+    rest = test_client.get(url, headers={"Range": "bytes=20-"})
+    assert content[:20] + rest.content == content
+
+    unsatisfiable = test_client.get(url, headers={"Range": f"bytes={len(content)}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_export_errors(test_client: TestClient, monkeypatch):
+    assert test_client.get("/exports/unknown").status_code == 404
+    assert test_client.get("/exports/unknown/download").status_code == 404
+    assert (
+        test_client.post("/exports", json={"compliance_version": "v0"}).status_code
+        == 400
+    )
+    response = test_client.post(
+        "/exports",
+        json={"start_date": "2025-09-12T00:00:00", "end_date": "2024-01-10T00:00:00"},
+    )
+    assert response.status_code == 400
+    assert test_client.post("/exports", json={"format": "xml"}).status_code == 422
+
+    # a job that did not run yet cannot be downloaded
+    monkeypatch.setattr(exports, "export_executor", IdleExecutor())
+    pending = test_client.post("/exports", json={}).json()
+    assert pending["status"] == "pending"
+    assert pending["download_url"] is None
+    response = test_client.get(f"/exports/{pending['job_id']}/download")
+    assert response.status_code == 409
+
+
+def test_jobs_of_stopped_processes_are_failed_on_startup(
+    test_client: TestClient, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(exports, "export_executor", IdleExecutor())
+    alive = test_client.post("/exports", json={}).json()["job_id"]
+    stopped = test_client.post("/exports", json={"format": "ndjson"}).json()["job_id"]
+    # a process that died while writing, the kernel released the lock of its file
+    (exports.EXPORT_OWNER_DIR / "stopped-process").touch()
+    exports.update_job(stopped, status="running", owner="stopped-process")
+    part_path = tmp_path / f"{stopped}.ndjson.gz.part"
+    part_path.write_bytes(b"partial")
+
+    assert exports.fail_interrupted_jobs() >= 1
+    job = test_client.get(f"/exports/{stopped}").json()
+    assert job["status"] == "failed"
+    assert job["error"].startswith("Interrupted")
+    assert not part_path.exists()
+    assert not (exports.EXPORT_OWNER_DIR / "stopped-process").exists()
+    # this process is alive, its job is still waiting for a worker
+    assert test_client.get(f"/exports/{alive}").json()["status"] == "pending"
+
+
+def test_failed_export_leaves_no_file(test_client: TestClient, tmp_path, monkeypatch):
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(exports, "export_record", fail)
+    job_id = test_client.post("/exports", json={}).json()["job_id"]
+    job = test_client.get(f"/exports/{job_id}").json()
+    assert job["status"] == "failed"
+    assert job["error"] == "disk full"
+    assert job["finished_at"] is not None
+    assert list(tmp_path.iterdir()) == []
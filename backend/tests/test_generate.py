@@ -0,0 +1,64 @@
+###
+# Test that generated data sets load with db.manage and are reproducible
+###
+import filecmp
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from bench.generate import generate
+from db.bulk_load import bulk_load_csv
+from db.manage import load_compliance_policy, parse_message_rows, parse_physician_rows
+from db.migrations import migrate
+from db.models import AnyKeyword, Message, Physician
+from db.texts import store_message_texts
+
+
+def test_generated_data_loads(tmp_path):
+    policy_paths = generate(
+        str(tmp_path / "data"), 2000, keyword_count=300, version_count=3
+    )
+    assert len(policy_paths) == 3
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'generated.db'}")
+    migrate(engine)
+    bulk_load_csv(
+        engine,
+        Physician.__table__,
+        str(tmp_path / "data" / "physicians.csv"),
+        parse_physician_rows,
+    )
+    message_count = bulk_load_csv(
+        engine,
+        Message.__table__,
+        str(tmp_path / "data" / "messages.csv"),
+        parse_message_rows,
+        before_insert=store_message_texts,
+    )
+    assert message_count == 2000
+
+    with Session(engine) as db:
+        versions = [load_compliance_policy(db, path) for path in policy_paths]
+        assert versions == ["v1", "v2", "v3"]
+
+        def keywords(version: str) -> set[tuple[str, str]]:
+            stmt = select(AnyKeyword.rule_id, AnyKeyword.keyword).where(
+                AnyKeyword.compliance_version == version
+            )
+            return {tuple(row) for row in db.execute(stmt)}
+
+        # later versions only replace a few keywords
+        v1, v2 = keywords("v1"), keywords("v2")
+        assert len(v1) == len(v2) == 300 + 11  # plus the sample data rules
+        assert 0 < len(v1 - v2) <= 300 * 0.02
+
+        physician_count = db.execute(select(func.count()).select_from(Physician))
+        assert physician_count.scalar_one() == 25
+
+
+def test_generate_is_reproducible(tmp_path):
+    generate(str(tmp_path / "a"), 500, keyword_count=50, seed=7)
+    generate(str(tmp_path / "b"), 500, keyword_count=50, seed=7)
+    files = ["physicians.csv", "messages.csv", "compliance_policies.json"]
+    match, _, _ = filecmp.cmpfiles(tmp_path / "a", tmp_path / "b", files)
+    assert match == files
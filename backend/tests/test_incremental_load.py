@@ -0,0 +1,223 @@
+###
+# Test that incremental loads only read what was added and can be rerun without duplicates
+###
+import json
+
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from db.database import engine as test_engine
+from db.incremental_load import (
+    insert_new_messages,
+    load_csv_incremental,
+    upsert_physicians,
+)
+from db.manage import (
+    load_compliance_policy,
+    load_data,
+    parse_message_rows,
+    parse_physician_rows,
+)
+from db.migrations import migrate
+from db.models import Message, MonthlyRollup, Physician, Rule, TextClassification
+from db.partitions import archive_month
+from services.classifications import backfill_classifications
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'incremental.db'}")
+    migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+def read_lines(path: str) -> list[bytes]:
+    with open(path, "rb") as f:
+        return f.readlines()
+
+
+def load(engine, data_dir) -> tuple[tuple[int, int], tuple[int, int]]:
+    physicians = load_csv_incremental(
+        engine,
+        str(data_dir / "physicians.csv"),
+        parse_physician_rows,
+        upsert_physicians,
+        chunk_size=7,
+    )
+    messages = load_csv_incremental(
+        engine,
+        str(data_dir / "messages.csv"),
+        parse_message_rows,
+        insert_new_messages,
+        chunk_size=17,
+    )
+    return physicians, messages
+
+
+def message_ids(engine) -> list[int]:
+    with engine.connect() as conn:
+        return list(
+            conn.execute(
+                select(Message.message_id).order_by(Message.message_id)
+            ).scalars()
+        )
+
+
+def test_rerun_after_the_full_load_changes_nothing(test_client):
+    before = test_client.get("/messages?limit=500").json()
+    # the conftest load checkpointed the sample files and loaded v1
+    load_data(incremental=True)
+    assert test_client.get("/messages?limit=500").json() == before
+
+
+def test_grown_file_only_loads_new_rows(engine, tmp_path):
+    physician_lines = read_lines("sample_data/physicians.csv")
+    message_lines = read_lines("sample_data/messages.csv")
+    (tmp_path / "physicians.csv").write_bytes(b"".join(physician_lines))
+    messages_path = tmp_path / "messages.csv"
+    messages_path.write_bytes(b"".join(message_lines[:121]))
+
+    assert load(engine, tmp_path) == ((25, 25), (120, 120))
+    # nothing new, the prefix hashes match and nothing is read
+    assert load(engine, tmp_path) == ((0, 0), (0, 0))
+
+    # the exporter is still writing the last row, only complete lines are read
+    partial = message_lines[-1][:20]
+    messages_path.write_bytes(b"".join(message_lines[:-1]) + partial)
+    assert load(engine, tmp_path)[1] == (79, 79)
+    messages_path.write_bytes(b"".join(message_lines))
+    assert load(engine, tmp_path)[1] == (1, 1)
+
+    with test_engine.connect() as conn:
+        all_ids = list(
+            conn.execute(
+                select(Message.message_id).order_by(Message.message_id)
+            ).scalars()
+        )
+    assert message_ids(engine) == all_ids
+    with engine.connect() as conn:
+        rolled_up = conn.execute(select(func.sum(MonthlyRollup.message_count)))
+        assert rolled_up.scalar_one() == 200
+
+
+def test_quoted_field_still_being_written_is_left_for_the_next_run(engine, tmp_path):
+    (tmp_path / "physicians.csv").write_bytes(
+        b"".join(read_lines("sample_data/physicians.csv"))
+    )
+    message_lines = read_lines("sample_data/messages.csv")
+    messages_path = tmp_path / "messages.csv"
+    record = (
+        b'20001,116,email,outbound,2025-09-23T06:24:32,"First line\nsecond line",'
+        b"CMP-49,scheduling,allowed,neutral,delivered,\n"
+    )
+    # every line so far ends with a newline but the quoted text is not closed yet
+    written = record.index(b"\n") + 1
+    messages_path.write_bytes(b"".join(message_lines) + record[:written])
+    assert load(engine, tmp_path)[1] == (200, 200)
+    assert 20001 not in message_ids(engine)
+
+    messages_path.write_bytes(b"".join(message_lines) + record)
+    assert load(engine, tmp_path)[1] == (1, 1)
+    with engine.connect() as conn:
+        text = conn.execute(
+            select(Message.message_text).where(Message.message_id == 20001)
+        ).scalar_one()
+    assert text == "First line\nsecond line"
+
+
+def test_changed_file_is_read_again_without_duplicates(engine, tmp_path):
+    physician_lines = read_lines("sample_data/physicians.csv")
+    (tmp_path / "physicians.csv").write_bytes(b"".join(physician_lines))
+    (tmp_path / "messages.csv").write_bytes(
+        b"".join(read_lines("sample_data/messages.csv"))
+    )
+    load(engine, tmp_path)
+    with engine.connect() as conn:
+        physician = conn.execute(
+            select(Physician.physician_id, Physician.state).limit(1)
+        ).one()
+
+    # an edited physician (a moved practice), the rest of the file is unchanged
+    line = next(
+        line
+        for line in physician_lines
+        if line.startswith(f"{physician.physician_id},".encode())
+    )
+    moved = line.replace(f",{physician.state},".encode(), b",ZZ,", 1)
+    (tmp_path / "physicians.csv").write_bytes(
+        b"".join(moved if other is line else other for other in physician_lines)
+    )
+    # a month archived since the load, its messages are not inserted again
+    archive_month(engine, "2025-07", str(tmp_path / "partitions"))
+
+    physicians, messages = load(engine, tmp_path)
+    assert physicians == (25, 1)
+    assert messages == (0, 0)
+    with engine.connect() as conn:
+        state = conn.execute(
+            select(Physician.state).where(
+                Physician.physician_id == physician.physician_id
+            )
+        ).scalar_one()
+        assert state == "ZZ"
+        assert conn.execute(select(func.count(Message.message_id))).scalar_one() == 176
+
+    # a rewritten messages file is scanned again, archived messages are found in the partition
+    lines = read_lines("sample_data/messages.csv")
+    (tmp_path / "messages.csv").write_bytes(b"".join([lines[0], *reversed(lines[1:])]))
+    assert load(engine, tmp_path)[1] == (200, 0)
+    assert len(message_ids(engine)) == 176
+
+
+def test_policy_is_upserted_per_version(engine, tmp_path):
+    with open("sample_data/compliance_policies.json") as f:
+        policy = json.load(f)
+    policy_path = tmp_path / "compliance_policies.json"
+    policy_path.write_text(json.dumps(policy))
+    (tmp_path / "physicians.csv").write_bytes(
+        b"".join(read_lines("sample_data/physicians.csv"))
+    )
+    (tmp_path / "messages.csv").write_bytes(
+        b"".join(read_lines("sample_data/messages.csv"))
+    )
+    load(engine, tmp_path)
+
+    def stored_results(version: str) -> int:
+        with engine.connect() as conn:
+            return conn.execute(
+                select(func.count()).where(
+                    TextClassification.compliance_version == version
+                )
+            ).scalar_one()
+
+    with Session(engine) as db:
+        assert load_compliance_policy(db, str(policy_path)) == "v1"
+        backfill_classifications(db, "v1")
+        # loading the same policy again is not an error and keeps the results
+        assert load_compliance_policy(db, str(policy_path)) == "v1"
+        assert stored_results("v1") == 7
+
+        # a new version reuses the rule ids of v1
+        v2_path = tmp_path / "compliance_policies_v2.json"
+        v2_path.write_text(json.dumps({**policy, "version": "v2"}))
+        assert load_compliance_policy(db, str(v2_path)) == "v2"
+        backfill_classifications(db, "v2")
+        assert stored_results("v1") == stored_results("v2") == 7
+
+        # a changed keyword invalidates the results of its version only
+        policy["rules"][0]["keywords_any"].append("zeppelin")
+        policy_path.write_text(json.dumps(policy))
+        load_compliance_policy(db, str(policy_path))
+        assert stored_results("v1") == 0
+        assert stored_results("v2") == 7
+
+        rule_counts = dict(
+            db.execute(
+                select(Rule.compliance_version, func.count()).group_by(
+                    Rule.compliance_version
+                )
+            ).all()
+        )
+        assert rule_counts == {"v1": len(policy["rules"]), "v2": len(policy["rules"])}
@@ -0,0 +1,191 @@
+###
+# Test that POST /messages/ingest validates NDJSON batches, writes and classifies them in
+# the background and pushes back when the queue is full
+###
+import json
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, exists, select
+
+from db.database import SessionLocal
+from db.models import KeywordPosting, Message, MessageText, TextClassification
+from db.texts import TextHashCollision
+from routers import ingest as ingest_router
+from services import ingest
+from services.classifications import active_compliance_version
+from services.response_cache import bump_data_version
+
+FIRST_INGEST_ID = 900000
+
+
+def ingest_message(message_id: int, **values) -> dict:
+    return {
+        "message_id": message_id,
+        "physician_id": 101,
+        "channel": "sms",
+        "direction": "inbound",
+        "timestamp": "2032-03-04T05:06:07",
+        "message_text": "Can you share the clinical trial data and dosing guidance?",
+        "campaign_id": "CMP-INGEST",
+        "topic": "clinical_trial",
+        "compliance_tag": "allowed",
+        "sentiment": "neutral",
+        "delivery_status": "delivered",
+        "response_latency_sec": "",
+        **values,
+    }
+
+
+def ndjson(messages: list[dict]) -> str:
+    return "\n".join(json.dumps(message) for message in messages) + "\n"
+
+
+@pytest.fixture(autouse=True)
+def remove_ingested_messages():
+    # other tests expect the sample data only
+    yield
+    ingest.ingest_queue.wait_until_idle(timeout=10)
+    with SessionLocal() as db:
+        db.execute(delete(Message).where(Message.message_id >= FIRST_INGEST_ID))
+        unused_texts = select(MessageText.text_hash).where(
+            ~exists().where(Message.text_hash == MessageText.text_hash)
+        )
+        for model in (TextClassification, KeywordPosting, MessageText):
+            db.execute(delete(model).where(model.text_hash.in_(unused_texts)))
+        bump_data_version(db)
+        db.commit()
+
+
+def test_ingested_messages_are_written_and_classified(test_client: TestClient):
+    messages = [ingest_message(FIRST_INGEST_ID + i) for i in range(3)]
+    response = test_client.post("/messages/ingest", content=ndjson(messages))
+    assert response.status_code == 202
+    assert response.json()["accepted"] == 3
+    assert ingest.ingest_queue.wait_until_idle(timeout=10)
+
+    items = test_client.get(
+        "/messages?start_date=2032-01-01T00:00:00&physician_id=101"
+    ).json()["items"]
+    assert [item["message_id"] for item in items] == [m["message_id"] for m in messages]
+    assert items[0]["direction"] == "inbound"
+    assert items[0]["response_latency_sec"] is None
+
+    with SessionLocal() as db:
+        version = active_compliance_version(db)
+        classified = db.execute(
+            select(Message.message_id)
+            .join(
+                TextClassification,
+                TextClassification.text_hash == Message.text_hash,
+            )
+            .where(
+                TextClassification.compliance_version == version,
+                Message.message_id >= FIRST_INGEST_ID,
+            )
+        ).scalars()
+        assert sorted(classified) == [m["message_id"] for m in messages]
+
+
+def test_duplicate_ids_keep_the_stored_message(test_client: TestClient):
+    first = ingest_message(FIRST_INGEST_ID)
+    duplicate = ingest_message(FIRST_INGEST_ID, message_text="A retried copy.")
+    for message in (first, duplicate):
+        response = test_client.post("/messages/ingest", content=ndjson([message]))
+        assert response.status_code == 202
+    assert ingest.ingest_queue.wait_until_idle(timeout=10)
+
+    with SessionLocal() as db:
+        stored = db.get(Message, FIRST_INGEST_ID)
+        assert stored is not None
+        assert stored.message_text == first["message_text"]
+
+
+def test_invalid_batches_are_rejected_whole(test_client: TestClient):
+    messages = [
+        ingest_message(FIRST_INGEST_ID),
+        ingest_message(FIRST_INGEST_ID + 1, timestamp="yesterday"),
+    ]
+    response = test_client.post("/messages/ingest", content=ndjson(messages))
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Line 2: timestamp")
+
+    response = test_client.post("/messages/ingest", content="not json\n")
+    assert response.status_code == 400
+    assert test_client.post("/messages/ingest", content="\n").status_code == 400
+    assert len(ingest.ingest_queue) == 0
+
+
+def test_optional_fields_are_stored_empty(test_client: TestClient):
+    # the csv shape allows leaving them out, an empty csv column is loaded as ""
+    message = ingest_message(FIRST_INGEST_ID)
+    for field in ("campaign_id", "topic", "sentiment", "response_latency_sec"):
+        del message[field]
+    response = test_client.post("/messages/ingest", content=ndjson([message]))
+    assert response.status_code == 202
+    assert ingest.ingest_queue.wait_until_idle(timeout=10)
+
+    with SessionLocal() as db:
+        stored = db.get(Message, FIRST_INGEST_ID)
+        assert stored is not None
+        assert (stored.campaign_id, stored.topic, stored.sentiment) == ("", "", "")
+        assert stored.response_latency_sec is None
+
+
+def test_a_message_failing_to_write_fails_alone(test_client: TestClient, monkeypatch):
+    bad_id = FIRST_INGEST_ID + 1
+    store_message_texts = ingest.store_message_texts
+
+    def failing_store(db, rows: list[dict]) -> list[dict]:
+        if any(row["message_id"] == bad_id for row in rows):
+            raise TextHashCollision("colliding text")
+        return store_message_texts(db, rows)
+
+    monkeypatch.setattr(ingest, "store_message_texts", failing_store)
+    monkeypatch.setattr(ingest.time, "sleep", lambda seconds: None)
+    failed = ingest.INGEST_MESSAGES.value(("failed",))
+
+    # the writer batch, it could as well hold the messages of other clients
+    messages = [ingest_message(FIRST_INGEST_ID + i) for i in range(3)]
+    response = test_client.post("/messages/ingest", content=ndjson(messages))
+    assert response.status_code == 202
+    assert ingest.ingest_queue.wait_until_idle(timeout=10)
+
+    assert ingest.INGEST_MESSAGES.value(("failed",)) == failed + 1
+    with SessionLocal() as db:
+        stored = db.execute(
+            select(Message.message_id).where(Message.message_id >= FIRST_INGEST_ID)
+        ).scalars()
+        assert sorted(stored) == [FIRST_INGEST_ID, FIRST_INGEST_ID + 2]
+
+
+def test_full_queue_is_answered_with_429(test_client: TestClient, monkeypatch):
+    queue = ingest.IngestQueue(max_messages=3)
+    monkeypatch.setattr(ingest_router, "ingest_queue", queue)
+    # the writer holds on to its first batch until released
+    taken, release = threading.Event(), threading.Event()
+
+    def blocked_write(rows: list[dict]):
+        taken.set()
+        release.wait(10)
+
+    monkeypatch.setattr(ingest, "write_messages", blocked_write)
+
+    def post(*message_ids: int):
+        messages = [ingest_message(FIRST_INGEST_ID + i) for i in message_ids]
+        return test_client.post("/messages/ingest", content=ndjson(messages))
+
+    assert post(0, 1, 2, 3).status_code == 413
+    assert post(0).status_code == 202
+    # the first batch is taken by the writer, then the queue fills up
+    assert taken.wait(10)
+    assert post(1, 2).status_code == 202
+    response = post(3, 4)
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+    assert post(3).status_code == 202
+
+    release.set()
+    queue.close(timeout=10)
+    assert len(queue) == 0
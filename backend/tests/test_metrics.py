@@ -0,0 +1,95 @@
+###
+# Test that requests and their SQL statements are recorded and served on /metrics
+###
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from db.database import engine
+from services import metrics
+from services.response_cache import response_cache
+
+
+def metric_value(test_client: TestClient, sample: str) -> float:
+    """Value of one sample, e.g. 'http_requests_total{method="GET",...}', 0 if not recorded yet"""
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    match = re.search(rf"^{re.escape(sample)} (\S+)$", response.text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_requests_are_counted_per_route_template(test_client: TestClient):
+    ok = (
+        'http_requests_total{method="POST",route="/classify/{message_id}",status="200"}'
+    )
+    not_found = 'http_request_errors_total{method="POST",route="/classify/{message_id}",status="404"}'
+    latency = 'http_request_duration_seconds_count{method="POST",route="/classify/{message_id}"}'
+    before = [metric_value(test_client, sample) for sample in (ok, not_found, latency)]
+
+    assert test_client.post("/classify/10001").status_code == 200
+    assert test_client.post("/classify/10002").status_code == 200
+    assert test_client.post("/classify/1").status_code == 404
+
+    after = [metric_value(test_client, sample) for sample in (ok, not_found, latency)]
+    assert [b - a for a, b in zip(before, after)] == [2, 1, 3]
+
+
+def test_sql_statements_are_counted(test_client: TestClient):
+    queries = 'db_queries_per_request_sum{method="GET",route="/physicians"}'
+    requests = 'db_queries_per_request_count{method="GET",route="/physicians"}'
+    response_cache.clear()
+    before_queries = metric_value(test_client, queries)
+    before_requests = metric_value(test_client, requests)
+
+    assert test_client.get("/physicians?state=CA").status_code == 200
+    # the data version of the response cache and a single select for the page
+    assert metric_value(test_client, queries) - before_queries == 2
+
+    assert test_client.get("/physicians?state=CA").status_code == 200
+    # a cached page only reads the data version
+    assert metric_value(test_client, queries) - before_queries == 3
+    assert metric_value(test_client, requests) - before_requests == 2
+
+
+def test_query_budget_flags_requests(test_client: TestClient, monkeypatch):
+    exceeded = 'db_query_budget_exceeded_total{method="GET",route="/messages"}'
+    before = metric_value(test_client, exceeded)
+
+    assert test_client.get("/messages").status_code == 200
+    assert metric_value(test_client, exceeded) == before
+
+    monkeypatch.setattr(metrics, "QUERY_BUDGET", 0)
+    assert test_client.get("/messages").status_code == 200
+    assert metric_value(test_client, exceeded) == before + 1
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("test_seconds", "Test", ("route",), (0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, ("/a",))
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 3',
+        'test_seconds_bucket{route="/a",le="+Inf"} 4',
+        'test_seconds_sum{route="/a"} 6.05',
+        'test_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_failing_statement_does_not_skew_later_timings():
+    with engine.connect() as conn, metrics.track_queries() as stats:
+        with pytest.raises(OperationalError):
+            conn.execute(text("SELECT * FROM no_such_table"))
+        conn.execute(text("SELECT 1")).scalar_one()
+        assert "query_start_times" not in conn.info
+
+    # only the statement that ran is counted, timed from its own start
+    assert stats.query_count == 1
+    assert 0 <= stats.db_seconds < 1
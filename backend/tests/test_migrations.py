@@ -0,0 +1,71 @@
+###
+# Test that the migration runner upgrades databases created before migrations existed
+###
+from sqlalchemy import create_engine, inspect
+
+from db.migrations import MIGRATIONS, migrate, pending_migrations
+
+# schema created by the original create_all, before any migration existed
+LEGACY_SCHEMA = [
+    "CREATE TABLE physicians (physician_id INTEGER NOT NULL PRIMARY KEY, npi CHAR(10) NOT NULL, "
+    "first_name TEXT NOT NULL, last_name TEXT NOT NULL, specialty TEXT NOT NULL, state CHAR(2) NOT NULL, "
+    "consent_opt_in BOOLEAN NOT NULL, preferred_channel TEXT NOT NULL)",
+    "CREATE TABLE messages (message_id INTEGER NOT NULL PRIMARY KEY, physician_id INTEGER NOT NULL "
+    "REFERENCES physicians (physician_id), channel TEXT NOT NULL, is_outbound BOOLEAN NOT NULL, "
+    "timestamp TIMESTAMP NOT NULL, message_text TEXT NOT NULL, campaign_id TEXT NOT NULL, topic TEXT NOT NULL, "
+    "compliance_tag TEXT NOT NULL, sentiment TEXT NOT NULL, delivery_status TEXT NOT NULL, "
+    "response_latency_sec FLOAT)",
+    "CREATE TABLE compliance_versions (version TEXT NOT NULL PRIMARY KEY, first_name TEXT NOT NULL)",
+    "CREATE TABLE rules (id TEXT NOT NULL, compliance_version TEXT NOT NULL REFERENCES compliance_versions (version), "
+    "name TEXT NOT NULL, result_type TEXT NOT NULL, result_text TEXT NOT NULL, PRIMARY KEY (id, compliance_version))",
+    "CREATE TABLE anykeywords (rule_id TEXT NOT NULL REFERENCES rules (id), keyword TEXT NOT NULL, "
+    "PRIMARY KEY (rule_id, keyword))",
+    "INSERT INTO physicians VALUES (101, '1089250953', 'Drew', 'Nguyen', 'Cardiology', 'MA', 1, 'sms')",
+    "INSERT INTO messages VALUES (1, 101, 'sms', 0, '2025-08-01 09:00:00', 'Can I get samples?', "
+    "'CMP-1', 'samples', 'none', 'neutral', 'delivered', NULL)",
+    "INSERT INTO compliance_versions VALUES ('v1', '2025-09-22')",
+    "INSERT INTO rules VALUES ('R-004', 'v1', 'Samples', 'action', 'route_to_rep')",
+    "INSERT INTO anykeywords VALUES ('R-004', 'samples')",
+]
+
+
+def test_migrate_legacy_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.exec_driver_sql(statement)
+
+    assert len(pending_migrations(engine)) == len(MIGRATIONS)
+    applied = migrate(engine)
+    assert applied == [name for _, name, _ in MIGRATIONS]
+    assert pending_migrations(engine) == []
+
+    inspector = inspect(engine)
+    message_indexes = {index["name"] for index in inspector.get_indexes("messages")}
+    assert {"ix_messages_physician_id_timestamp", "ix_messages_timestamp"} <= message_indexes
+    rule_indexes = {index["name"] for index in inspector.get_indexes("rules")}
+    assert "ix_rules_compliance_version" in rule_indexes
+    assert inspector.has_table("text_classifications")
+
+    with engine.connect() as conn:
+        keywords = conn.exec_driver_sql(
+            "SELECT rule_id, compliance_version, keyword FROM anykeywords"
+        ).all()
+        assert keywords == [("R-004", "v1", "samples")]
+        normalized = conn.exec_driver_sql(
+            "SELECT state_normalized, specialty_normalized FROM physicians"
+        ).one()
+        assert tuple(normalized) == ("ma", "cardiology")
+        # the inline text moved to message_texts and is still searchable
+        texts = conn.exec_driver_sql(
+            "SELECT m.message_text, t.message_text FROM messages m "
+            "JOIN message_texts t ON t.text_hash = m.text_hash"
+        ).one()
+        assert tuple(texts) == ("", "Can I get samples?")
+        found = conn.exec_driver_sql(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'samples'"
+        ).scalars()
+        assert list(found) == [1]
+
+    # running again is a no-op
+    assert migrate(engine) == []
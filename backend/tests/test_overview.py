@@ -0,0 +1,119 @@
+###
+# Test that physician overviews match the paged endpoints and take a fixed number of queries
+###
+from fastapi.testclient import TestClient
+
+from db.database import engine
+from db.partitions import archive_month, restore_month
+from tests.test_metrics import metric_value
+
+QUERIES = 'db_queries_per_request_sum{{method="{method}",route="{route}"}}'
+
+
+def overview_query_count(test_client: TestClient, method: str, route: str, **request):
+    sample = QUERIES.format(method=method, route=route)
+    before = metric_value(test_client, sample)
+    response = test_client.request(method, request.pop("url"), **request)
+    assert response.status_code == 200
+    return metric_value(test_client, sample) - before
+
+
+def physician_ids(test_client: TestClient) -> list[int]:
+    items = test_client.get("/physicians?limit=1000").json()["items"]
+    return [item["physician_id"] for item in items]
+
+
+def test_overview_matches_messages_and_classify(test_client: TestClient):
+    response = test_client.get("/physicians/101/overview?limit=4")
+    assert response.status_code == 200
+    overview = response.json()
+    assert (
+        overview["physician"]
+        == test_client.get("/physicians/search?prefix=1089250953").json()["items"][0]
+    )
+
+    # the most recent messages of /messages, newest first
+    messages = test_client.get("/messages?physician_id=101&limit=1000").json()["items"]
+    expected = messages[::-1][:4]
+    assert [
+        {key: value for key, value in item.items() if key != "matched_rules"}
+        for item in overview["messages"]
+    ] == expected
+    for item in overview["messages"]:
+        classified = test_client.post(f"/classify/{item['message_id']}").json()
+        assert item["matched_rules"] == classified["matched_rules"]
+
+    # the cursor pages through the older messages
+    seen = [item["message_id"] for item in overview["messages"]]
+    cursor = overview["next_cursor"]
+    while cursor is not None:
+        page = test_client.get(
+            "/physicians/101/overview", params={"limit": 4, "cursor": cursor}
+        ).json()
+        seen.extend(item["message_id"] for item in page["messages"])
+        cursor = page["next_cursor"]
+    assert seen == [item["message_id"] for item in messages[::-1]]
+
+
+def test_batch_overview_keeps_the_request_order(test_client: TestClient):
+    response = test_client.post(
+        "/physicians/overview",
+        json={"physician_ids": [105, 101, 99_999, 105], "limit": 2},
+    )
+    assert response.status_code == 200
+    items = response.json()["items"]
+    # unknown ids are skipped, repeated ones are answered once
+    assert [item["physician"]["physician_id"] for item in items] == [105, 101]
+    single = test_client.get("/physicians/105/overview?limit=2").json()
+    assert items[0] == single
+
+
+def test_overview_errors(test_client: TestClient):
+    assert test_client.get("/physicians/99999/overview").status_code == 404
+    response = test_client.get("/physicians/101/overview?compliance_version=v404")
+    assert response.status_code == 400
+    assert test_client.get("/physicians/101/overview?cursor=abc").status_code == 400
+    response = test_client.post("/physicians/overview", json={"physician_ids": []})
+    assert response.status_code == 422
+
+
+def test_query_count_does_not_grow_with_messages(test_client: TestClient):
+    ids = physician_ids(test_client)
+    # every text gets its stored classification first, later requests only read them
+    test_client.post("/physicians/overview", json={"physician_ids": ids, "limit": 100})
+
+    single = "/physicians/{physician_id}/overview"
+    counts = {
+        limit: overview_query_count(
+            test_client, "GET", single, url=f"/physicians/101/overview?limit={limit}"
+        )
+        for limit in (1, 5, 100)
+    }
+    assert len(set(counts.values())) == 1, counts
+
+    batch = {
+        count: overview_query_count(
+            test_client,
+            "POST",
+            "/physicians/overview",
+            url="/physicians/overview",
+            json={"physician_ids": ids[:count], "limit": 100},
+        )
+        for count in (1, 5, len(ids))
+    }
+    assert len(set(batch.values())) == 1, batch
+    # the rules revision, the physicians, their messages, the partition catalog and the
+    # stored classifications
+    assert batch[1] == counts[1] == 5
+
+
+def test_overview_reads_archived_months(test_client: TestClient, tmp_path):
+    ids = physician_ids(test_client)
+    request = {"physician_ids": ids, "limit": 100}
+    before = test_client.post("/physicians/overview", json=request).json()
+
+    archive_month(engine, "2025-07", str(tmp_path))
+    try:
+        assert test_client.post("/physicians/overview", json=request).json() == before
+    finally:
+        restore_month(engine, "2025-07")
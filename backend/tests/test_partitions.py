@@ -0,0 +1,230 @@
+###
+# Test that messages moved to monthly partitions are still served by the same endpoints
+###
+import json
+import os
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+from db.database import SessionLocal, engine
+from db.manage import route_to_partitions
+from db.models import Message
+from db.partitions import (
+    PartitionError,
+    archive_month,
+    attach_month,
+    detach_month,
+    restore_month,
+    set_read_only,
+)
+from db.texts import store_texts, text_hash
+from services import exports, ingest
+from services.response_cache import bump_data_version
+from tests.test_exports import InlineExecutor, download, run_export
+from tests.test_search import collect_pages
+
+# every page shape of /messages, small pages so they cross the partition boundary
+MESSAGE_URLS = [
+    "/messages?limit=7",
+    "/messages?limit=7&fields=message_id,timestamp,message_text",
+    "/messages?limit=5&start_date=2025-07-20T00:00:00&end_date=2025-08-05T00:00:00",
+    "/messages?limit=3&physician_id=101",
+    "/messages?limit=3&q=samples OR trial",
+]
+
+
+def collect_messages(test_client: TestClient, url: str) -> list[dict]:
+    items = collect_pages(test_client, url)[0]
+    if "q=" in url:
+        # bm25 ranks come from the full text index of each partition, equal texts can
+        # rank differently so only the matches are compared
+        return sorted(items, key=lambda item: item["message_id"])
+    return items
+
+
+@pytest.fixture
+def july_partition(tmp_path):
+    """The sample messages of 2025-07 moved to a partition for the test"""
+    moved_count = archive_month(engine, "2025-07", str(tmp_path))
+    assert moved_count == 24
+    try:
+        yield tmp_path / "messages_2025-07.db"
+    finally:
+        restore_month(engine, "2025-07")
+
+
+def july_message_ids() -> list[int]:
+    with SessionLocal() as db:
+        return list(
+            db.execute(
+                select(Message.message_id).filter(
+                    Message.timestamp < "2025-08-01", Message.timestamp >= "2025-07-01"
+                )
+            ).scalars()
+        )
+
+
+def test_partitioned_messages_match_the_hot_table(test_client: TestClient, tmp_path):
+    before = {url: collect_messages(test_client, url) for url in MESSAGE_URLS}
+    stats_before = test_client.get("/stats?group_by=month").json()
+
+    with SessionLocal() as db:
+        july_ids = [
+            message.message_id
+            for message in db.execute(select(Message)).scalars()
+            if message.timestamp.month == 7
+        ]
+    archive_month(engine, "2025-07", str(tmp_path))
+    try:
+        assert july_message_ids() == []
+        for url in MESSAGE_URLS:
+            assert collect_messages(test_client, url) == before[url], url
+        # the rollups keep the totals of the archived month
+        assert test_client.get("/stats?group_by=month").json() == stats_before
+
+        response = test_client.post(f"/classify/{july_ids[0]}")
+        assert response.status_code == 200
+        assert response.json()["message_id"] == july_ids[0]
+        assert test_client.post("/classify/1").status_code == 404
+    finally:
+        restore_month(engine, "2025-07")
+
+    assert sorted(july_message_ids()) == sorted(july_ids)
+    assert not os.path.exists(tmp_path / "messages_2025-07.db")
+    for url in MESSAGE_URLS:
+        assert collect_messages(test_client, url) == before[url], url
+    assert test_client.get("/stats?group_by=month").json() == stats_before
+
+
+def test_detach_and_read_only_partitions(test_client: TestClient, july_partition):
+    def message_count(url: str) -> int:
+        return len(collect_pages(test_client, url)[0])
+
+    all_messages = message_count("/messages?limit=1000")
+    august = "/messages?limit=1000&start_date=2025-08-01T00:00:00"
+    august_messages = message_count(august)
+
+    path = detach_month(engine, "2025-07")
+    assert path == str(july_partition)
+    assert message_count("/messages?limit=1000") == all_messages - 24
+    assert message_count(august) == august_messages
+
+    attach_month(engine, "2025-07", path, read_only=True)
+    assert os.stat(july_partition).st_mode & 0o222 == 0
+    assert message_count("/messages?limit=1000") == all_messages
+    with pytest.raises(PartitionError):
+        archive_month(engine, "2025-07")
+
+    set_read_only(engine, "2025-07", False)
+    assert message_count("/messages?limit=1000") == all_messages
+
+
+def test_loader_routes_messages_to_their_partition(test_client: TestClient, tmp_path):
+    archive_month(engine, "2025-07", str(tmp_path))
+    try:
+        # e.g. a late export of july loaded after the month was archived
+        with SessionLocal() as db:
+            store_texts(db, {text_hash("Zeppelin follow up."): "Zeppelin follow up."})
+            db.execute(
+                Message.__table__.insert().values(
+                    message_id=99_001,
+                    physician_id=101,
+                    channel="email",
+                    is_outbound=True,
+                    timestamp=datetime(2025, 7, 15, 9),
+                    text_hash=text_hash("Zeppelin follow up."),
+                    campaign_id="CAMP-LATE",
+                    topic="follow_up",
+                    compliance_tag="none",
+                    sentiment="neutral",
+                    delivery_status="delivered",
+                )
+            )
+            bump_data_version(db)
+            db.commit()
+        assert july_message_ids() == [99_001]
+
+        route_to_partitions()
+        assert july_message_ids() == []
+        items = test_client.get("/messages?q=zeppelin").json()["items"]
+        assert [item["message_id"] for item in items] == [99_001]
+    finally:
+        restore_month(engine, "2025-07")
+        with SessionLocal() as db:
+            db.execute(Message.__table__.delete().where(Message.message_id == 99_001))
+            bump_data_version(db)
+            db.commit()
+
+
+def test_exports_and_batches_include_archived_months(
+    test_client: TestClient, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(exports, "export_executor", InlineExecutor())
+    monkeypatch.setattr(exports, "EXPORT_DIR", tmp_path / "exports")
+    # windows and chunks that cross the partition boundary
+    monkeypatch.setattr(exports, "EXPORT_WINDOW_SIZE", 7)
+    monkeypatch.setattr(exports, "EXPORT_CHUNK_SIZE", 3)
+
+    def export_records() -> tuple[dict, list[dict]]:
+        job = run_export(test_client, format="ndjson")
+        lines = download(test_client, job).splitlines()
+        return job, [json.loads(line) for line in lines]
+
+    batches = [
+        {"physician_id": 101, "end_date": "2030-01-01T00:00:00"},
+        {"start_date": "2025-07-20T00:00:00", "end_date": "2025-08-05T00:00:00"},
+        {"message_ids": list(range(10000, 10200, 3))},
+    ]
+
+    def classify_batches() -> list[str]:
+        return [test_client.post("/classify/batch", json=b).text for b in batches]
+
+    job_before, records_before = export_records()
+    batches_before = classify_batches()
+    july_ids = july_message_ids()
+
+    archive_month(engine, "2025-07", str(tmp_path))
+    try:
+        job, records = export_records()
+        assert job["total_rows"] == job["rows_written"] == job_before["total_rows"]
+        assert records == records_before
+        assert july_ids and {r["message_id"] for r in records} >= set(july_ids)
+        assert classify_batches() == batches_before
+    finally:
+        restore_month(engine, "2025-07")
+
+
+def test_ingest_skips_messages_stored_in_a_partition(
+    test_client: TestClient, tmp_path
+):
+    [message_id, *_] = july_message_ids()
+    archive_month(engine, "2025-07", str(tmp_path))
+    try:
+        message = test_client.post(f"/classify/{message_id}").json()
+        # e.g. a retried pipeline batch of a message archived since
+        ingest.write_messages(
+            [
+                {
+                    "message_id": message_id,
+                    "physician_id": 101,
+                    "channel": "sms",
+                    "is_outbound": False,
+                    "timestamp": datetime(2025, 7, 15, 9),
+                    "message_text": "A retried copy.",
+                    "campaign_id": "CMP-RETRY",
+                    "topic": "follow_up",
+                    "compliance_tag": "none",
+                    "sentiment": "neutral",
+                    "delivery_status": "delivered",
+                    "response_latency_sec": None,
+                }
+            ]
+        )
+        # the archived message is not shadowed by a second copy in the hot table
+        assert july_message_ids() == []
+        assert test_client.post(f"/classify/{message_id}").json() == message
+    finally:
+        restore_month(engine, "2025-07")
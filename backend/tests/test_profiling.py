@@ -0,0 +1,115 @@
+###
+# Test the opt-in request profiler and the collapsed stacks of the sampling profiler
+###
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services import profiling
+
+TOKEN = {"x-profile-token": "test-token"}
+
+
+@pytest.fixture
+def profiling_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", "test-token")
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_profiled_request_reports_its_phases(test_client: TestClient, profiling_on):
+    response = test_client.get("/messages?limit=20", headers=TOKEN)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 20
+
+    profile_id = response.headers["x-profile-id"]
+    timings = dict(
+        metric.split(";dur=")
+        for metric in response.headers["server-timing"].split(", ")
+    )
+    assert set(timings) == set(profiling.PHASES)
+    # the page is read with sqlite (db) through the orm, then validated by pydantic
+    for phase in ("db", "orm", "validation"):
+        assert float(timings[phase]) > 0, phase
+
+    report = test_client.get(f"/debug/profiles/{profile_id}", headers=TOKEN)
+    assert report.status_code == 200
+    assert report.text.startswith("GET /messages")
+    assert "get_messages" in report.text
+    assert (profiling_on / f"request-{profile_id}.txt").exists()
+
+
+def test_handlers_run_in_the_threadpool_are_profiled(
+    test_client: TestClient, profiling_on
+):
+    # a sync handler runs on a worker thread, not the one of the middleware
+    response = test_client.post("/classify/10001", headers=TOKEN)
+    assert response.status_code == 200
+    report = test_client.get(
+        f"/debug/profiles/{response.headers['x-profile-id']}", headers=TOKEN
+    )
+    assert "classify_message" in report.text
+
+
+def test_unprofiled_requests_are_untouched(test_client: TestClient, profiling_on):
+    response = test_client.get("/messages?limit=5")
+    assert "x-profile-id" not in response.headers
+    assert "server-timing" not in response.headers
+
+    response = test_client.get("/messages?limit=5", headers={"x-profile-token": "x"})
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+
+
+def test_debug_routes_need_the_token(test_client: TestClient, monkeypatch):
+    # without PROFILE_TOKEN nothing is profiled and the routes are hidden
+    response = test_client.get("/messages?limit=5", headers=TOKEN)
+    assert "x-profile-id" not in response.headers
+    assert test_client.get("/debug/profiles/abc", headers=TOKEN).status_code == 404
+
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", "test-token")
+    wrong = {"x-profile-token": "wrong"}
+    assert test_client.get("/debug/profiles/abc", headers=wrong).status_code == 403
+    assert test_client.get("/debug/profiles/abc", headers=TOKEN).status_code == 404
+    assert test_client.get("/debug/profiles/../x", headers=TOKEN).status_code == 404
+    # the sampler only runs with SAMPLING_PROFILER=1
+    assert test_client.post("/debug/flamegraph", headers=TOKEN).status_code == 409
+
+
+def test_sampled_stacks_are_collapsed():
+    busy = threading.Event()
+    stop = threading.Event()
+
+    def spin():
+        busy.set()
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=spin, name="spinner")
+    thread.start()
+    busy.wait()
+    sampler = profiling.StackSampler(interval=0.001)
+    try:
+        for _ in range(5):
+            sampler.sample()
+    finally:
+        stop.set()
+        thread.join()
+
+    samples, sample_count, _ = sampler.take()
+    assert sample_count == 5
+    spinner = [stack for stack in samples if stack.startswith("spinner;")]
+    assert spinner
+    assert all(
+        "test_profiling.py:test_sampled_stacks_are_collapsed.<locals>.spin" in s
+        for s in spinner
+    )
+
+    lines = profiling.collapsed_stacks(samples).splitlines()
+    assert len(lines) == len(samples)
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert samples[stack] == int(count)
+    # taking resets the counts
+    assert sampler.take()[1] == 0
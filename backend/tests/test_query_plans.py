@@ -0,0 +1,124 @@
+###
+# Test that the statements behind each endpoint are answered with an index, not a full table scan
+###
+import re
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Select, event
+
+from db.database import SessionLocal, engine
+from db.models import Message
+from routers.search import (
+    MESSAGE_FIELDS,
+    build_message_search_stmt,
+    build_messages_stmt,
+    build_physicians_stmt,
+)
+from routers.classify import select_with_classification
+from routers.overview import recent_messages_stmt
+from routers.stats import build_stats_stmt
+from services.matcher import select_keywords, select_rules
+
+# "SCAN <table>" without "USING ..." reads every row of the table
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+def query_plan(stmt: Select) -> list[str]:
+    """EXPLAIN QUERY PLAN details of the exact sql (and parameters) sqlalchemy sends"""
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    db = SessionLocal()
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        db.execute(stmt).all()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    try:
+        [(statement, parameters)] = captured
+        rows = db.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + statement, parameters
+        )
+        return [row[3] for row in rows]
+    finally:
+        db.close()
+
+
+START = datetime(2024, 1, 10)
+END = datetime(2025, 9, 12, 23, 59, 59)
+
+STATEMENTS = {
+    "physicians by state": build_physicians_stmt("ca", None, None, None),
+    "physicians by specialty": build_physicians_stmt(None, "Cardiology", None, None),
+    "physicians by state and specialty": build_physicians_stmt(
+        "NY", "Oncology", None, None
+    ),
+    "physicians next page": build_physicians_stmt(None, None, 110, None),
+    "messages by physician": build_messages_stmt("101", None, None, None, None),
+    "messages by date range": build_messages_stmt(None, START, END, None, None),
+    "messages by physician and date range": build_messages_stmt(
+        "101", START, END, None, None
+    ),
+    "messages next page": build_messages_stmt(
+        None, None, None, (START, 10013), ["message_id"]
+    ),
+    "messages by physician next page": build_messages_stmt(
+        "101", START, None, (START, 10013), None
+    ),
+    # the full text index finds the matches, messages are looked up by primary key
+    "messages search": build_message_search_stmt(
+        "dosing", None, None, None, None, list(MESSAGE_FIELDS)
+    ),
+    "messages search by physician next page": build_message_search_stmt(
+        "clinical trial", "101", START, None, (-1.5, 10013), ["message_id"]
+    ),
+    "stats by day in a date range": build_stats_stmt(
+        ["day"], None, None, None, START.date(), END.date(), None
+    ),
+    "stats of a physician by campaign": build_stats_stmt(
+        ["campaign_id"], 101, None, None, None, None, None
+    ),
+    "classify message": select_with_classification("v1").where(
+        Message.message_id == 10013
+    ),
+    "classify batch by ids": select_with_classification("v1").where(
+        Message.message_id.in_([10013, 10153])
+    ),
+    "compliance version rules": select_rules("v1"),
+    "compliance version keywords": select_keywords("v1"),
+}
+
+
+@pytest.mark.parametrize("name", STATEMENTS)
+def test_statement_uses_index(name: str):
+    plan = query_plan(STATEMENTS[name])
+    assert plan
+    full_scans = [detail for detail in plan if FULL_SCAN.match(detail)]
+    assert not full_scans, f"{name} falls back to a full table scan: {plan}"
+
+
+def test_messages_order_uses_index():
+    # the keyset ordering must come from the index instead of sorting every row
+    plan = query_plan(build_messages_stmt("101", START, END, None, None))
+    assert not [detail for detail in plan if "TEMP B-TREE" in detail], plan
+
+
+def test_physician_overview_walks_the_index():
+    # every physician's page is read backwards from its index range, the only scans are
+    # of the small pages materialized for the union
+    plan = query_plan(recent_messages_stmt([101, 102], 20, (END, 10013)))
+    index_searches = [
+        detail
+        for detail in plan
+        if detail.startswith("SEARCH messages USING INDEX ix_messages_physician_id")
+    ]
+    assert len(index_searches) == 2, plan
+    assert not [
+        detail
+        for detail in plan
+        if "TEMP B-TREE" in detail or detail == "SCAN messages"
+    ], plan
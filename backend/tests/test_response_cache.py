@@ -0,0 +1,130 @@
+###
+# Test that /physicians and /messages responses are cached, revalidated with ETags,
+# coalesced and invalidated by the data version
+###
+import asyncio
+
+import httpx
+from fastapi.testclient import TestClient
+
+from db.database import SessionLocal
+from main import app
+from services.response_cache import (
+    CACHE_REQUESTS,
+    CachedResponse,
+    ResponseCache,
+    bump_data_version,
+    response_cache,
+)
+
+
+def cache_counts() -> dict[str, float]:
+    return {
+        result: CACHE_REQUESTS.value((result,))
+        for result in ("hit", "miss", "coalesced", "not_modified")
+    }
+
+
+def count_changes(before: dict[str, float]) -> dict[str, float]:
+    return {result: value - before[result] for result, value in cache_counts().items()}
+
+
+def test_etag_and_not_modified(test_client: TestClient):
+    response = test_client.get("/physicians?state=CA")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+
+    not_modified = test_client.get(
+        "/physicians?state=CA", headers={"If-None-Match": etag}
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+
+    weak = test_client.get(
+        "/physicians?state=CA", headers={"If-None-Match": f"W/{etag}"}
+    )
+    assert weak.status_code == 304
+
+    changed = test_client.get("/physicians?state=CA", headers={"If-None-Match": '"x"'})
+    assert changed.status_code == 200
+    assert changed.json() == response.json()
+
+
+def test_query_parameter_order_shares_an_entry(test_client: TestClient):
+    response_cache.clear()
+    before = cache_counts()
+    first = test_client.get("/messages?physician_id=101&limit=5")
+    second = test_client.get("/messages?limit=5&physician_id=101")
+    assert first.content == second.content
+    assert count_changes(before) == {
+        "hit": 1,
+        "miss": 1,
+        "coalesced": 0,
+        "not_modified": 0,
+    }
+
+
+def test_data_version_bump_invalidates(test_client: TestClient):
+    first = test_client.get("/physicians?specialty=Cardiology")
+    before = cache_counts()
+
+    with SessionLocal() as db:
+        bump_data_version(db)
+        db.commit()
+
+    second = test_client.get("/physicians?specialty=Cardiology")
+    assert second.content == first.content
+    assert count_changes(before)["miss"] == 1
+
+
+def test_errors_are_not_cached(test_client: TestClient):
+    before = cache_counts()
+    for _ in range(2):
+        response = test_client.get("/messages?cursor=not-a-cursor")
+        assert response.status_code == 400
+        assert "etag" not in response.headers
+    assert count_changes(before)["miss"] == 2
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    response_cache.clear()
+    before = cache_counts()
+
+    async def get_concurrently() -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://testserver"
+        ) as client:
+            return await asyncio.gather(
+                *(client.get("/messages?limit=50") for _ in range(5))
+            )
+
+    responses = asyncio.run(get_concurrently())
+    assert {response.status_code for response in responses} == {200}
+    assert len({response.content for response in responses}) == 1
+    changes = count_changes(before)
+    assert changes["miss"] == 1
+    assert changes["coalesced"] == 4
+
+
+def test_lru_eviction_by_size():
+    cache = ResponseCache(max_bytes=10)
+
+    def entry(body: bytes) -> CachedResponse:
+        return CachedResponse(1, 200, {}, body, '"etag"')
+
+    cache.put("a", entry(b"1234"))
+    cache.put("b", entry(b"1234"))
+    assert cache.get("a", 1) is not None  # b is now the least recently used
+    cache.put("c", entry(b"1234"))
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is not None and cache.get("c", 1) is not None
+    assert cache.size == 8
+
+    cache.put("too big", entry(b"12345678901"))
+    assert cache.get("too big", 1) is None
+    # an entry of an older data version is dropped on read
+    assert cache.get("a", 2) is None
+    assert cache.size == 4
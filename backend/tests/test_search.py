@@ -1,13 +1,16 @@
 ###
 # Test that search routes return correct items for the sample data
 ###
+import pytest
 from fastapi.testclient import TestClient
 
+from routers.search import encode_cursor
+
 
 def test_get_physicians_no_filter(test_client: TestClient):
     response = test_client.get("/physicians")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     assert "physician_id" in data[0]
 
@@ -15,7 +18,7 @@ def test_get_physicians_no_filter(test_client: TestClient):
 def test_get_physicians_filter_by_state(test_client: TestClient):
     response = test_client.get("/physicians?state=CA")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for physician in data:
         assert physician["state"] == "CA"
@@ -24,7 +27,7 @@ def test_get_physicians_filter_by_state(test_client: TestClient):
 def test_get_physicians_filter_by_specialty(test_client: TestClient):
     response = test_client.get("/physicians?specialty=Cardiology")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for physician in data:
         assert physician["specialty"] == "Cardiology"
@@ -33,14 +36,14 @@ def test_get_physicians_filter_by_specialty(test_client: TestClient):
 def test_get_physicians_filter_by_state_and_specialty(test_client: TestClient):
     response = test_client.get("/physicians?state=NY&specialty=Oncology")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) == 0  # there are no matching in sample data
 
 
 def test_get_messages_no_filter(test_client: TestClient):
     response = test_client.get("/messages")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     assert "message_id" in data[0]
 
@@ -48,7 +51,7 @@ def test_get_messages_no_filter(test_client: TestClient):
 def test_get_messages_filter_by_physician(test_client: TestClient):
     response = test_client.get("/messages?physician_id=101")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for message in data:
         assert message["physician_id"] == 101
@@ -57,7 +60,7 @@ def test_get_messages_filter_by_physician(test_client: TestClient):
 def test_get_messages_filter_by_start_date(test_client: TestClient):
     response = test_client.get("/messages?start_date=2024-01-15T00:00:00")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for message in data:
         assert message["timestamp"] >= "2025-01-15T00:00:00"
@@ -66,7 +69,7 @@ def test_get_messages_filter_by_start_date(test_client: TestClient):
 def test_get_messages_filter_by_end_date(test_client: TestClient):
     response = test_client.get("/messages?end_date=2025-09-15T00:00:00")
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for message in data:
         assert message["timestamp"] <= "2025-09-15T23:59:59"
@@ -77,7 +80,344 @@ def test_get_messages_filter_by_date_range(test_client: TestClient):
         "/messages?start_date=2024-01-10T00:00:00&end_date=2025-09-12T23:59:59"
     )
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert len(data) > 0
     for message in data:
         assert "2024-01-10T00:00:00" <= message["timestamp"] <= "2025-09-12T23:59:59"
+
+
+def collect_pages(test_client: TestClient, url: str) -> tuple[list[dict], int]:
+    items: list[dict] = []
+    pages = 0
+    cursor = None
+    while True:
+        page_url = url if cursor is None else f"{url}&cursor={cursor}"
+        response = test_client.get(page_url)
+        assert response.status_code == 200
+        page = response.json()
+        items.extend(page["items"])
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items, pages
+
+
+def test_get_messages_keyset_pagination(test_client: TestClient):
+    items, pages = collect_pages(test_client, "/messages?limit=30")
+    assert pages == 7  # 200 sample messages
+    assert len(items) == 200
+    assert len({message["message_id"] for message in items}) == 200
+
+    keys = [(message["timestamp"], message["message_id"]) for message in items]
+    assert keys == sorted(keys)
+
+
+def test_get_messages_pagination_keeps_filters(test_client: TestClient):
+    all_items = test_client.get("/messages?physician_id=101&limit=1000").json()
+    paged_items, _ = collect_pages(test_client, "/messages?physician_id=101&limit=2")
+    assert all_items["next_cursor"] is None
+    assert paged_items == all_items["items"]
+
+
+def test_get_messages_fields_projection(test_client: TestClient):
+    response = test_client.get("/messages?fields=message_id,direction,timestamp&limit=5")
+    assert response.status_code == 200
+    page = response.json()
+    full_page = test_client.get("/messages?limit=5").json()
+
+    assert page["next_cursor"] == full_page["next_cursor"]
+    assert page["items"] == [
+        {
+            "message_id": message["message_id"],
+            "direction": message["direction"],
+            "timestamp": message["timestamp"],
+        }
+        for message in full_page["items"]
+    ]
+
+
+def test_get_messages_invalid_fields_and_cursor(test_client: TestClient):
+    assert test_client.get("/messages?fields=password").status_code == 400
+    assert test_client.get("/messages?cursor=not-a-cursor").status_code == 400
+    assert test_client.get("/messages?limit=0").status_code == 422
+
+
+@pytest.mark.parametrize(
+    "url, values",
+    [
+        ("/physicians", (1, 2)),
+        ("/physicians", ("x",)),
+        ("/physicians", (True,)),
+        ("/physicians", ()),
+        ("/messages", ("2024-01-01T00:00:00", {"a": 1})),
+        ("/messages", ("2024-01-01T00:00:00",)),
+        ("/messages", ("not a timestamp", 1)),
+        ("/messages", (None, 1)),
+        ("/messages?q=dosing", ("0.5", 1)),
+        ("/physicians/101/overview", ("2024-01-01T00:00:00", "1")),
+        ("/physicians/101/overview", (20240101, 1)),
+        ("/stats?group_by=day", ([1],)),
+        ("/stats", ("2024-01-01",)),
+    ],
+)
+def test_malformed_cursors_are_rejected(test_client: TestClient, url, values):
+    cursor = encode_cursor(*values)
+    separator = "&" if "?" in url else "?"
+    response = test_client.get(f"{url}{separator}cursor={cursor}")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+@pytest.mark.parametrize("url", ["/physicians", "/messages"])
+def test_cursor_that_is_not_a_list_is_rejected(test_client: TestClient, url):
+    # a bare json value, not a list of values
+    response = test_client.get(f"{url}?cursor=NQ==")
+    assert response.status_code == 400
+
+
+def test_get_physicians_keyset_pagination(test_client: TestClient):
+    items, pages = collect_pages(test_client, "/physicians?limit=10")
+    assert pages == 3  # 25 sample physicians
+    ids = [physician["physician_id"] for physician in items]
+    assert ids == sorted(set(ids)) and len(ids) == 25
+
+
+def test_get_physicians_fields_projection(test_client: TestClient):
+    response = test_client.get("/physicians?state=CA&fields=last_name,state")
+    assert response.status_code == 200
+    data = response.json()["items"]
+    assert len(data) > 0
+    for physician in data:
+        assert physician.keys() == {"last_name", "state"}
+        assert physician["state"] == "CA"
+
+
+def test_fast_serialization_is_byte_identical(test_client: TestClient, monkeypatch):
+    from routers import search
+    from services.response_cache import response_cache
+
+    # both passes have to render their responses
+    monkeypatch.setattr(response_cache, "max_bytes", 0)
+
+    urls = [
+        "/physicians",
+        "/physicians?state=CA&limit=3",
+        "/messages?limit=1000",
+        "/messages?physician_id=101&limit=2",
+        "/messages?start_date=2025-07-01T00:00:00&limit=7",
+    ]
+    fast = [test_client.get(url).content for url in urls]
+    monkeypatch.setattr(search, "FAST_SERIALIZATION", False)
+    slow = [test_client.get(url).content for url in urls]
+    assert fast == slow
+
+
+def test_search_messages_terms_prefix_and_phrase(test_client: TestClient):
+    for q, word in [
+        ("dosing", "dosing"),
+        ("titr*", "titration"),
+        ('"clinical trial"', "clinical trial"),
+    ]:
+        response = test_client.get("/messages", params={"q": q, "limit": 1000})
+        assert response.status_code == 200
+        data = response.json()["items"]
+        assert len(data) > 0
+        for message in data:
+            assert word in message["message_text"].lower()
+
+
+def test_search_messages_keeps_filters(test_client: TestClient):
+    response = test_client.get(
+        "/messages", params={"q": "clinical", "physician_id": "101", "limit": 1000}
+    )
+    assert response.status_code == 200
+    data = response.json()["items"]
+    assert len(data) > 0
+    for message in data:
+        assert message["physician_id"] == 101
+        assert "clinical" in message["message_text"].lower()
+
+
+def test_search_messages_pagination(test_client: TestClient):
+    all_items = test_client.get("/messages?q=samples OR trial&limit=1000").json()
+    paged_items, pages = collect_pages(
+        test_client, "/messages?q=samples OR trial&limit=7"
+    )
+    assert all_items["next_cursor"] is None
+    assert pages > 1
+    assert paged_items == all_items["items"]
+
+
+def test_search_messages_invalid_query(test_client: TestClient):
+    for q in ['"unclosed', "dosing AND", "unknown_column:dosing"]:
+        response = test_client.get("/messages", params={"q": q})
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Invalid search query")
+    assert test_client.get("/messages?q=dosing&cursor=not-a-cursor").status_code == 400
+    assert test_client.get("/messages?q=").status_code == 422
+
+
+def test_physician_filters_fold_only_ascii_letters(test_client: TestClient):
+    from db.database import SessionLocal
+    from db.models import Physician
+    from services.response_cache import bump_data_version
+
+    def specialty_ids(specialty: str) -> list[int]:
+        response = test_client.get("/physicians", params={"specialty": specialty})
+        assert response.status_code == 200
+        return [physician["physician_id"] for physician in response.json()["items"]]
+
+    with SessionLocal() as db:
+        physician = db.get(Physician, 101)
+        assert physician is not None
+        original = physician.specialty
+        physician.specialty = "Électrophysiologie"
+        bump_data_version(db)
+        db.commit()
+        try:
+            # the same as LIKE, the ascii letters match in any case, others only exactly
+            assert specialty_ids("Électrophysiologie") == [101]
+            assert specialty_ids("ÉLECTROPHYSIOLOGIE") == [101]
+            assert specialty_ids("électrophysiologie") == []
+        finally:
+            physician.specialty = original
+            bump_data_version(db)
+            db.commit()
+
+
+def test_search_index_follows_message_changes(test_client: TestClient):
+    from db.database import SessionLocal
+    from db.models import Message
+    from db.texts import store_texts, text_hash
+    from services.response_cache import bump_data_version
+
+    def search_ids(q: str) -> list[int]:
+        items = test_client.get("/messages", params={"q": q}).json()["items"]
+        return [message["message_id"] for message in items]
+
+    with SessionLocal() as db:
+        message = db.get(Message, 10001)
+        assert message is not None
+        original_hash = message.text_hash
+        assert 10001 not in search_ids("zebrafish")
+
+        # messages point at their text, a new text is stored and referenced
+        new_text = "Zebrafish study follow up."
+        store_texts(db, {text_hash(new_text): new_text})
+        message.text_hash = text_hash(new_text)
+        bump_data_version(db)
+        db.commit()
+        assert search_ids("zebrafish") == [10001]
+        assert 10001 not in search_ids("reimbursement")
+
+        message.text_hash = original_hash
+        bump_data_version(db)
+        db.commit()
+        assert search_ids("zebrafish") == []
+        assert 10001 in search_ids("reimbursement")
+
+
+def physician_search_ids(test_client: TestClient, **params) -> list[int]:
+    response = test_client.get("/physicians/search", params=params)
+    assert response.status_code == 200
+    return [physician["physician_id"] for physician in response.json()["items"]]
+
+
+def test_search_physicians_by_prefix(test_client: TestClient):
+    # ordered by last name then first name
+    assert physician_search_ids(test_client, prefix="LE") == [124, 107, 118, 122]
+    # every word has to match a field
+    assert physician_search_ids(test_client, prefix="jamie le") == [118, 122]
+    assert physician_search_ids(test_client, prefix="1089") == [101]
+    # first name matches (ties by last name) before specialty matches, each physician once
+    assert physician_search_ids(test_client, prefix="ca") == [
+        124, 104, 102, 108, 121, 119, 101, 103, 110,
+    ]  # fmt: skip
+    assert physician_search_ids(test_client, prefix="ca", limit=2) == [124, 104]
+    assert physician_search_ids(test_client, prefix="zz") == []
+
+    items = test_client.get("/physicians/search?prefix=nguyen").json()["items"]
+    assert items[0] == test_client.get("/physicians?limit=1").json()["items"][0]
+
+
+def test_search_physicians_filters(test_client: TestClient):
+    assert physician_search_ids(test_client, prefix="le", state="pa") == [122]
+    assert physician_search_ids(
+        test_client, prefix="ca", state="CT", specialty="Cardiology"
+    ) == [104, 119]
+    assert physician_search_ids(test_client, prefix="ca", state="XX") == []
+
+    assert test_client.get("/physicians/search").status_code == 422
+    assert test_client.get("/physicians/search?prefix=").status_code == 422
+    assert test_client.get("/physicians/search?prefix=a&limit=101").status_code == 422
+
+
+def test_physician_directory_plans_agree():
+    import random
+    from services.physician_directory import PhysicianDirectory, PhysicianRecord
+
+    rng = random.Random(0)
+    names = ["Ana", "Anders", "Bo", "Lee", "Leeds", "Li", "Mary Ann", "Nguyen"]
+    specialties = ["Cardiology", "Cardiac Surgery", "Oncology", "Neurology"]
+    records = [
+        PhysicianRecord(
+            physician_id=physician_id,
+            npi=str(rng.randint(10**9, 10**10 - 1)),
+            first_name=rng.choice(names),
+            last_name=rng.choice(names),
+            specialty=rng.choice(specialties),
+            state=rng.choice(["CA", "NY", "WY"]),
+            consent_opt_in=True,
+            preferred_channel="sms",
+        )
+        for physician_id in range(2000)
+    ]
+    directory = PhysicianDirectory(list(records), data_version=1)
+
+    def matches(record: PhysicianRecord, prefix: str) -> bool:
+        fields = [record.last_name, record.first_name, record.npi, record.specialty]
+        return all(
+            any(field.lower().startswith(term) for field in fields)
+            for term in prefix.lower().split()
+        )
+
+    for prefix in ["a", "le", "LI a", "card", "1", "mary", "bo ne"]:
+        unfiltered = directory.search(prefix, limit=5000)
+        assert {r.physician_id for r in unfiltered} == {
+            r.physician_id for r in records if matches(r, prefix)
+        }
+        for state, specialty in [("WY", None), (None, "oncology"), ("ny", "Neurology")]:
+            # a short posting list is walked instead of the prefix ranges, same order
+            expected = [
+                record
+                for record in unfiltered
+                if (state is None or record.state == state.upper())
+                and (specialty is None or record.specialty.lower() == specialty.lower())
+            ]
+            assert directory.search(prefix, state, specialty, limit=5000) == expected
+            assert directory.search(prefix, state, specialty, limit=3) == expected[:3]
+
+
+def test_physician_directory_follows_data_changes(test_client: TestClient, monkeypatch):
+    from db.database import SessionLocal
+    from db.models import Physician
+    from services import physician_directory
+    from services.response_cache import bump_data_version
+
+    monkeypatch.setattr(physician_directory, "PHYSICIAN_DIRECTORY_REFRESH_SECONDS", 0)
+
+    assert physician_search_ids(test_client, prefix="zhang") == []
+    with SessionLocal() as db:
+        physician = db.get(Physician, 110)
+        assert physician is not None
+        original_last_name = physician.last_name
+
+        physician.last_name = "Zhang"
+        bump_data_version(db)
+        db.commit()
+        assert physician_search_ids(test_client, prefix="zhang") == [110]
+
+        physician.last_name = original_last_name
+        bump_data_version(db)
+        db.commit()
+        assert physician_search_ids(test_client, prefix="zhang") == []
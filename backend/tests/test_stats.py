@@ -0,0 +1,160 @@
+###
+# Test that /stats answers from the rollups with the same totals as the raw messages
+###
+from datetime import date, datetime
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+from db.database import SessionLocal
+from db.models import Message
+from db.texts import store_texts, text_hash
+from services.response_cache import bump_data_version
+from tests.test_search import collect_pages
+
+
+def raw_totals(*filters) -> dict:
+    """Totals computed from the messages table itself"""
+    with SessionLocal() as db:
+        messages = db.execute(select(Message).filter(*filters)).scalars().all()
+    latencies = [
+        m.response_latency_sec for m in messages if m.response_latency_sec is not None
+    ]
+    return {
+        "message_count": len(messages),
+        "outbound_count": sum(m.is_outbound for m in messages),
+        "delivered_count": sum(m.delivery_status == "delivered" for m in messages),
+        "bounced_count": sum(m.delivery_status == "bounced" for m in messages),
+        "failed_count": sum(m.delivery_status == "failed" for m in messages),
+        "positive_count": sum(m.sentiment == "positive" for m in messages),
+        "neutral_count": sum(m.sentiment == "neutral" for m in messages),
+        "negative_count": sum(m.sentiment == "negative" for m in messages),
+        "latency_count": len(latencies),
+        "min_latency_sec": min(latencies, default=None),
+        "max_latency_sec": max(latencies, default=None),
+    }
+
+
+def test_stats_totals_match_messages(test_client: TestClient):
+    response = test_client.get("/stats")
+    assert response.status_code == 200
+    [totals] = response.json()["items"]
+    expected = raw_totals()
+    assert {key: totals[key] for key in expected} == expected
+    assert totals["delivery_rate"] == expected["delivered_count"] / 200
+
+
+def test_stats_grouped_and_filtered(test_client: TestClient):
+    response = test_client.get(
+        "/stats?group_by=channel,physician_id&physician_id=101"
+        "&start_date=2024-01-10&end_date=2025-09-12"
+    )
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert len(items) > 0
+    assert [(i["channel"], i["physician_id"]) for i in items] == sorted(
+        (i["channel"], i["physician_id"]) for i in items
+    )
+    for item in items:
+        assert item.keys() >= {"channel", "physician_id"}
+        assert "day" not in item and "campaign_id" not in item
+        expected = raw_totals(
+            Message.physician_id == 101,
+            Message.channel == item["channel"],
+            Message.timestamp >= datetime(2024, 1, 10),
+            Message.timestamp < datetime(2025, 9, 13),
+        )
+        assert {key: item[key] for key in expected} == expected
+
+
+def test_stats_keyset_pagination(test_client: TestClient):
+    all_items = test_client.get("/stats?group_by=physician_id,day").json()
+    paged_items, pages = collect_pages(
+        test_client, "/stats?group_by=physician_id,day&limit=7"
+    )
+    assert all_items["next_cursor"] is None
+    assert pages > 1
+    assert paged_items == all_items["items"]
+
+
+def test_stats_invalid_parameters(test_client: TestClient):
+    assert test_client.get("/stats?group_by=message_text").status_code == 400
+    assert test_client.get("/stats?cursor=not-a-cursor").status_code == 400
+    assert test_client.get("/stats?group_by=day&cursor=WzFd").status_code == 200
+    response = test_client.get("/stats?start_date=2025-09-12&end_date=2024-01-10")
+    assert response.status_code == 400
+
+
+def test_rollups_follow_message_writes(test_client: TestClient):
+    def day_totals() -> list[dict]:
+        return test_client.get(
+            "/stats?group_by=day&start_date=2031-01-01&end_date=2031-01-01"
+        ).json()["items"]
+
+    assert day_totals() == []
+    with SessionLocal() as db:
+        next_id = db.execute(select(func.max(Message.message_id))).scalar_one() + 1
+        store_texts(db, {text_hash("Rollup test message."): "Rollup test message."})
+        for message_id, latency in [(next_id, 10.0), (next_id + 1, 30.0)]:
+            db.add(
+                Message(
+                    message_id=message_id,
+                    physician_id=101,
+                    channel="sms",
+                    is_outbound=False,
+                    timestamp=datetime(2031, 1, 1, 12),
+                    text_hash=text_hash("Rollup test message."),
+                    campaign_id="CMP-ROLLUP",
+                    topic="scheduling",
+                    compliance_tag="allowed",
+                    sentiment="positive",
+                    delivery_status="delivered",
+                    response_latency_sec=latency,
+                )
+            )
+        bump_data_version(db)
+        db.commit()
+
+        [totals] = day_totals()
+        assert totals["message_count"] == 2
+        assert totals["mean_latency_sec"] == 20.0
+        assert (totals["min_latency_sec"], totals["max_latency_sec"]) == (10.0, 30.0)
+
+        # an update and a delete recompute the group
+        message = db.get(Message, next_id + 1)
+        assert message is not None
+        message.response_latency_sec = 50.0
+        db.delete(db.get(Message, next_id))
+        bump_data_version(db)
+        db.commit()
+        [totals] = day_totals()
+        assert totals["message_count"] == 1
+        assert totals["min_latency_sec"] == totals["max_latency_sec"] == 50.0
+
+        db.delete(message)
+        bump_data_version(db)
+        db.commit()
+        assert day_totals() == []
+
+
+def test_stats_from_monthly_rollups_match_daily(test_client: TestClient):
+    from db.models import MessageRollup, MonthlyRollup
+    from routers.stats import choose_rollup
+
+    # whole months without a physician are answered from the monthly rollups
+    assert choose_rollup(["channel"], None, None, None)[0] is MonthlyRollup
+    assert choose_rollup(["month"], None, date(2025, 8, 1), date(2025, 8, 31))[0] is (
+        MonthlyRollup
+    )
+    assert choose_rollup(["month"], None, date(2025, 8, 2), None)[0] is MessageRollup
+    assert choose_rollup(["channel"], 101, None, None)[0] is MessageRollup
+    assert choose_rollup(["day"], None, None, None)[0] is MessageRollup
+
+    monthly = test_client.get("/stats?group_by=month,channel&start_date=2025-08-01")
+    # an end in the middle of a month sums the daily rollups instead
+    daily = test_client.get(
+        "/stats?group_by=month,channel&start_date=2025-08-01&end_date=2099-12-30"
+    )
+    assert monthly.status_code == daily.status_code == 200
+    assert len(monthly.json()["items"]) > 0
+    assert monthly.json()["items"] == daily.json()["items"]
@@ -0,0 +1,78 @@
+###
+# Test that the startup warm-up primes the caches and that /ready follows it
+###
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+from main import app
+from routers import health
+from services import matcher, warmup
+from services.physician_directory import physician_directory
+
+
+def test_warm_up_primes_caches(monkeypatch):
+    matcher.invalidate_matchers()
+    monkeypatch.setattr(physician_directory, "directory", None)
+    state = warmup.WarmupState()
+    asyncio.run(warmup.warm_up(state))
+
+    assert state.ready and state.error is None
+    assert list(state.steps) == [
+        "database",
+        "connections",
+        "statements",
+        "physician_directory",
+    ]
+    assert state.seconds is not None and state.seconds >= sum(state.steps.values())
+    assert "v1" in matcher._matchers
+    assert physician_directory.directory is not None
+    assert warmup.WARMUP_SECONDS.value(("total",)) == state.seconds
+
+
+def test_warm_up_fails_on_pending_migrations(monkeypatch):
+    monkeypatch.setattr(warmup, "pending_migrations", lambda engine: ["export_jobs"])
+    state = warmup.WarmupState()
+    asyncio.run(warmup.warm_up(state))
+    assert not state.ready
+    assert state.error == "Pending migrations: export_jobs"
+
+
+def test_ready_follows_the_warm_up(test_client: TestClient, monkeypatch):
+    state = warmup.WarmupState()
+    monkeypatch.setattr(health, "warmup_state", state)
+    response = test_client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["detail"] == "Warming up"
+
+    state.error = "Pending migrations: export_jobs"
+    response = test_client.get("/ready")
+    assert response.status_code == 503
+    assert (
+        response.json()["detail"] == "Warm-up failed: Pending migrations: export_jobs"
+    )
+
+    state.error = None
+    state.ready, state.seconds, state.steps = True, 0.5, {"database": 0.1}
+    response = test_client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": "ready",
+        "warmup_seconds": 0.5,
+        "warmup_steps": {"database": 0.1},
+    }
+
+
+def test_lifespan_runs_the_warm_up(monkeypatch):
+    state = warmup.WarmupState()
+    monkeypatch.setattr(health, "warmup_state", state)
+    monkeypatch.setattr(warmup, "warmup_state", state)
+    # only /ready is requested until the warm-up is done, the test database has a
+    # single connection
+    with TestClient(app) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/ready").status_code != 200:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    assert state.ready
@@ -19,12 +19,16 @@ interface MessageSearchProps {
 
 export default function MessageSearch({ initialPhysicianId }: MessageSearchProps) {
     const [physicianId, setPhysicianId] = useState("");
+    const [searchText, setSearchText] = useState("");
 
     const [startDate, setStartDate] = useState<Date | null>(null);
     const [endDate, setEndDate] = useState<Date | null>(new Date());
 
     const [messages, setMessages] = useState<Message[]>([]);
+    // cursor of the page after the listed messages, null on the last page
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
     const [loading, setLoading] = useState(false);
+    const [loadingMore, setLoadingMore] = useState(false);
     const [error, setError] = useState<string | null>(null);
 
     const [classifying, setClassifying] = useState<Record<number, boolean>>({});
@@ -34,6 +38,7 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
 
     const [lastSearched, setLastSearched] = useState<{
         physicianId: string;
+        searchText: string;
         startDate: Date | null;
         endDate: Date | null;
     } | null>(null);
@@ -49,6 +54,7 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
             setLoading(true);
             setError(null);
             setMessages([]);
+            setNextCursor(null);
             setClassificationResults({});
             const physicianIdNum = physicianId ? parseInt(physicianId, 10) : null;
 
@@ -57,9 +63,10 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
                 setLoading(false);
                 return;
             }
-            const data = await getMessages(physicianIdNum, startDate, endDate);
-            setMessages(data);
-            setLastSearched({ physicianId, startDate, endDate });
+            const page = await getMessages(physicianIdNum, startDate, endDate, searchText.trim());
+            setMessages(page.items);
+            setNextCursor(page.next_cursor);
+            setLastSearched({ physicianId, searchText: searchText.trim(), startDate, endDate });
         } catch (err) {
             setError("Failed to load messages.");
             setLastSearched(null);
@@ -68,6 +75,33 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
         }
     };
 
+    // the next page of the last search, not of the current inputs
+    const handleLoadMore = async () => {
+        if (!lastSearched || !nextCursor) {
+            return;
+        }
+        try {
+            setLoadingMore(true);
+            setError(null);
+            const physicianIdNum = lastSearched.physicianId
+                ? parseInt(lastSearched.physicianId, 10)
+                : null;
+            const page = await getMessages(
+                physicianIdNum,
+                lastSearched.startDate,
+                lastSearched.endDate,
+                lastSearched.searchText,
+                nextCursor
+            );
+            setMessages((prev) => [...prev, ...page.items]);
+            setNextCursor(page.next_cursor);
+        } catch (err) {
+            setError("Failed to load more messages.");
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     const handleClassify = async (messageId: number) => {
         setClassifying((prev) => ({ ...prev, [messageId]: true }));
         try {
@@ -92,6 +126,13 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
                     value={physicianId}
                     onChange={(e) => setPhysicianId(e.target.value)}
                 />
+                <input
+                    type="text"
+                    name="searchText"
+                    placeholder="Message text"
+                    value={searchText}
+                    onChange={(e) => setSearchText(e.target.value)}
+                />
                 <label htmlFor="start-date">From:</label>
                 <input
                     type="date"
@@ -118,6 +159,7 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
                     <p>
                         Results for:
                         <strong>{lastSearched.physicianId ? ` Physician ID ${lastSearched.physicianId}` : ' All Physicians'}</strong> Messages
+                        {lastSearched.searchText && <> matching <strong>{lastSearched.searchText}</strong></>}
                         {lastSearched.startDate && lastSearched.endDate ? (
                             <> from <strong>{toDateInputString(lastSearched.startDate)}</strong> to <strong>{toDateInputString(lastSearched.endDate)}</strong></>
                         ) : lastSearched.startDate ? (
@@ -191,6 +233,11 @@ export default function MessageSearch({ initialPhysicianId }: MessageSearchProps
             ) : (
                 lastSearched && <p>No messages found for the selected criteria.</p>
             )}
+            {nextCursor && !loading && (
+                <button type="button" onClick={handleLoadMore} disabled={loadingMore}>
+                    {loadingMore ? "Loading..." : "Load more"}
+                </button>
+            )}
         </div>
     );
 }
@@ -20,16 +20,18 @@ export default function PhysicianSearch({
     const [physicians, setPhysicians] = useState<Physician[]>([]);
     const [loading, setLoadingPhysicians] = useState(false);
     const [error, setError] = useState<string | null>(null);
+    // filters of the listed physicians and the cursor of their next page
+    const [filters, setFilters] = useState({ state: "", specialty: "" });
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
 
 
-    const handleSearch = async () => {
-        const specialty = specialtyRef.current?.value || "";
-        const state = stateRef.current?.value || "";
+    const loadPage = async (state: string, specialty: string, cursor: string | null) => {
         try {
             setLoadingPhysicians(true);
             setError(null);
-            const data = await getPhysicians(state, specialty);
-            setPhysicians(data);
+            const page = await getPhysicians(state, specialty, cursor);
+            setPhysicians((prev) => (cursor ? [...prev, ...page.items] : page.items));
+            setNextCursor(page.next_cursor);
         } catch (err) {
             setError("Failed to load physicians.");
         } finally {
@@ -37,6 +39,17 @@ export default function PhysicianSearch({
         }
     };
 
+    const handleSearch = async () => {
+        const specialty = specialtyRef.current?.value || "";
+        const state = stateRef.current?.value || "";
+        setFilters({ state, specialty });
+        await loadPage(state, specialty, null);
+    };
+
+    const handleLoadMore = async () => {
+        await loadPage(filters.state, filters.specialty, nextCursor);
+    };
+
     return (
         <div className={styles.physicianSearch}>
             <h2>Physician Search</h2>
@@ -78,6 +91,11 @@ export default function PhysicianSearch({
                     ))}
                 </ul>
             }
+            {nextCursor && (
+                <button type="button" onClick={handleLoadMore} disabled={loading}>
+                    {loading ? "Loading..." : "Load more"}
+                </button>
+            )}
             {error && <p className={styles.error}>{error}</p>}
         </div>
     );
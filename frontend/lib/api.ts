@@ -1,27 +1,50 @@
-import type { Physician, Message, ClassifyMessageResponse } from './types';
+import type { Physician, Message, ClassifyMessageResponse, Page } from './types';
 
 const API_BASE_URL = 'http://localhost:8000';
+const PAGE_LIMIT = 100;
+
+// list endpoints are keyset paginated, a page is fetched when the ui asks for it by
+// passing back the next_cursor of the previous one
+async function getPage<T>(
+    path: string,
+    params: URLSearchParams,
+    cursor: string | null | undefined,
+    errorMessage: string
+): Promise<Page<T>> {
+    params.set('limit', PAGE_LIMIT.toString());
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    const response = await fetch(`${API_BASE_URL}${path}?${params.toString()}`);
+    if (!response.ok) {
+        throw new Error(errorMessage);
+    }
+    return response.json();
+}
 
 export async function getPhysicians(
     state?: string,
-    specialty?: string
-): Promise<Physician[]> {
+    specialty?: string,
+    cursor?: string | null
+): Promise<Page<Physician>> {
     const params = new URLSearchParams();
     if (state) params.append('state', state);
     if (specialty) params.append('specialty', specialty);
-    const response = await fetch(`${API_BASE_URL}/physicians?${params.toString()}`);
-    if (!response.ok) {
-        throw new Error('Failed to fetch physicians');
-    }
-    return response.json();
+    return getPage<Physician>('/physicians', params, cursor, 'Failed to fetch physicians');
 }
 
 export async function getMessages(
     physicianId?: number | null,
     startDate?: Date | null,
-    endDate?: Date | null
-): Promise<Message[]> {
+    endDate?: Date | null,
+    searchText?: string,
+    cursor?: string | null
+): Promise<Page<Message>> {
     const params = new URLSearchParams();
+    // full text search, results come back most relevant first
+    if (searchText) {
+        params.append('q', searchText);
+    }
     if (physicianId) {
         params.append('physician_id', physicianId.toString());
     }
@@ -36,11 +59,7 @@ export async function getMessages(
         end.setDate(end.getDate() + 1);
         params.append('end_date', (<string>end.toISOString().split('T')[0]));
     };
-    const response = await fetch(`${API_BASE_URL}/messages?${params.toString()}`);
-    if (!response.ok) {
-        throw new Error('Failed to fetch messages');
-    }
-    return response.json();
+    return getPage<Message>('/messages', params, cursor, 'Failed to fetch messages');
 }
 
 export async function classifyMessage(messageId: number): Promise<ClassifyMessageResponse> {
@@ -24,6 +24,11 @@ export interface Message {
     response_latency_sec?: number;
 }
 
+export interface Page<T> {
+    items: T[];
+    next_cursor: string | null;
+}
+
 export interface RuleResponse {
     id: string;
     name: string;